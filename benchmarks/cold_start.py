@@ -0,0 +1,72 @@
+"""
+Measures the cold-start cost of lambda.py: module import time and the latency of the first
+PowerController directive, each in a fresh interpreter, against a local Home Assistant stand-in.
+PT-BR: Mede o custo de cold start do lambda.py: tempo de importação do módulo e latência da
+primeira diretiva PowerController, cada um num interpretador novo, contra um HA local simulado.
+
+Usage / Uso:
+	python benchmarks/cold_start.py [--runs 10] [--rev <git revision>]
+
+--rev measures lambda.py as it was at another git revision, so before/after numbers can be
+compared on the same machine (e.g. `--rev HEAD~1`).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from fakes import FakeHomeAssistant
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD_SCRIPT = """
+import importlib.util, json, sys, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('lambda_function', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+directive = {"directive": {"header": {"namespace": "Alexa.PowerController", "name": "TurnOn", "messageId": "m", "correlationToken": "c"}, "endpoint": {"endpointId": "light.bench"}, "payload": {}}}
+response = module.lambda_handler(directive, None)
+invoked = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "first_invocation_ms": (invoked - imported) * 1000, "response": response["event"]["header"]["name"], "boto3_imported": "boto3" in sys.modules}))
+"""
+
+def _lambda_source(rev):
+	if not rev: return os.path.join(REPO_ROOT, 'lambda.py')
+	source = subprocess.run(['git', 'show', f'{rev}:lambda.py'], cwd=REPO_ROOT, check=True, capture_output=True).stdout
+	path = os.path.join(tempfile.mkdtemp(prefix='cold-start-'), 'lambda.py')
+	with open(path, 'wb') as f: f.write(source)
+	return path
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+	parser.add_argument('--runs', type=int, default=10)
+	parser.add_argument('--rev', help='git revision of lambda.py to measure (default: working tree)')
+	args = parser.parse_args()
+
+	server = FakeHomeAssistant().start()
+	env = {**os.environ, 'HA_URL': server.url, 'HA_TOKEN': 'bench', 'AWS_DEFAULT_REGION': os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')}
+	source = _lambda_source(args.rev)
+
+	samples = []
+	for _ in range(args.runs):
+		proc = subprocess.run([sys.executable, '-c', CHILD_SCRIPT, source], env=env, capture_output=True, text=True)
+		if proc.returncode != 0:
+			print(json.dumps({"rev": args.rev or 'working-tree', "error": proc.stderr.strip().splitlines()[-1]}))
+			return 1
+		samples.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+	server.stop()
+
+	summary = {"rev": args.rev or 'working-tree', "runs": args.runs, "boto3_imported": samples[-1]["boto3_imported"]}
+	for metric in ("import_ms", "first_invocation_ms"):
+		values = [sample[metric] for sample in samples]
+		summary[metric] = {"median": round(statistics.median(values), 2), "min": round(min(values), 2), "max": round(max(values), 2)}
+	print(json.dumps(summary, indent=2))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,181 @@
+"""
+Local stand-ins for the services lambda.py talks to, used by the offline benchmarks:
+a Home Assistant REST API, the Alexa Event Gateway / Login with Amazon token endpoint and an
+in-memory replacement for the DynamoDB tokens table. Latency and failure rate are configurable.
+PT-BR: Simuladores locais dos serviços usados pelo lambda.py nos benchmarks offline: a API REST
+do Home Assistant, o Alexa Event Gateway / endpoint de token do Login with Amazon e uma tabela
+de tokens em memória no lugar do DynamoDB. Latência e taxa de falhas são configuráveis.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def make_states(lights=20, covers=5, scripts=5, others=0, tag=None):
+	"""
+	Generates HA state objects for a synthetic install; `others` adds sensors that discovery must skip.
+	PT-BR: Gera estados do HA para uma instalação sintética; `others` adiciona sensores que a descoberta deve ignorar.
+	"""
+	extra = {tag: True} if tag else {}
+	states = [{"entity_id": f"light.bench_{i}", "state": "on", "attributes": {"friendly_name": f"Light {i}", "brightness": 128, "hs_color": [30.0, 50.0], "supported_color_modes": ["hs", "color_temp"], **extra}} for i in range(lights)]
+	states += [{"entity_id": f"cover.bench_{i}", "state": "open", "attributes": {"friendly_name": f"Cover {i}", "current_position": 50, **extra}} for i in range(covers)]
+	states += [{"entity_id": f"script.bench_{i}", "state": "off", "attributes": {"friendly_name": f"Script {i}", **extra}} for i in range(scripts)]
+	states += [{"entity_id": f"sensor.bench_{i}", "state": "21.5", "attributes": {"friendly_name": f"Sensor {i}", "unit_of_measurement": "°C"}} for i in range(others)]
+	return states
+
+class _FakeServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, handler, latency_ms, failure_rate):
+		super().__init__(('127.0.0.1', 0), handler)
+		self.latency_ms, self.failure_rate = latency_ms, failure_rate
+		self.requests = 0
+		self.lock = threading.Lock()
+
+	@property
+	def url(self):
+		return f'http://127.0.0.1:{self.server_port}'
+
+	def start(self):
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+class _FakeHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	# PT-BR: Sem isso, headers e corpo saem em dois segmentos e o delayed ACK adiciona ~40 ms por resposta.
+	disable_nagle_algorithm = True
+
+	def log_message(self, *args): pass
+
+	def _read_body(self):
+		return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+	def _send(self, status, payload=None, content_type='application/json'):
+		body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8') if payload is not None else b''
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def _simulate(self):
+		"""Applies the configured latency and returns True when this request should fail."""
+		with self.server.lock: self.server.requests += 1
+		if self.server.latency_ms: time.sleep(self.server.latency_ms / 1000.0 * random.uniform(0.8, 1.2))
+		return random.random() < self.server.failure_rate
+
+class _HomeAssistantHandler(_FakeHandler):
+	def do_GET(self):
+		if self._simulate(): return self._send(503, {"message": "Simulated failure"})
+		if self.path == '/api/states':
+			return self._send(200, list(self.server.states.values()))
+		if self.path.startswith('/api/states/'):
+			if (state := self.server.states.get(self.path[len('/api/states/'):])) is None: return self._send(404, {"message": "Entity not found."})
+			return self._send(200, state)
+		self._send(404, {"message": "Not found"})
+
+	def do_POST(self):
+		body = json.loads(self._read_body() or b'{}')
+		if self._simulate(): return self._send(503, {"message": "Simulated failure"})
+		if self.path == '/api/template':
+			# PT-BR: Não há Jinja aqui; aplica em Python o mesmo filtro do template de estados (membros, ou domínios e tag).
+			variables = body.get('variables', {})
+			matches = [state for state in self.server.states.values() if state['entity_id'] in variables.get('members', ()) or (state['entity_id'].split('.')[0] in variables.get('domains', ()) and (not variables.get('tag') or state['attributes'].get(variables['tag'])))]
+			return self._send(200, ''.join(json.dumps(state) + '\n' for state in matches).encode('utf-8'), content_type='text/plain')
+		if self.path.startswith('/api/services/'):
+			service = self.path.rsplit('/', 1)[-1]
+			entity_ids = body.get('entity_id', [])
+			changed = []
+			for entity_id in [entity_ids] if isinstance(entity_ids, str) else entity_ids:
+				if (state := self.server.states.get(entity_id)) is None: continue
+				state['state'] = {'turn_off': 'off', 'close_cover': 'closed', 'open_cover': 'open'}.get(service, 'on')
+				state['attributes'].update({k: v for k, v in body.items() if k in ('brightness', 'hs_color', 'kelvin')})
+				if 'position' in body: state['attributes']['current_position'] = body['position']
+				changed.append(state)
+			return self._send(200, changed)
+		self._send(404, {"message": "Not found"})
+
+class FakeHomeAssistant(_FakeServer):
+	"""
+	Home Assistant REST API stand-in serving /api/states, /api/template (state queries) and /api/services/<domain>/<service>.
+	PT-BR: Simulador da API REST do Home Assistant com /api/states, /api/template (consultas de estado) e /api/services/<domínio>/<serviço>.
+	"""
+	def __init__(self, states=None, latency_ms=0, failure_rate=0.0):
+		super().__init__(_HomeAssistantHandler, latency_ms, failure_rate)
+		self.states = {state['entity_id']: state for state in (states if states is not None else make_states())}
+
+class _AmazonHandler(_FakeHandler):
+	def do_POST(self):
+		self._read_body()
+		if self._simulate():
+			return self._send(503, {"message": "Simulated failure"})
+		if self.path == '/v3/events':
+			with self.server.lock: self.server.events += 1
+			return self._send(202)
+		if self.path == '/auth/o2/token':
+			return self._send(200, {"access_token": f"Atza|bench-{time.time()}", "refresh_token": "Atzr|bench", "token_type": "bearer", "expires_in": 3600})
+		self._send(404, {"message": "Not found"})
+
+class FakeAmazon(_FakeServer):
+	"""
+	Alexa Event Gateway (/v3/events) and Login with Amazon token endpoint (/auth/o2/token) stand-in.
+	PT-BR: Simulador do Alexa Event Gateway (/v3/events) e do endpoint de token do Login with Amazon (/auth/o2/token).
+	"""
+	def __init__(self, latency_ms=0, failure_rate=0.0):
+		super().__init__(_AmazonHandler, latency_ms, failure_rate)
+		self.events = 0
+
+class InMemoryTokensTable:
+	"""
+	Minimal stand-in for the boto3 DynamoDB Table API used by lambda.py (keyed by user_id).
+	PT-BR: Substituto mínimo da API de Table do DynamoDB (boto3) usada pelo lambda.py (chave user_id).
+	"""
+	def __init__(self, latency_ms=0):
+		self.items, self.latency_ms, self.calls = {}, latency_ms, 0
+
+	def _round_trip(self):
+		self.calls += 1
+		if self.latency_ms: time.sleep(self.latency_ms / 1000.0)
+
+	def get_item(self, Key, **kwargs):
+		self._round_trip()
+		return {'Item': dict(self.items[Key['user_id']])} if Key['user_id'] in self.items else {}
+
+	def put_item(self, Item, **kwargs):
+		self._round_trip()
+		self.items[Item['user_id']] = dict(Item)
+
+	def update_item(self, Key, UpdateExpression='', ExpressionAttributeValues=None, **kwargs):
+		self._round_trip()
+		item = self.items.setdefault(Key['user_id'], dict(Key))
+		values = ExpressionAttributeValues or {}
+		if UpdateExpression.startswith('ADD #users'):
+			item.setdefault('users', set()).update(values[':user'])
+		names = {':at': 'access_token', ':rt': 'refresh_token', ':ea': 'expires_at', ':ua': 'updated_at', ':now': 'seeded_at'}
+		item.update({names[k]: v for k, v in values.items() if k in names})
+		return {}
+
+	def scan(self, **kwargs):
+		self._round_trip()
+		return {'Items': [dict(item) for item in self.items.values() if 'access_token' in item]}
+
+class InMemoryDynamoDB:
+	"""
+	Stand-in for the boto3 DynamoDB service resource: Table() and batch_get_item() over one InMemoryTokensTable.
+	PT-BR: Substituto do resource de serviço DynamoDB do boto3: Table() e batch_get_item() sobre uma InMemoryTokensTable.
+	"""
+	def __init__(self, table_name, table=None):
+		self.table_name, self.table = table_name, table or InMemoryTokensTable()
+
+	def Table(self, name):
+		return self.table
+
+	def batch_get_item(self, RequestItems):
+		self.table._round_trip()
+		keys = RequestItems[self.table_name]['Keys']
+		return {'Responses': {self.table_name: [dict(self.table.items[key['user_id']]) for key in keys if key['user_id'] in self.table.items]}, 'UnprocessedKeys': {}}
@@ -0,0 +1,183 @@
+"""
+Offline benchmark for lambda.py. Starts local Home Assistant and Alexa Gateway / LWA stand-ins
+(see fakes.py), drives lambda_handler with generated directives and webhooks and reports
+p50/p95/p99 latency and throughput per scenario as JSON.
+PT-BR: Benchmark offline do lambda.py. Sobe simuladores locais do Home Assistant e do Alexa
+Gateway / LWA (ver fakes.py), chama o lambda_handler com diretivas e webhooks gerados e
+reporta latência p50/p95/p99 e vazão por cenário em JSON.
+
+Usage / Uso:
+	python benchmarks/run.py [--iterations 200] [--concurrency 1] [--ha-latency-ms 20]
+		[--gateway-latency-ms 30] [--failure-rate 0] [--scenarios power,change_report_15]
+		[--output results.json] [--compare baseline.json --threshold 20]
+"""
+import argparse
+import base64
+import gzip
+import importlib.util
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fakes import FakeAmazon, FakeHomeAssistant, InMemoryDynamoDB, InMemoryTokensTable, make_states
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEBHOOK_SECRET = 'bench-secret'
+BENCH_USER_ID = 'bench-user'
+
+def _directive(namespace, name, endpoint_id=None, payload=None):
+	directive = {"header": {"namespace": namespace, "name": name, "payloadVersion": "3", "messageId": f"bench-{time.perf_counter_ns()}", "correlationToken": "bench-correlation"}, "payload": payload or {}}
+	if endpoint_id: directive["endpoint"] = {"scope": {"type": "BearerToken", "token": "bench"}, "endpointId": endpoint_id}
+	return {"directive": directive}
+
+def _webhook(entities):
+	return {"requestContext": {"http": {"method": "POST", "sourceIp": "127.0.0.1"}}, "headers": {"x-webhook-secret": WEBHOOK_SECRET}, "body": json.dumps({"entities": entities}), "isBase64Encoded": False}
+
+def _compact_webhook(entities):
+	# PT-BR: Mesmo lote no formato colunar (v2) compactado com gzip, como enviado pelo WEBHOOK-SYNC-ALEXA-BATCH.yml.
+	columns = ["entity_id", "state", "brightness"]
+	body = json.dumps({"v": 2, "cols": columns, "rows": [[e["entity_id"], e["state"], e["attributes"]["brightness"]] for e in entities]}, separators=(',', ':'))
+	headers = {"x-webhook-secret": WEBHOOK_SECRET, "content-encoding": "gzip"}
+	return {"requestContext": {"http": {"method": "POST", "sourceIp": "127.0.0.1"}}, "headers": headers, "body": base64.b64encode(gzip.compress(body.encode())).decode(), "isBase64Encoded": True}
+
+def _light_changes(i, count):
+	# PT-BR: O brilho varia a cada iteração para que os ChangeReports não sejam descartados como duplicados.
+	return [{"entity_id": f"light.bench_{n}", "state": "on", "attributes": {"brightness": 1 + (i * 7 + n) % 254}} for n in range(count)]
+
+# PT-BR: Cada cenário recebe o número da iteração e devolve o evento a ser enviado ao lambda_handler.
+SCENARIOS = {
+	"discovery": lambda i: _directive("Alexa.Discovery", "Discover", payload={"scope": {"type": "BearerToken", "token": "bench"}}),
+	"report_state": lambda i: _directive("Alexa", "ReportState", f"light.bench_{i % 20}"),
+	"power": lambda i: _directive("Alexa.PowerController", "TurnOn" if i % 2 else "TurnOff", f"light.bench_{i % 20}"),
+	"brightness": lambda i: _directive("Alexa.BrightnessController", "SetBrightness", f"light.bench_{i % 20}", {"brightness": i % 100}),
+	"color": lambda i: _directive("Alexa.ColorController", "SetColor", f"light.bench_{i % 20}", {"color": {"hue": float(i % 360), "saturation": 0.5, "brightness": 0.8}}),
+	"color_temperature": lambda i: _directive("Alexa.ColorTemperatureController", "SetColorTemperature", f"light.bench_{i % 20}", {"colorTemperatureInKelvin": 2700 + i % 3000}),
+	"range": lambda i: _directive("Alexa.RangeController", "SetRangeValue", f"cover.bench_{i % 5}", {"rangeValue": i % 100}),
+	"mode": lambda i: _directive("Alexa.ModeController", "SetMode", f"cover.bench_{i % 5}", {"mode": "Cover.Open" if i % 2 else "Cover.Closed"}),
+	"scene": lambda i: _directive("Alexa.SceneController", "Activate", f"script.bench_{i % 5}"),
+	"change_report_1": lambda i: _webhook(_light_changes(i, 1)),
+	"change_report_15": lambda i: _webhook(_light_changes(i, 15)),
+	"change_report_15_compact": lambda i: _compact_webhook(_light_changes(i, 15)),
+}
+
+def _succeeded(response):
+	if 'statusCode' in response:
+		body = json.loads(response.get('body') or '{}')
+		return response['statusCode'] == 200 and all(result.get('success') for result in body.get('results', []))
+	return response.get('event', {}).get('header', {}).get('name') != 'ErrorResponse'
+
+def load_lambda_module(ha, amazon, table):
+	"""
+	Imports lambda.py configured against the stand-ins, with the tokens table pre-seeded.
+	PT-BR: Importa o lambda.py configurado para os simuladores, com a tabela de tokens já preenchida.
+	"""
+	os.environ.update({
+		'HA_URL': ha.url, 'HA_TOKEN': 'bench', 'WEBHOOK_SECRET': WEBHOOK_SECRET,
+		'ALEXA_GATEWAY_URL': amazon.url, 'LWA_TOKEN_URL': f'{amazon.url}/auth/o2/token',
+		'ALEXA_CLIENT_ID': 'bench', 'ALEXA_CLIENT_SECRET': 'bench', 'ALEXA_USER_ID': BENCH_USER_ID,
+		'RATE_LIMIT_MAX_REQUESTS': str(10 ** 9), 'RETRY_QUEUE_PATH': os.path.join(tempfile.mkdtemp(), 'retry-queue.db'),
+		# PT-BR: Sem o índice em cache, o cenário de descoberta mede a leitura completa do HA a cada iteração.
+		'DISCOVERY_INDEX_TTL': '0',
+	})
+	spec = importlib.util.spec_from_file_location('lambda_function', os.path.join(REPO_ROOT, 'lambda.py'))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	table.items[BENCH_USER_ID] = {'user_id': BENCH_USER_ID, 'access_token': 'Atza|bench', 'refresh_token': 'Atzr|bench', 'expires_at': int(time.time()) + 3600}
+	table.items['route#*'] = {'user_id': 'route#*', 'users': {BENCH_USER_ID}}
+	module._aws_clients['dynamodb'] = InMemoryDynamoDB(module.DYNAMODB_TABLE_NAME, table)
+	return module
+
+def _percentile(sorted_values, pct):
+	return sorted_values[min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))]
+
+def run_scenario(module, build_event, iterations, concurrency, warmup):
+	"""
+	Runs one scenario and returns its latency percentiles (ms), throughput (req/s) and error count.
+	PT-BR: Executa um cenário e retorna os percentis de latência (ms), a vazão (req/s) e o número de erros.
+	"""
+	for i in range(warmup): module.lambda_handler(build_event(-1 - i), None)
+
+	def invoke(i):
+		event = build_event(i)
+		start = time.perf_counter()
+		response = module.lambda_handler(event, None)
+		return (time.perf_counter() - start) * 1000, _succeeded(response)
+
+	started = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		samples = list(executor.map(invoke, range(iterations)))
+	elapsed = time.perf_counter() - started
+	latencies = sorted(latency for latency, _ in samples)
+	return {
+		"iterations": iterations,
+		"errors": sum(1 for _, ok in samples if not ok),
+		"p50_ms": round(_percentile(latencies, 50), 3),
+		"p95_ms": round(_percentile(latencies, 95), 3),
+		"p99_ms": round(_percentile(latencies, 99), 3),
+		"mean_ms": round(statistics.fmean(latencies), 3),
+		"throughput_rps": round(iterations / elapsed, 2),
+	}
+
+def compare(results, baseline, threshold):
+	"""
+	Prints per-scenario deltas against a previous result file; returns True when any p95 regressed beyond the threshold (%).
+	PT-BR: Mostra as diferenças por cenário em relação a um resultado anterior; retorna True se algum p95 piorou além do limite (%).
+	"""
+	regressed = False
+	for name, current in results["scenarios"].items():
+		if not (previous := baseline.get("scenarios", {}).get(name)): continue
+		deltas = {key: (current[key] - previous[key]) / previous[key] * 100 if previous[key] else 0.0 for key in ("p50_ms", "p95_ms", "p99_ms")}
+		flag = deltas["p95_ms"] > threshold
+		regressed |= flag
+		print(f"{name:20s} p50 {deltas['p50_ms']:+7.1f}%  p95 {deltas['p95_ms']:+7.1f}%  p99 {deltas['p99_ms']:+7.1f}%{'  REGRESSION' if flag else ''}", file=sys.stderr)
+	return regressed
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+	parser.add_argument('--iterations', type=int, default=200)
+	parser.add_argument('--concurrency', type=int, default=1)
+	parser.add_argument('--warmup', type=int, default=3)
+	parser.add_argument('--ha-latency-ms', type=float, default=0)
+	parser.add_argument('--gateway-latency-ms', type=float, default=0)
+	parser.add_argument('--failure-rate', type=float, default=0.0)
+	parser.add_argument('--entities', type=int, default=0, help='extra non-exposed HA entities (sensors) in the fake install')
+	parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+	parser.add_argument('--output', help='write the JSON result to this file')
+	parser.add_argument('--compare', help='previous JSON result to compare against')
+	parser.add_argument('--threshold', type=float, default=20.0, help='p95 regression threshold in percent for --compare')
+	parser.add_argument('--verbose', action='store_true', help='keep lambda.py log output (simulated failures are logged as errors)')
+	args = parser.parse_args()
+	if not args.verbose: logging.disable(logging.CRITICAL)
+
+	ha = FakeHomeAssistant(make_states(others=args.entities), latency_ms=args.ha_latency_ms, failure_rate=args.failure_rate).start()
+	amazon = FakeAmazon(latency_ms=args.gateway_latency_ms, failure_rate=args.failure_rate).start()
+	module = load_lambda_module(ha, amazon, InMemoryTokensTable())
+
+	results = {
+		"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "python": platform.python_version(), "platform": platform.platform(),
+			**{key: getattr(args, key) for key in ("iterations", "concurrency", "ha_latency_ms", "gateway_latency_ms", "failure_rate", "entities")}},
+		"scenarios": {},
+	}
+	for name in args.scenarios.split(','):
+		results["scenarios"][name] = run_scenario(module, SCENARIOS[name], args.iterations, args.concurrency, args.warmup)
+	results["meta"].update(ha_requests=ha.requests, gateway_events=amazon.events)
+	ha.stop()
+	amazon.stop()
+
+	output = json.dumps(results, indent=2)
+	if args.output:
+		with open(args.output, 'w') as f: f.write(output + '\n')
+	print(output)
+	if args.compare:
+		with open(args.compare) as f: baseline = json.load(f)
+		return 1 if compare(results, baseline, args.threshold) else 0
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+Compares the token store backends of lambda.py: DynamoDB (against the in-memory table stand-in
+with a simulated round trip) and the embedded SQLite file. Reports p50/p95/p99 latency and
+throughput per operation and backend as JSON.
+PT-BR: Compara os armazenamentos de tokens do lambda.py: DynamoDB (contra a tabela simulada em
+memória, com latência de ida e volta configurável) e o arquivo SQLite embutido. Reporta latência
+p50/p95/p99 e vazão por operação e armazenamento em JSON.
+
+Usage / Uso:
+	python benchmarks/storage.py [--iterations 1000] [--users 100] [--dynamodb-latency-ms 5]
+		[--backends dynamodb,sqlite] [--output storage.json]
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from fakes import InMemoryDynamoDB, InMemoryTokensTable
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# PT-BR: Cada operação recebe o armazenamento, o número da iteração e a lista de user_ids já gravados.
+OPERATIONS = {
+	"get": lambda store, i, users: store.get(users[i % len(users)]),
+	"get_consistent": lambda store, i, users: store.get(users[i % len(users)], consistent=True),
+	"batch_get_25": lambda store, i, users: store.batch_get([users[(i + n) % len(users)] for n in range(25)]),
+	"update_tokens": lambda store, i, users: store.update_tokens(users[i % len(users)], f"Atza|{i}", "Atzr|bench", int(time.time()) + 3600),
+	"add_user": lambda store, i, users: store.add_user(f"route#light.bench_{i % 20}", users[i % len(users)]),
+}
+
+def _percentile(sorted_values, pct):
+	return sorted_values[min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))]
+
+def load_lambda_module():
+	spec = importlib.util.spec_from_file_location('lambda_function', os.path.join(REPO_ROOT, 'lambda.py'))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def make_store(module, backend, dynamodb_latency_ms):
+	"""
+	Builds a store of the given backend, the DynamoDB one wired to the in-memory table stand-in.
+	PT-BR: Cria um armazenamento do tipo informado; o do DynamoDB usa a tabela simulada em memória.
+	"""
+	if backend == 'sqlite':
+		return module.SQLiteTokenStore(os.path.join(tempfile.mkdtemp(), 'tokens.db'))
+	module._aws_clients.pop('tokens_table', None)
+	module._aws_clients['dynamodb'] = InMemoryDynamoDB(module.DYNAMODB_TABLE_NAME, InMemoryTokensTable(latency_ms=dynamodb_latency_ms))
+	return module.DynamoDBTokenStore()
+
+def run_operation(store, operation, iterations, users):
+	"""
+	Runs one operation sequentially and returns its latency percentiles (ms) and throughput (ops/s).
+	PT-BR: Executa uma operação em sequência e retorna os percentis de latência (ms) e a vazão (ops/s).
+	"""
+	latencies = []
+	started = time.perf_counter()
+	for i in range(iterations):
+		start = time.perf_counter()
+		operation(store, i, users)
+		latencies.append((time.perf_counter() - start) * 1000)
+	elapsed = time.perf_counter() - started
+	latencies.sort()
+	return {
+		"iterations": iterations,
+		"p50_ms": round(_percentile(latencies, 50), 4),
+		"p95_ms": round(_percentile(latencies, 95), 4),
+		"p99_ms": round(_percentile(latencies, 99), 4),
+		"mean_ms": round(statistics.fmean(latencies), 4),
+		"throughput_ops": round(iterations / elapsed, 1),
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+	parser.add_argument('--iterations', type=int, default=1000)
+	parser.add_argument('--users', type=int, default=100, help='linked users written to each store before measuring')
+	parser.add_argument('--dynamodb-latency-ms', type=float, default=5, help='simulated DynamoDB round trip')
+	parser.add_argument('--backends', default='dynamodb,sqlite')
+	parser.add_argument('--output', help='write the JSON result to this file')
+	args = parser.parse_args()
+	logging.disable(logging.CRITICAL)
+
+	module = load_lambda_module()
+	users = [f"bench-user-{n}" for n in range(args.users)]
+	results = {
+		"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "python": platform.python_version(), "platform": platform.platform(),
+			**{key: getattr(args, key) for key in ("iterations", "users", "dynamodb_latency_ms")}},
+		"backends": {},
+	}
+	for backend in args.backends.split(','):
+		store = make_store(module, backend, args.dynamodb_latency_ms)
+		for user_id in users:
+			store.put({'user_id': user_id, 'access_token': 'Atza|bench', 'refresh_token': 'Atzr|bench', 'expires_at': int(time.time()) + 3600})
+		results["backends"][backend] = {name: run_operation(store, operation, args.iterations, users) for name, operation in OPERATIONS.items()}
+
+	output = json.dumps(results, indent=2)
+	if args.output:
+		with open(args.output, 'w') as f: f.write(output + '\n')
+	print(output)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -1,11 +1,19 @@
 import json
-import urllib.request
 import urllib.parse
+import http.client
 import os
 import time
 import base64
-import boto3
-from collections import defaultdict
+import uuid
+import threading
+import sqlite3
+import zlib
+import math
+import contextvars
+import contextlib
+import random
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import traceback
 import logging
 
@@ -24,13 +32,216 @@ ALEXA_CLIENT_ID = os.environ.get('ALEXA_CLIENT_ID')
 ALEXA_CLIENT_SECRET = os.environ.get('ALEXA_CLIENT_SECRET')
 DYNAMODB_TABLE_NAME = os.environ.get('DYNAMODB_TABLE', 'alexa-user-tokens')
 HA_DISCOVERY_TAG = os.environ.get('HA_DISCOVERY_TAG')
+# PT-BR: user_id vinculado (opcional). Quando definido, o token é lido por chave sem nenhum scan.
+ALEXA_USER_ID = os.environ.get('ALEXA_USER_ID')
+# PT-BR: Janela (ms) em que mudanças seguidas de um mesmo endpoint são agrupadas; só o valor mais recente é enviado. 0 desativa.
+# Só vale no modo servidor e no bridge: na Lambda cada webhook é uma invocação (às vezes noutro container) e não há o que agrupar.
+CHANGE_REPORT_COALESCE_MS = int(os.environ.get('CHANGE_REPORT_COALESCE_MS', '0'))
+# PT-BR: Na Lambda o container congela após a resposta, então threads de fundo (ex: o timer do agrupamento) não rodam entre invocações.
+RUNNING_ON_LAMBDA = bool(os.environ.get('AWS_LAMBDA_FUNCTION_NAME'))
+# PT-BR: Rate limit dos webhooks: requisições por janela (s), por IP. 'dynamodb' compartilha a contagem entre containers.
+RATE_LIMIT_MAX_REQUESTS = int(os.environ.get('RATE_LIMIT_MAX_REQUESTS', '100'))
+RATE_LIMIT_WINDOW = int(os.environ.get('RATE_LIMIT_WINDOW', '60'))
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'local')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '10000'))
+# PT-BR: Métricas por etapa em CloudWatch EMF e fração das requisições com trace detalhado (0.0 a 1.0).
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'HASyncAlexa')
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+# PT-BR: Fila de reenvio de ChangeReports que falharam: 'sqlite' (arquivo local), 'sqs' (RETRY_QUEUE_URL) ou 'none'.
+RETRY_QUEUE_BACKEND = os.environ.get('RETRY_QUEUE_BACKEND', 'sqlite')
+RETRY_QUEUE_PATH = os.environ.get('RETRY_QUEUE_PATH', '/tmp/alexa-retry-queue.db')
+RETRY_QUEUE_URL = os.environ.get('RETRY_QUEUE_URL')
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', '8'))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', '2'))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', '300'))
+# PT-BR: Validade (s) do cache em memória do índice entidade -> usuários.
+ROUTE_INDEX_TTL = float(os.environ.get('ROUTE_INDEX_TTL', '300'))
+# PT-BR: Armazenamento dos tokens, do índice de roteamento e da referência da descoberta: 'dynamodb' ou 'sqlite' (arquivo local em modo WAL,
+# PT-BR: para instalações próprias e testes offline), e validade (s) da cópia em memória das leituras do SQLite.
+TOKEN_STORE_BACKEND = os.environ.get('TOKEN_STORE_BACKEND', 'dynamodb')
+TOKEN_STORE_PATH = os.environ.get('TOKEN_STORE_PATH', 'alexa-tokens.db')
+TOKEN_STORE_CACHE_TTL = float(os.environ.get('TOKEN_STORE_CACHE_TTL', '60'))
+# PT-BR: Evento agendado (EventBridge): renova tokens que expiram nos próximos N segundos, com N refreshes em paralelo e atraso aleatório (s) de até N.
+TOKEN_REFRESH_AHEAD = int(os.environ.get('TOKEN_REFRESH_AHEAD', '900'))
+TOKEN_REFRESH_CONCURRENCY = int(os.environ.get('TOKEN_REFRESH_CONCURRENCY', '4'))
+TOKEN_REFRESH_JITTER = float(os.environ.get('TOKEN_REFRESH_JITTER', '2'))
+# PT-BR: Validade (s) do índice de descoberta usado para responder ao Discover sem reler /api/states. 0 desativa.
+DISCOVERY_INDEX_TTL = float(os.environ.get('DISCOVERY_INDEX_TTL', '60'))
+# PT-BR: Validade (s) do cache de estados usado pelo ReportState. 0 desativa.
+STATE_CACHE_TTL = float(os.environ.get('STATE_CACHE_TTL', '5'))
+# PT-BR: Tamanho máximo (bytes) do corpo do webhook depois de descompactado (protege contra gzip malicioso).
+WEBHOOK_MAX_BODY_BYTES = int(os.environ.get('WEBHOOK_MAX_BODY_BYTES', str(1024 * 1024)))
+# PT-BR: Endpoint regional do Alexa Event Gateway (ex: https://api.eu.amazonalexa.com) e tamanho do pool de envio.
+ALEXA_GATEWAY_URL = os.environ.get('ALEXA_GATEWAY_URL', 'https://api.amazonalexa.com')
+LWA_TOKEN_URL = os.environ.get('LWA_TOKEN_URL', 'https://api.amazon.com/auth/o2/token')
+GATEWAY_MAX_WORKERS = int(os.environ.get('GATEWAY_MAX_WORKERS', '8'))
+# PT-BR: Limite de conexões keep-alive por host e tempo máximo (s) que uma conexão ociosa é reaproveitada.
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.environ.get('HTTP_MAX_CONNECTIONS_PER_HOST', '10'))
+HTTP_IDLE_TIMEOUT = float(os.environ.get('HTTP_IDLE_TIMEOUT', '60'))
+# PT-BR: Circuit breaker do HA: falhas de conexão seguidas que abrem o circuito e espera (s) até a requisição de teste.
+HA_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('HA_CIRCUIT_FAILURE_THRESHOLD', '3'))
+HA_CIRCUIT_COOLDOWN = float(os.environ.get('HA_CIRCUIT_COOLDOWN', '30'))
+# PT-BR: Domínios do HA (ex: cover,script) ou '*' cujas diretivas de controle recebem DeferredResponse e terminam de forma assíncrona; vazio desativa.
+DEFERRED_RESPONSE_DOMAINS = {domain.strip() for domain in os.environ.get('DEFERRED_RESPONSE_DOMAINS', '').split(',') if domain.strip()}
+DEFERRED_RESPONSE_SECONDS = int(os.environ.get('DEFERRED_RESPONSE_SECONDS', '15'))
+# PT-BR: Modo bridge (python lambda.py bridge): janela (ms) para agrupar eventos do WebSocket e intervalo (s) para reler as entidades descobertas.
+BRIDGE_BATCH_MS = int(os.environ.get('BRIDGE_BATCH_MS', '100'))
+BRIDGE_DISCOVERY_INTERVAL = float(os.environ.get('BRIDGE_DISCOVERY_INTERVAL', '300'))
+# PT-BR: Modo servidor (python lambda.py serve): endereço, threads para os handlers, espera (s) pelas requisições em andamento ao encerrar,
+# PT-BR: tempo (s) que uma conexão keep-alive ociosa fica aberta e intervalo (s) da manutenção agendada (tokens e fila de reenvio; 0 desativa).
+SERVER_HOST = os.environ.get('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', '8080'))
+SERVER_MAX_WORKERS = int(os.environ.get('SERVER_MAX_WORKERS', '32'))
+SERVER_SHUTDOWN_TIMEOUT = float(os.environ.get('SERVER_SHUTDOWN_TIMEOUT', '10'))
+SERVER_KEEPALIVE_TIMEOUT = float(os.environ.get('SERVER_KEEPALIVE_TIMEOUT', '75'))
+SERVER_MAINTENANCE_INTERVAL = float(os.environ.get('SERVER_MAINTENANCE_INTERVAL', '600'))
 
-# PT-BR: Clientes para serviços AWS e cache em memória.
-dynamodb = boto3.resource('dynamodb')
-tokens_table = dynamodb.Table(DYNAMODB_TABLE_NAME)
-request_counts = defaultdict(list)
+# PT-BR: Clientes AWS criados só no primeiro uso (diretivas de controle nunca tocam o DynamoDB) e cache em memória.
+_aws_clients = {}
+_aws_clients_lock = threading.Lock()
+# PT-BR: Cache de tokens por user_id mantido entre invocações "quentes", com um lock por usuário para o refresh.
+_token_cache = {}
+_token_refresh_locks = {}
+_token_cache_lock = threading.Lock()
+_default_user_id = ALEXA_USER_ID
+# PT-BR: Cache do índice de roteamento: chave (entity_id ou '*') -> (instante da leitura, conjunto de user_ids).
+_route_cache = {}
+ROUTE_WILDCARD = '*'
+
+def get_aws_resource(service_name):
+	"""
+	Returns a boto3 resource, importing boto3 and creating the resource lazily on first use.
+	PT-BR: Retorna um resource do boto3, importando o boto3 e criando o resource só no primeiro uso.
+	"""
+	with _aws_clients_lock:
+		if (resource := _aws_clients.get(service_name)) is None:
+			import boto3
+			resource = _aws_clients[service_name] = boto3.resource(service_name)
+		return resource
+
+def get_aws_client(service_name):
+	"""
+	Returns a boto3 low-level client, created lazily on first use.
+	PT-BR: Retorna um client de baixo nível do boto3, criado só no primeiro uso.
+	"""
+	with _aws_clients_lock:
+		if (client := _aws_clients.get(f"client:{service_name}")) is None:
+			import boto3
+			client = _aws_clients[f"client:{service_name}"] = boto3.client(service_name)
+		return client
+
+def get_tokens_table():
+	"""
+	Returns the DynamoDB tokens table.
+	PT-BR: Retorna a tabela de tokens do DynamoDB.
+	"""
+	if (table := _aws_clients.get('tokens_table')) is None:
+		table = _aws_clients['tokens_table'] = get_aws_resource('dynamodb').Table(DYNAMODB_TABLE_NAME)
+	return table
 
 
+# ===============================================================================
+# 📈 METRICS AND TRACING (CloudWatch Embedded Metric Format)
+# ===============================================================================
+# PT-BR: Coletor da requisição atual; None quando as métricas estão desativadas.
+_metrics_collector = contextvars.ContextVar('metrics_collector', default=None)
+
+class _NullStageTimer:
+	"""
+	Shared no-op timer returned when metrics are disabled, so instrumentation costs a single lookup.
+	PT-BR: Timer vazio compartilhado usado quando as métricas estão desativadas; a instrumentação custa uma única consulta.
+	"""
+	def __enter__(self): return self
+	def __exit__(self, *exc_info): return False
+	def set_outcome(self, outcome): pass
+
+_NULL_STAGE_TIMER = _NullStageTimer()
+
+class _StageTimer:
+	"""
+	Times one stage and records it on the request collector when the block exits.
+	PT-BR: Mede uma etapa e a registra no coletor da requisição ao final do bloco.
+	"""
+	def __init__(self, collector, stage, dimensions):
+		self.collector, self.stage, self.dimensions, self.outcome = collector, stage, dimensions, None
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		outcome = self.outcome or ('error' if exc_type else 'success')
+		self.collector.record(self.stage, self.start, (time.perf_counter() - self.start) * 1000, {**self.dimensions, "Outcome": outcome})
+		return False
+
+	def set_outcome(self, outcome):
+		self.outcome = outcome
+
+class MetricsCollector:
+	"""
+	Collects stage timings for one request and emits them as CloudWatch EMF lines, plus an
+	optional detailed trace for sampled requests.
+	PT-BR: Coleta os tempos das etapas de uma requisição e os emite como linhas CloudWatch EMF,
+	além de um trace detalhado opcional para requisições amostradas.
+	"""
+	def __init__(self, dimensions, traced):
+		self.dimensions, self.traced = dimensions, traced
+		self.started = time.perf_counter()
+		self.samples, self.values = [], []
+		self._lock = threading.Lock()
+
+	def record(self, stage, start, duration_ms, dimensions):
+		with self._lock:
+			self.samples.append((stage, start, duration_ms, dimensions))
+
+	def record_value(self, name, value, unit, dimensions):
+		with self._lock:
+			self.values.append((name, value, unit, dimensions))
+
+	def flush(self):
+		"""
+		Prints one EMF document per (stage, dimensions) group and the sampled trace, if any.
+		PT-BR: Imprime um documento EMF por grupo (etapa, dimensões) e o trace amostrado, se houver.
+		"""
+		groups = {}
+		for stage, _, duration_ms, dimensions in self.samples:
+			labels = {**self.dimensions, "Stage": stage, **dimensions}
+			groups.setdefault(tuple(sorted(labels.items())), []).append(round(duration_ms, 3))
+		timestamp = int(time.time() * 1000)
+		for labels, durations in groups.items():
+			labels = dict(labels)
+			print(json.dumps({"_aws": {"Timestamp": timestamp, "CloudWatchMetrics": [{"Namespace": METRICS_NAMESPACE, "Dimensions": [list(labels)], "Metrics": [{"Name": "Duration", "Unit": "Milliseconds"}]}]}, **labels, "Duration": durations}), flush=True)
+		for name, value, unit, dimensions in self.values:
+			labels = {**self.dimensions, **dimensions}
+			print(json.dumps({"_aws": {"Timestamp": timestamp, "CloudWatchMetrics": [{"Namespace": METRICS_NAMESPACE, "Dimensions": [list(labels)], "Metrics": [{"Name": name, "Unit": unit}]}]}, **labels, name: value}), flush=True)
+		if self.traced:
+			spans = [{"stage": stage, "offset_ms": round((start - self.started) * 1000, 3), "duration_ms": round(duration_ms, 3), **dimensions} for stage, start, duration_ms, dimensions in sorted(self.samples, key=lambda sample: sample[1])]
+			print(json.dumps({"trace": {**self.dimensions, "spans": spans}}), flush=True)
+
+def timed_stage(stage, **dimensions):
+	"""
+	Returns a context manager that times a stage of the current request, or a shared no-op when metrics are off.
+	PT-BR: Retorna um context manager que mede uma etapa da requisição atual, ou um no-op compartilhado quando as métricas estão desligadas.
+	"""
+	if (collector := _metrics_collector.get()) is None: return _NULL_STAGE_TIMER
+	return _StageTimer(collector, stage, dimensions)
+
+def record_metric(name, value, unit='Count', **dimensions):
+	"""
+	Records a single metric value (e.g. a queue depth) for the current request; no-op when metrics are off.
+	PT-BR: Registra um valor de métrica (ex: profundidade de fila) na requisição atual; no-op com as métricas desligadas.
+	"""
+	if (collector := _metrics_collector.get()) is not None:
+		collector.record_value(name, value, unit, dimensions)
+
+def _ha_endpoint_label(endpoint):
+	"""
+	Reduces an HA API endpoint to a low-cardinality metric label (entity ids are dropped).
+	PT-BR: Reduz um endpoint da API do HA a um rótulo de baixa cardinalidade (entity ids são removidos).
+	"""
+	return "states/{entity_id}" if endpoint.startswith("states/") else endpoint
+
 # ===============================================================================
 # 🛡️ SECURITY MODULE
 # ===============================================================================
@@ -47,34 +258,255 @@ def security_check(headers, source_ip):
 		return False
 	
 	real_ip = headers.get('cf-connecting-ip') or source_ip
-	now = time.time()
-	window, max_requests = 60, 100
-	request_counts[real_ip] = [t for t in request_counts[real_ip] if now - t < window]
-	if len(request_counts[real_ip]) >= max_requests:
+	if not get_rate_limiter().allow(real_ip):
 		logger.warning(f"RATE LIMIT: IP {real_ip} exceeded request limit.")
 		return False
-	request_counts[real_ip].append(now)
 	return True
 
+class LocalRateLimiter:
+	"""
+	In-memory token bucket per key. Each check is O(1) and the key table is bounded: buckets that
+	have been idle for a whole window (i.e. are full again) and the least recently used keys above
+	max_keys are evicted.
+	PT-BR: Token bucket em memória por chave. Cada checagem é O(1) e a tabela de chaves é limitada:
+	buckets ociosos por uma janela inteira (ou seja, cheios de novo) e as chaves menos usadas acima
+	de max_keys são removidos.
+	"""
+	def __init__(self, max_requests, window, max_keys):
+		self.capacity, self.window, self.max_keys = max_requests, window, max_keys
+		self.refill_rate = max_requests / window
+		self._buckets = OrderedDict()
+		self._lock = threading.Lock()
+
+	def allow(self, key):
+		now = time.monotonic()
+		with self._lock:
+			tokens, last_seen = self._buckets.pop(key, (self.capacity, now))
+			tokens = min(self.capacity, tokens + (now - last_seen) * self.refill_rate)
+			if allowed := tokens >= 1: tokens -= 1
+			self._buckets[key] = (tokens, now)
+			while self._buckets:
+				_, (_, oldest_seen) = next(iter(self._buckets.items()))
+				if len(self._buckets) <= self.max_keys and now - oldest_seen < self.window: break
+				self._buckets.popitem(last=False)
+			return allowed
+
+class DynamoDBRateLimiter:
+	"""
+	Fixed-slot counter shared by every concurrent container through atomic ADD updates on the
+	tokens table. Counter items expire through the table's TTL attribute `expires_ttl`.
+	PT-BR: Contador por janela fixa compartilhado por todos os containers via updates atômicos ADD
+	na tabela de tokens. Os itens de contagem expiram pelo atributo TTL `expires_ttl` da tabela.
+	"""
+	def __init__(self, table, max_requests, window):
+		self.table, self.max_requests, self.window = table, max_requests, window
+
+	def allow(self, key):
+		slot = int(time.time()) // self.window
+		try:
+			with timed_stage("DynamoDB", Operation="RateLimit"):
+				self.table.update_item(Key={'user_id': f"ratelimit#{key}#{slot}"}, UpdateExpression='ADD request_count :one SET expires_ttl = :ttl',
+					ConditionExpression='attribute_not_exists(request_count) OR request_count < :max', ExpressionAttributeValues={':one': 1, ':max': self.max_requests, ':ttl': (slot + 2) * self.window})
+			return True
+		except Exception as e:
+			if getattr(e, 'response', {}).get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+				return False
+			# PT-BR: Falha aberta: um problema no DynamoDB não deve bloquear as atualizações de estado.
+			logger.exception("Exception in DynamoDBRateLimiter, allowing request")
+			return True
+
+_rate_limiter = None
+
+def get_rate_limiter():
+	"""
+	Returns the container-wide rate limiter selected by RATE_LIMIT_BACKEND.
+	PT-BR: Retorna o rate limiter do container selecionado por RATE_LIMIT_BACKEND.
+	"""
+	global _rate_limiter
+	if _rate_limiter is None:
+		if RATE_LIMIT_BACKEND == 'dynamodb':
+			_rate_limiter = DynamoDBRateLimiter(get_tokens_table(), RATE_LIMIT_MAX_REQUESTS, RATE_LIMIT_WINDOW)
+		else:
+			_rate_limiter = LocalRateLimiter(RATE_LIMIT_MAX_REQUESTS, RATE_LIMIT_WINDOW, RATE_LIMIT_MAX_KEYS)
+	return _rate_limiter
+
+# ===============================================================================
+# TOKEN STORAGE (DYNAMODB OR SQLITE)
+# ===============================================================================
+class DynamoDBTokenStore:
+	"""
+	Items of the DynamoDB tokens table, keyed by user_id: user tokens, the routing index ('route#...')
+	and the discovery baseline ('discovery#index').
+	PT-BR: Itens da tabela de tokens do DynamoDB, com chave user_id: tokens dos usuários, o índice de
+	roteamento ('route#...') e a referência da descoberta ('discovery#index').
+	"""
+	def get(self, key, consistent=False):
+		with timed_stage("DynamoDB", Operation="GetItem"):
+			return get_tokens_table().get_item(Key={'user_id': key}, ConsistentRead=consistent).get('Item')
+
+	def batch_get(self, keys, consistent=False):
+		# PT-BR: BatchGetItem aceita 100 chaves por chamada; chaves não processadas são repetidas.
+		items, dynamodb = [], get_aws_resource('dynamodb')
+		keys = [{'user_id': key} for key in keys]
+		for offset in range(0, len(keys), 100):
+			request = {DYNAMODB_TABLE_NAME: {'Keys': keys[offset:offset + 100], 'ConsistentRead': consistent}}
+			while request:
+				with timed_stage("DynamoDB", Operation="BatchGetItem"):
+					response = dynamodb.batch_get_item(RequestItems=request)
+				items.extend(response.get('Responses', {}).get(DYNAMODB_TABLE_NAME, []))
+				if request := response.get('UnprocessedKeys'): time.sleep(0.05)
+		return items
+
+	def put(self, item):
+		with timed_stage("DynamoDB", Operation="PutItem"):
+			get_tokens_table().put_item(Item=item)
+
+	def update_tokens(self, user_id, access_token, refresh_token, expires_at):
+		with timed_stage("DynamoDB", Operation="UpdateItem"):
+			get_tokens_table().update_item(Key={'user_id': user_id}, UpdateExpression='SET access_token = :at, refresh_token = :rt, expires_at = :ea, updated_at = :ua',
+				ExpressionAttributeValues={':at': access_token, ':rt': refresh_token, ':ea': expires_at, ':ua': int(time.time())})
+
+	def add_user(self, key, user_id):
+		with timed_stage("DynamoDB", Operation="UpdateItem"):
+			get_tokens_table().update_item(Key={'user_id': key}, UpdateExpression='ADD #users :user', ExpressionAttributeNames={'#users': 'users'}, ExpressionAttributeValues={':user': {user_id}})
+
+	def seed_users(self, key, user_ids):
+		# PT-BR: ADD não aceita conjunto vazio; sem usuários o item só é marcado como semeado.
+		kwargs = {'UpdateExpression': 'SET seeded_at = :now', 'ExpressionAttributeValues': {':now': int(time.time())}}
+		if user_ids:
+			kwargs = {'UpdateExpression': 'ADD #users :user SET seeded_at = :now', 'ExpressionAttributeNames': {'#users': 'users'}, 'ExpressionAttributeValues': {':user': set(user_ids), ':now': int(time.time())}}
+		with timed_stage("DynamoDB", Operation="UpdateItem"):
+			get_tokens_table().update_item(Key={'user_id': key}, **kwargs)
+
+	def scan(self, attribute, projection):
+		"""
+		Yields the items that have the attribute, one page at a time, so callers can stop early.
+		PT-BR: Devolve os itens que têm o atributo, uma página por vez, para que quem chama possa parar antes.
+		"""
+		scan_kwargs = {'ProjectionExpression': ', '.join(projection), 'FilterExpression': f'attribute_exists({attribute})'}
+		while True:
+			with timed_stage("DynamoDB", Operation="Scan"):
+				response = get_tokens_table().scan(**scan_kwargs)
+			yield from response.get('Items', [])
+			if 'LastEvaluatedKey' not in response: return
+			scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def _encode_item_value(value):
+	# PT-BR: JSON não tem conjuntos; o conjunto de usuários do índice de roteamento é gravado como {"$set": [...]}.
+	if isinstance(value, (set, frozenset)): return {"$set": sorted(value)}
+	raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _decode_item_value(value):
+	return set(value["$set"]) if value.keys() == {"$set"} else value
+
+class SQLiteTokenStore:
+	"""
+	The same items in an embedded SQLite file (WAL mode) for self-hosted and offline deployments.
+	Reads are served from an in-memory copy for up to TOKEN_STORE_CACHE_TTL seconds and writes go
+	through to the file. Consistent reads skip the copy, so processes sharing the file (e.g. bridge
+	and server) see each other's token refreshes.
+	PT-BR: Os mesmos itens num arquivo SQLite embutido (modo WAL), para instalações próprias e testes
+	offline. Leituras são servidas de uma cópia em memória por até TOKEN_STORE_CACHE_TTL segundos e as
+	escritas vão direto para o arquivo. Leituras consistentes ignoram a cópia, então processos que
+	compartilham o arquivo (ex: bridge e servidor) enxergam os refreshes de token uns dos outros.
+	"""
+	def __init__(self, path):
+		self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+		self._conn.execute('PRAGMA journal_mode=WAL')
+		self._conn.execute('PRAGMA synchronous=NORMAL')
+		self._conn.execute('CREATE TABLE IF NOT EXISTS token_items (user_id TEXT PRIMARY KEY, item TEXT NOT NULL)')
+		self._cache = {}
+		self._lock = threading.Lock()
+
+	def get(self, key, consistent=False):
+		return next(iter(self.batch_get([key], consistent)), None)
+
+	def batch_get(self, keys, consistent=False):
+		now = time.monotonic()
+		with self._lock:
+			stale = [key for key in dict.fromkeys(keys) if consistent or (entry := self._cache.get(key)) is None or now - entry[0] >= TOKEN_STORE_CACHE_TTL]
+			# PT-BR: Blocos de 500 chaves ficam abaixo do limite de parâmetros por consulta do SQLite.
+			for offset in range(0, len(stale), 500):
+				chunk = stale[offset:offset + 500]
+				found = dict(self._conn.execute(f"SELECT user_id, item FROM token_items WHERE user_id IN ({', '.join('?' * len(chunk))})", chunk).fetchall())
+				for key in chunk: self._cache[key] = (now, json.loads(found[key], object_hook=_decode_item_value) if key in found else None)
+			return [dict(item) for key in keys if (item := self._cache[key][1]) is not None]
+
+	def _write(self, key, change):
+		"""
+		Applies change(current item) inside an immediate transaction and keeps the result in the in-memory copy.
+		PT-BR: Aplica change(item atual) dentro de uma transação imediata e guarda o resultado na cópia em memória.
+		"""
+		with self._lock:
+			self._conn.execute('BEGIN IMMEDIATE')
+			try:
+				row = self._conn.execute('SELECT item FROM token_items WHERE user_id = ?', (key,)).fetchone()
+				item = change(json.loads(row[0], object_hook=_decode_item_value) if row else {'user_id': key})
+				self._conn.execute('INSERT OR REPLACE INTO token_items (user_id, item) VALUES (?, ?)', (key, json.dumps(item, default=_encode_item_value)))
+				self._conn.execute('COMMIT')
+			except BaseException:
+				self._conn.execute('ROLLBACK')
+				raise
+			self._cache[key] = (time.monotonic(), item)
+
+	def put(self, item):
+		self._write(item['user_id'], lambda current: dict(item))
+
+	def update_tokens(self, user_id, access_token, refresh_token, expires_at):
+		self._write(user_id, lambda current: {**current, 'access_token': access_token, 'refresh_token': refresh_token, 'expires_at': expires_at, 'updated_at': int(time.time())})
+
+	def add_user(self, key, user_id):
+		self._write(key, lambda current: {**current, 'users': set(current.get('users', ())) | {user_id}})
+
+	def seed_users(self, key, user_ids):
+		self._write(key, lambda current: {**current, 'users': set(current.get('users', ())) | set(user_ids), 'seeded_at': int(time.time())})
+
+	def scan(self, attribute, projection):
+		with self._lock:
+			rows = self._conn.execute('SELECT item FROM token_items').fetchall()
+		for (raw,) in rows:
+			if attribute in (item := json.loads(raw, object_hook=_decode_item_value)):
+				yield {name: item[name] for name in projection if name in item}
+
+_token_store = None
+_token_store_lock = threading.Lock()
+
+def get_token_store():
+	"""
+	Returns the token store selected by TOKEN_STORE_BACKEND.
+	PT-BR: Retorna o armazenamento de tokens selecionado por TOKEN_STORE_BACKEND.
+	"""
+	global _token_store
+	with _token_store_lock:
+		if _token_store is None:
+			_token_store = SQLiteTokenStore(TOKEN_STORE_PATH) if TOKEN_STORE_BACKEND == 'sqlite' else DynamoDBTokenStore()
+		return _token_store
+
 # ===============================================================================
-# TOKEN MANAGEMENT (DYNAMODB)
+# TOKEN MANAGEMENT
 # ===============================================================================
+def _request_lwa_token(payload):
+	"""
+	Posts a grant to the Login with Amazon token endpoint over a pooled connection and returns the decoded JSON.
+	PT-BR: Envia um grant para o endpoint de token do Login with Amazon por uma conexão do pool e retorna o JSON.
+	"""
+	data = urllib.parse.urlencode(payload).encode('utf-8')
+	with timed_stage("LoginWithAmazon", GrantType=payload.get("grant_type")) as timer:
+		status, _, body = get_connection_pool(LWA_TOKEN_URL).request('POST', urllib.parse.urlsplit(LWA_TOKEN_URL).path, body=data, headers={"Content-Type": "application/x-www-form-urlencoded"}, timeout=10)
+		if status >= 300: timer.set_outcome(f"http_{status}")
+	return json.loads(body)
+
 def exchange_code_for_tokens(code):
 	"""
 	Exchanges an Alexa authorization code for access and refresh tokens.
 	PT-BR: Troca um código de autorização da Alexa por tokens de acesso e de atualização.
 	"""
 	try:
-		url = "https://api.amazon.com/auth/o2/token"
-		payload = {"grant_type": "authorization_code", "code": code, "client_id": ALEXA_CLIENT_ID, "client_secret": ALEXA_CLIENT_SECRET}
-		data = urllib.parse.urlencode(payload).encode('utf-8')
-		req = urllib.request.Request(url, data=data, method='POST', headers={"Content-Type": "application/x-www-form-urlencoded"})
-		with urllib.request.urlopen(req, timeout=10) as resp:
-			token_data = json.loads(resp.read())
-			if 'access_token' not in token_data:
-				logger.error(f"Failed to exchange code, 'access_token' not in response: {token_data}")
-				return None
-			return {'access_token': token_data['access_token'], 'refresh_token': token_data.get('refresh_token'), 'expires_at': int(time.time()) + 3600}
+		token_data = _request_lwa_token({"grant_type": "authorization_code", "code": code, "client_id": ALEXA_CLIENT_ID, "client_secret": ALEXA_CLIENT_SECRET})
+		if 'access_token' not in token_data:
+			logger.error(f"Failed to exchange code, 'access_token' not in response: {token_data}")
+			return None
+		return {'access_token': token_data['access_token'], 'refresh_token': token_data.get('refresh_token'), 'expires_at': int(time.time()) + 3600}
 	except Exception:
 		logger.exception("Exception in exchange_code_for_tokens")
 		return None
@@ -88,42 +520,399 @@ def refresh_user_token(user_id, refresh_token):
 		logger.warning(f"Refresh token not available for user {user_id}.")
 		return None
 	try:
-		url = "https://api.amazon.com/auth/o2/token"
-		payload = {"grant_type": "refresh_token", "refresh_token": refresh_token, "client_id": ALEXA_CLIENT_ID, "client_secret": ALEXA_CLIENT_SECRET}
-		data = urllib.parse.urlencode(payload).encode('utf-8')
-		req = urllib.request.Request(url, data=data, method='POST', headers={"Content-Type": "application/x-www-form-urlencoded"})
-		with urllib.request.urlopen(req, timeout=10) as resp:
-			token_data = json.loads(resp.read())
-			if 'access_token' not in token_data:
-				logger.error(f"Failed to refresh token, 'access_token' not in response: {token_data}")
-				return None
-			new_tokens = {':at': token_data['access_token'], ':rt': token_data.get('refresh_token', refresh_token), ':ea': int(time.time()) + 3600, ':ua': int(time.time())}
-			tokens_table.update_item(Key={'user_id': user_id}, UpdateExpression='SET access_token = :at, refresh_token = :rt, expires_at = :ea, updated_at = :ua', ExpressionAttributeValues=new_tokens)
-			logger.info(f"Successfully refreshed token for user {user_id}")
-			return new_tokens[':at']
+		token_data = _request_lwa_token({"grant_type": "refresh_token", "refresh_token": refresh_token, "client_id": ALEXA_CLIENT_ID, "client_secret": ALEXA_CLIENT_SECRET})
+		if 'access_token' not in token_data:
+			logger.error(f"Failed to refresh token, 'access_token' not in response: {token_data}")
+			return None
+		new_tokens = {'access_token': token_data['access_token'], 'refresh_token': token_data.get('refresh_token', refresh_token), 'expires_at': int(time.time()) + 3600}
+		get_token_store().update_tokens(user_id, **new_tokens)
+		_token_cache[user_id] = {'user_id': user_id, **new_tokens}
+		logger.info(f"Successfully refreshed token for user {user_id}")
+		return new_tokens['access_token']
 	except Exception:
 		logger.exception(f"Exception in refresh_user_token for user {user_id}")
 		return None
 
-def get_user_access_token():
+def _token_is_valid(user_data):
+	"""
+	Checks whether a cached token item is still valid, keeping a 5 minute safety buffer.
+	PT-BR: Verifica se um token em cache ainda é válido, mantendo uma margem de 5 minutos.
+	"""
+	return bool(user_data) and int(time.time()) < user_data.get('expires_at', 0) - 300 # 5 min buffer
+
+def _get_token_refresh_lock(user_id):
+	"""
+	Returns the per-user lock that collapses concurrent refreshes into a single request.
+	PT-BR: Retorna o lock por usuário que agrupa refreshes concorrentes em uma única requisição.
+	"""
+	with _token_cache_lock:
+		return _token_refresh_locks.setdefault(user_id, threading.Lock())
+
+def _resolve_default_user_id():
 	"""
-	Gets a valid user access token from DynamoDB, refreshing if necessary.
-	PT-BR: Obtém um token de usuário válido do DynamoDB, atualizando se necessário.
+	Returns the linked user_id, scanning the token store only once per container when ALEXA_USER_ID is not set.
+	PT-BR: Retorna o user_id vinculado, fazendo scan no armazenamento de tokens só uma vez por container quando ALEXA_USER_ID não está definido.
+	"""
+	global _default_user_id
+	# PT-BR: A tabela também guarda contadores de rate limit; pagina até achar um item de token.
+	if not _default_user_id and (item := next(get_token_store().scan('access_token', ['user_id']), None)):
+		_default_user_id = item['user_id']
+	return _default_user_id
+
+def get_user_access_token(user_id=None):
+	"""
+	Gets a valid user access token, served from the warm-container cache and refreshed (once per
+	user, even under concurrency) when it is close to expiring.
+	PT-BR: Obtém um token de usuário válido, servido do cache do container e atualizado (uma vez
+	por usuário, mesmo com concorrência) quando está perto de expirar.
+	"""
+	with timed_stage("AccessToken") as timer:
+		if not (token := _get_user_access_token(user_id)): timer.set_outcome("unavailable")
+		return token
+
+def _get_user_access_token(user_id):
+	"""
+	Token lookup behind get_user_access_token, kept separate so the whole lookup is timed as one stage.
+	PT-BR: Busca do token por trás de get_user_access_token, separada para que toda a busca seja medida como uma etapa.
 	"""
 	try:
-		response = tokens_table.scan(Limit=1)
-		if not (items := response.get('Items')):
-			logger.warning("No user tokens found in DynamoDB.")
+		if not (user_id := user_id or _resolve_default_user_id()):
+			logger.warning("No user tokens found in the token store.")
 			return None
-		user_data = items[0]
-		if int(time.time()) < user_data.get('expires_at', 0) - 300: # 5 min buffer
+		if _token_is_valid(user_data := _token_cache.get(user_id)):
 			return user_data['access_token']
-		logger.info(f"User token for {user_data.get('user_id')} expired, refreshing...")
-		return refresh_user_token(user_data.get('user_id'), user_data.get('refresh_token'))
+		with _get_token_refresh_lock(user_id):
+			# PT-BR: Outra thread pode ter atualizado o token enquanto esperávamos o lock.
+			if _token_is_valid(user_data := _token_cache.get(user_id)):
+				return user_data['access_token']
+			# PT-BR: Leitura consistente por chave: outro container pode já ter feito o refresh.
+			if not (user_data := get_token_store().get(user_id, consistent=True)):
+				logger.warning(f"No tokens found for user {user_id}.")
+				return None
+			if _token_is_valid(user_data):
+				_token_cache[user_id] = user_data
+				return user_data['access_token']
+			logger.info(f"User token for {user_id} expired, refreshing...")
+			return refresh_user_token(user_id, user_data.get('refresh_token'))
 	except Exception:
 		logger.exception("Exception in get_user_access_token")
 		return None
 
+def get_user_access_tokens(user_ids):
+	"""
+	Returns {user_id: access_token} for many linked users: cached tokens are reused, the rest are
+	read in one batch and only expired ones go through the single-flight refresh.
+	PT-BR: Retorna {user_id: access_token} para vários usuários: tokens em cache são reaproveitados,
+	o restante é lido num único lote e só os expirados passam pelo refresh único.
+	"""
+	tokens, missing = {}, []
+	for user_id in user_ids:
+		if _token_is_valid(user_data := _token_cache.get(user_id)): tokens[user_id] = user_data['access_token']
+		else: missing.append(user_id)
+	if missing:
+		try:
+			for item in get_token_store().batch_get(missing, consistent=True):
+				if _token_is_valid(item): _token_cache[item['user_id']] = item
+		except Exception:
+			logger.exception("Exception batch-reading user tokens")
+		for user_id in missing:
+			if token := get_user_access_token(user_id): tokens[user_id] = token
+	return tokens
+
+def _refresh_expiring_token(item, deadline):
+	"""
+	Refreshes one token from the scheduled sweep, unless another thread already did.
+	PT-BR: Renova um token da varredura agendada, a menos que outra thread já o tenha feito.
+	"""
+	with _get_token_refresh_lock(item['user_id']):
+		if (cached := _token_cache.get(item['user_id'])) and cached.get('expires_at', 0) > deadline: return True
+		return refresh_user_token(item['user_id'], item.get('refresh_token')) is not None
+
+def refresh_expiring_tokens():
+	"""
+	Refreshes every linked user's token that expires within TOKEN_REFRESH_AHEAD seconds, so webhooks
+	and directives only ever read a valid token. Returns counters for the sweep.
+	PT-BR: Renova o token de todo usuário vinculado que expira em até TOKEN_REFRESH_AHEAD segundos, para
+	que webhooks e diretivas só leiam tokens válidos. Retorna contadores da varredura.
+	"""
+	deadline = int(time.time()) + TOKEN_REFRESH_AHEAD
+	linked_users, expiring = 0, []
+	for item in get_token_store().scan('refresh_token', ['user_id', 'refresh_token', 'expires_at']):
+		linked_users += 1
+		if item.get('expires_at', 0) <= deadline: expiring.append(item)
+
+	# PT-BR: O atraso aleatório é aplicado na submissão, não dentro do worker: nenhuma vaga fica ocupada
+	# dormindo e o escalonamento inteiro cabe em TOKEN_REFRESH_JITTER segundos.
+	start = time.monotonic()
+	offsets = sorted(random.uniform(0, TOKEN_REFRESH_JITTER) for _ in expiring)
+	with ThreadPoolExecutor(max_workers=max(1, TOKEN_REFRESH_CONCURRENCY), thread_name_prefix='token-refresh') as executor:
+		futures = []
+		for offset, item in zip(offsets, expiring):
+			if (delay := start + offset - time.monotonic()) > 0: time.sleep(delay)
+			futures.append(executor.submit(contextvars.copy_context().run, _refresh_expiring_token, item, deadline))
+		refreshed = sum(1 for future in futures if future.result())
+	record_metric("TokensRefreshed", refreshed)
+	record_metric("TokenRefreshFailures", len(expiring) - refreshed)
+	return {"linked_users": linked_users, "expiring": len(expiring), "refreshed": refreshed, "failed": len(expiring) - refreshed}
+
+def _route_key(entity_id):
+	return f"route#{entity_id}"
+
+def get_entity_users(entity_ids):
+	"""
+	Returns {entity_id: set of user_ids} from the routing index stored in the tokens table: an item
+	'route#<entity_id>' lists the only users of that entity, and entities without one go to the
+	users in 'route#*'.
+	PT-BR: Retorna {entity_id: conjunto de user_ids} a partir do índice de roteamento na tabela de
+	tokens: um item 'route#<entity_id>' lista os únicos usuários daquela entidade, e entidades sem
+	item vão para os usuários de 'route#*'.
+	"""
+	now = time.monotonic()
+	stale = [key for key in {*entity_ids, ROUTE_WILDCARD} if (entry := _route_cache.get(key)) is None or now - entry[0] >= ROUTE_INDEX_TTL]
+	if stale:
+		found = {item['user_id'][len(_route_key('')):]: item for item in get_token_store().batch_get([_route_key(key) for key in stale])}
+		if ROUTE_WILDCARD in stale and 'seeded_at' not in found.get(ROUTE_WILDCARD, {}):
+			found[ROUTE_WILDCARD] = _seed_wildcard_route()
+		# PT-BR: None marca entidade sem item próprio, que segue o 'route#*'.
+		for key in stale: _route_cache[key] = (now, set(found[key].get('users', ())) if key in found else None)
+	wildcard_users = _route_cache[ROUTE_WILDCARD][1] or set()
+	return {entity_id: wildcard_users if (users := _route_cache[entity_id][1]) is None else users for entity_id in entity_ids}
+
+def _seed_wildcard_route():
+	"""
+	Adds every user that already has a token item to 'route#*' (once, marked by 'seeded_at'), so
+	accounts linked before the routing index keep receiving ChangeReports. Returns the updated item.
+	PT-BR: Adiciona ao 'route#*' todo usuário que já tem item de token (uma vez, marcado por
+	'seeded_at'), para que contas vinculadas antes do índice de roteamento continuem recebendo
+	ChangeReports. Retorna o item atualizado.
+	"""
+	store = get_token_store()
+	user_ids = {item['user_id'] for item in store.scan('access_token', ['user_id'])}
+	store.seed_users(_route_key(ROUTE_WILDCARD), user_ids)
+	logger.info(f"Routing index seeded with {len(user_ids)} linked users.")
+	return store.get(_route_key(ROUTE_WILDCARD), consistent=True) or {}
+
+def link_user_entities(user_id, entity_ids=None):
+	"""
+	Adds a user to the routing index for the given entities, or for every entity when none are given.
+	PT-BR: Adiciona um usuário ao índice de roteamento das entidades informadas, ou de todas quando nenhuma é informada.
+	"""
+	for key in entity_ids or [ROUTE_WILDCARD]:
+		get_token_store().add_user(_route_key(key), user_id)
+		_route_cache.pop(key, None)
+
+# ===============================================================================
+# HTTP CONNECTION POOLING
+# ===============================================================================
+class ConnectionPoolExhausted(Exception):
+	"""
+	Raised when every connection slot of a pool stays busy past the request timeout. It is a local
+	capacity limit, not a failure of the remote host, so it is deliberately not an OSError.
+	PT-BR: Lançada quando todas as vagas de conexão de um pool continuam ocupadas além do timeout da
+	requisição. É um limite local de capacidade, não uma falha do host remoto, por isso não é um OSError.
+	"""
+
+class ConnectionPool:
+	"""
+	Thread-safe pool of keep-alive HTTP/1.1 connections to a single host (scheme, host, port).
+	Pools live at module scope so their sockets are reused across warm Lambda invocations, and
+	each pool caps how many connections it opens to its host.
+	PT-BR: Pool thread-safe de conexões HTTP/1.1 keep-alive para um único host (esquema, host, porta).
+	Os pools ficam no escopo do módulo para que os sockets sejam reutilizados entre invocações
+	"quentes" da Lambda, e cada pool limita quantas conexões abre para o seu host.
+	"""
+	# PT-BR: Erros que indicam que o servidor fechou um socket ocioso; a requisição é repetida numa conexão nova.
+	STALE_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionResetError, BrokenPipeError)
+
+	def __init__(self, scheme, host, port, max_connections, idle_timeout):
+		self.scheme, self.host, self.port = scheme, host, port
+		self.idle_timeout = idle_timeout
+		self._idle = deque()
+		self._lock = threading.Lock()
+		self._slots = threading.BoundedSemaphore(max_connections)
+
+	def _connect(self, timeout):
+		connection_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+		return connection_class(self.host, self.port, timeout=timeout)
+
+	def _checkout(self, timeout):
+		now = time.monotonic()
+		with self._lock:
+			while self._idle:
+				conn, last_used = self._idle.pop()
+				# PT-BR: Sockets ociosos por muito tempo (ex: Lambda congelada) provavelmente já foram fechados pelo servidor.
+				if now - last_used > self.idle_timeout:
+					conn.close()
+					continue
+				if conn.sock: conn.sock.settimeout(timeout)
+				return conn, True
+		return self._connect(timeout), False
+
+	def _checkin(self, conn):
+		with self._lock:
+			self._idle.append((conn, time.monotonic()))
+
+	def _open(self, method, path, body, headers, timeout):
+		# PT-BR: Um socket reutilizado que o servidor já fechou é tentado novamente uma vez numa conexão nova.
+		for attempt in range(2):
+			conn, reused = self._checkout(timeout)
+			try:
+				conn.request(method, path, body=body, headers=headers or {})
+				return conn, conn.getresponse()
+			except self.STALE_ERRORS:
+				conn.close()
+				if reused and attempt == 0: continue
+				raise
+			except Exception:
+				conn.close()
+				raise
+
+	def request(self, method, path, body=None, headers=None, timeout=10):
+		"""
+		Sends a request and returns (status, headers, body). A reused socket that the server already
+		closed is retried once on a fresh connection.
+		PT-BR: Envia uma requisição e retorna (status, headers, body). Um socket reutilizado que o
+		servidor já fechou é tentado novamente uma vez numa conexão nova.
+		"""
+		with self.stream(method, path, body, headers, timeout) as (status, response_headers, resp):
+			return status, response_headers, resp.read()
+
+	@contextlib.contextmanager
+	def stream(self, method, path, body=None, headers=None, timeout=10):
+		"""
+		Like request(), but yields (status, headers, response) so the body can be read incrementally.
+		The connection goes back to the pool only when the block ends normally; on an exception it is closed.
+		PT-BR: Como request(), mas entrega (status, headers, response) para o corpo ser lido aos poucos.
+		A conexão só volta ao pool quando o bloco termina normalmente; numa exceção ela é fechada.
+		"""
+		if not self._slots.acquire(timeout=timeout):
+			raise ConnectionPoolExhausted(f"Connection limit reached for {self.host}")
+		try:
+			conn, resp = self._open(method, path, body, headers, timeout)
+			try:
+				yield resp.status, {k.lower(): v for k, v in resp.getheaders()}, resp
+				# PT-BR: Consome o que sobrou do corpo (normalmente nada) para a conexão poder ser reutilizada.
+				resp.read()
+			except BaseException:
+				conn.close()
+				raise
+			if resp.will_close: conn.close()
+			else: self._checkin(conn)
+		finally:
+			self._slots.release()
+
+	def close(self):
+		"""
+		Closes every idle connection in the pool.
+		PT-BR: Fecha todas as conexões ociosas do pool.
+		"""
+		with self._lock:
+			while self._idle: self._idle.pop()[0].close()
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+_gateway_executor = None
+
+def get_connection_pool(url):
+	"""
+	Returns the shared connection pool for the host of a URL, creating it on first use.
+	PT-BR: Retorna o pool de conexões compartilhado para o host de uma URL, criando-o no primeiro uso.
+	"""
+	parts = urllib.parse.urlsplit(url)
+	key = (parts.scheme or 'https', parts.hostname, parts.port)
+	with _connection_pools_lock:
+		if (pool := _connection_pools.get(key)) is None:
+			pool = _connection_pools[key] = ConnectionPool(*key, max_connections=HTTP_MAX_CONNECTIONS_PER_HOST, idle_timeout=HTTP_IDLE_TIMEOUT)
+		return pool
+
+def _get_gateway_executor():
+	"""
+	Returns the bounded worker pool used to fan out Alexa Gateway deliveries.
+	PT-BR: Retorna o pool limitado de workers usado para enviar eventos ao Alexa Gateway em paralelo.
+	"""
+	global _gateway_executor
+	with _connection_pools_lock:
+		if _gateway_executor is None:
+			_gateway_executor = ThreadPoolExecutor(max_workers=GATEWAY_MAX_WORKERS, thread_name_prefix='alexa-gateway')
+		return _gateway_executor
+
+# ===============================================================================
+# ⚡ CIRCUIT BREAKER (unreachable Home Assistant)
+# ===============================================================================
+class CircuitBreaker:
+	"""
+	Container-wide circuit breaker. It opens after `failure_threshold` consecutive connection
+	failures and rejects calls for `cooldown` seconds; then a single trial request is let through
+	and its outcome closes the circuit or opens it again.
+	PT-BR: Circuit breaker compartilhado no container. Abre após `failure_threshold` falhas de
+	conexão seguidas e rejeita chamadas por `cooldown` segundos; depois deixa passar uma única
+	requisição de teste, cujo resultado fecha o circuito ou o abre de novo.
+	"""
+	CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+	# PT-BR: Respostas do túnel/proxy (ex: Cloudflare) quando o HA atrás dele não responde.
+	UNREACHABLE_STATUSES = (502, 503, 504, 530)
+
+	def __init__(self, name, failure_threshold, cooldown):
+		self.name, self.failure_threshold, self.cooldown = name, failure_threshold, cooldown
+		self.state = self.CLOSED
+		self._failures, self._changed_at = 0, time.monotonic()
+		self._lock = threading.Lock()
+		self.stats = {"opened": 0, "rejected": 0}
+
+	def _set_state(self, state):
+		if state != self.state:
+			logger.warning(f"{self.name} circuit {self.state} -> {state}.")
+			record_metric(f"{self.name}CircuitTransition", 1, To=state)
+			if state == self.OPEN: self.stats["opened"] += 1
+		self.state, self._changed_at = state, time.monotonic()
+
+	def rejecting(self):
+		"""
+		Tells, without changing state, whether a call would be rejected right now (counted as a rejection).
+		PT-BR: Indica, sem mudar o estado, se uma chamada seria rejeitada agora (contada como rejeição).
+		"""
+		with self._lock:
+			if not (rejected := self.state != self.CLOSED and time.monotonic() - self._changed_at < self.cooldown): return False
+			self.stats["rejected"] += 1
+		record_metric(f"{self.name}CircuitRejected", 1)
+		return rejected
+
+	def allow(self):
+		"""
+		Returns True when a call may proceed. After the cooldown only one trial call passes at a time;
+		a trial that never reported back is replaced after another cooldown.
+		PT-BR: Retorna True quando a chamada pode seguir. Depois da espera só uma chamada de teste passa
+		por vez; um teste que nunca retornou é substituído após outra espera.
+		"""
+		with self._lock:
+			if self.state == self.CLOSED: return True
+			if time.monotonic() - self._changed_at >= self.cooldown:
+				self._set_state(self.HALF_OPEN)
+				return True
+			self.stats["rejected"] += 1
+		record_metric(f"{self.name}CircuitRejected", 1)
+		return False
+
+	def record_success(self):
+		with self._lock:
+			self._failures = 0
+			if self.state != self.CLOSED: self._set_state(self.CLOSED)
+
+	def record_failure(self):
+		with self._lock:
+			self._failures += 1
+			if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold: self._set_state(self.OPEN)
+
+	def record_status(self, status):
+		if status in self.UNREACHABLE_STATUSES: self.record_failure()
+		else: self.record_success()
+
+	def snapshot(self):
+		with self._lock:
+			return {"state": self.state, "consecutive_failures": self._failures, **self.stats}
+
+ha_circuit = CircuitBreaker("HomeAssistant", HA_CIRCUIT_FAILURE_THRESHOLD, HA_CIRCUIT_COOLDOWN)
+
 # ===============================================================================
 # CENTRALIZED API CALLER
 # ===============================================================================
@@ -132,21 +921,377 @@ def _call_ha_api(endpoint, method='GET', json_payload=None):
 	Centralized function to make API calls to Home Assistant.
 	PT-BR: Função centralizada para fazer chamadas à API do Home Assistant.
 	"""
+	if not ha_circuit.allow():
+		logger.warning(f"Home Assistant circuit is open, skipping '{endpoint}'.")
+		return None
 	try:
-		url = f'{HA_URL}/api/{endpoint}'
+		path = f"{urllib.parse.urlsplit(HA_URL).path.rstrip('/')}/api/{endpoint}"
 		data = json.dumps(json_payload).encode('utf-8') if json_payload else None
-		req = urllib.request.Request(url, data=data, method=method, headers={'Authorization': f'Bearer {HA_TOKEN}', 'Content-Type': 'application/json'})
-		with urllib.request.urlopen(req, timeout=7) as resp:
-			if resp.status >= 300:
-				logger.error(f"Home Assistant API returned status {resp.status} for {endpoint}")
-				return None
-			if resp.status == 204: # No Content
-				return {} # Success with no data to return
-			return json.loads(resp.read().decode('utf-8'))
+		with timed_stage("HomeAssistant", Endpoint=_ha_endpoint_label(endpoint)) as timer:
+			try:
+				status, _, body = get_connection_pool(HA_URL).request(method, path, body=data, headers={'Authorization': f'Bearer {HA_TOKEN}', 'Content-Type': 'application/json'}, timeout=7)
+			except (OSError, http.client.HTTPException):
+				# PT-BR: ConnectionPoolExhausted (pool local cheio) não chega aqui e não conta para o circuito.
+				ha_circuit.record_failure()
+				raise
+			ha_circuit.record_status(status)
+			if status >= 300: timer.set_outcome(f"http_{status}")
+		if status >= 300:
+			logger.error(f"Home Assistant API returned status {status} for {endpoint}")
+			return None
+		if status == 204 or not body: # No Content
+			return {} # Success with no data to return
+		return json.loads(body.decode('utf-8'))
 	except Exception:
 		logger.exception(f"Exception calling Home Assistant API endpoint '{endpoint}'")
 		return None
 
+# PT-BR: Template renderizado pelo próprio HA que devolve só os estados pedidos (por domínio e tag, ou por entity_id), um por linha (NDJSON).
+STATES_TEMPLATE = "{% for s in states if s.entity_id in members or (s.domain in domains and (not tag or s.attributes.get(tag))) %}{{ {'entity_id': s.entity_id, 'state': s.state, 'attributes': dict(s.attributes)} | to_json }}\n{% endfor %}"
+
+def stream_template_states(domains=(), tag=None, members=()):
+	"""
+	Yields the HA states selected server-side by STATES_TEMPLATE (entities of the given domains, with
+	the tag when set, plus the listed members), parsed line by line as they arrive.
+	PT-BR: Entrega os estados do HA selecionados no próprio HA pelo STATES_TEMPLATE (entidades dos
+	domínios informados, com a tag quando definida, mais os membros listados), lidos linha a linha.
+	"""
+	if not ha_circuit.allow(): raise ConnectionError("Home Assistant circuit is open")
+	data = json.dumps({"template": STATES_TEMPLATE, "variables": {"domains": list(domains), "tag": tag or "", "members": list(members)}}).encode('utf-8')
+	responded = False
+	with timed_stage("HomeAssistant", Endpoint="template") as timer:
+		try:
+			with get_connection_pool(HA_URL).stream('POST', f"{urllib.parse.urlsplit(HA_URL).path.rstrip('/')}/api/template", body=data, headers={'Authorization': f'Bearer {HA_TOKEN}', 'Content-Type': 'application/json'}, timeout=7) as (status, _, response):
+				responded = True
+				ha_circuit.record_status(status)
+				if status != 200:
+					timer.set_outcome(f"http_{status}")
+					raise ConnectionError(f"Home Assistant template API returned status {status}")
+				for line in response:
+					if line.strip(): yield json.loads(line)
+		except (OSError, http.client.HTTPException):
+			# PT-BR: Só falhas antes da resposta contam para o circuito; o status HTTP já foi registrado.
+			if not responded: ha_circuit.record_failure()
+			raise
+
+def fetch_entity_states(entity_ids):
+	"""
+	Reads several entities from HA in a single request, returning {entity_id: state}.
+	PT-BR: Lê várias entidades do HA numa única requisição, retornando {entity_id: estado}.
+	"""
+	try:
+		return {state['entity_id']: state for state in stream_template_states(members=entity_ids)}
+	except Exception:
+		logger.exception("Template state read failed, falling back to /api/states")
+	wanted = set(entity_ids)
+	return {state['entity_id']: state for state in _call_ha_api("states") or [] if state.get('entity_id') in wanted}
+
+# ===============================================================================
+# ENTITY STATE CACHE
+# ===============================================================================
+# PT-BR: Estados recentes por entity_id (preenchidos pelos webhooks e pelo ReportState) e estatísticas de uso.
+_state_cache = {}
+state_cache_stats = {"hits": 0, "misses": 0}
+# PT-BR: Campos que a automação do HA envia no nível raiz do webhook, mas que pertencem a 'attributes'.
+WEBHOOK_ATTRIBUTE_KEYS = ('brightness', 'current_position', 'hs_color', 'color_temp_kelvin', 'friendly_name')
+
+# PT-BR: Atributos numéricos; o template da automação pode entregá-los como texto ou vazios ("").
+WEBHOOK_NUMERIC_KEYS = ('brightness', 'current_position', 'color_temp_kelvin')
+
+def _webhook_attribute(key, value):
+	"""
+	Returns a flat webhook field as an HA attribute value, or None when it is empty or malformed
+	(e.g. "" rendered by the automation for an attribute the entity does not have).
+	PT-BR: Retorna um campo do webhook como valor de atributo do HA, ou None quando vazio ou malformado
+	(ex: "" gerado pela automação para um atributo que a entidade não tem).
+	"""
+	if key in WEBHOOK_NUMERIC_KEYS:
+		if isinstance(value, bool): return None
+		if isinstance(value, str):
+			try:
+				value = float(value)
+			except ValueError:
+				return None
+		if not isinstance(value, (int, float)) or not math.isfinite(value): return None
+		return int(value) if float(value).is_integer() else value
+	if key == 'hs_color':
+		return list(value) if isinstance(value, (list, tuple)) and len(value) == 2 and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value) else None
+	return value if isinstance(value, str) and value else None
+
+def normalize_webhook_entity(entity):
+	"""
+	Converts a webhook entity into the shape of an HA state object, moving flat attributes under
+	'attributes' and skipping empty or malformed ones.
+	PT-BR: Converte uma entidade do webhook no formato de um estado do HA, movendo atributos do nível
+	raiz para 'attributes' e ignorando os vazios ou malformados.
+	"""
+	attributes = dict(entity.get('attributes') or {})
+	for key in WEBHOOK_ATTRIBUTE_KEYS:
+		if (value := _webhook_attribute(key, entity.get(key))) is not None: attributes.setdefault(key, value)
+	return {**{key: value for key, value in entity.items() if key not in WEBHOOK_ATTRIBUTE_KEYS}, 'attributes': attributes}
+
+def cache_entity_state(state, complete=True):
+	"""
+	Stores a fresh HA state object in the cache. A partial state (webhook payload) is only merged
+	into a fresh complete entry, keeping that entry's age, so it never hides retrievable properties.
+	PT-BR: Guarda um estado recente do HA no cache. Um estado parcial (payload do webhook) só é
+	mesclado numa entrada completa ainda válida, mantendo a idade dela, para nunca esconder
+	propriedades consultáveis.
+	"""
+	if not (STATE_CACHE_TTL and (entity_id := state.get('entity_id'))): return
+	if complete:
+		_state_cache[entity_id] = (time.monotonic(), state)
+	elif (entry := _state_cache.get(entity_id)) and time.monotonic() - entry[0] < STATE_CACHE_TTL:
+		_state_cache[entity_id] = (entry[0], {**entry[1], **state, 'attributes': {**entry[1].get('attributes', {}), **state.get('attributes', {})}})
+
+def invalidate_entity_state(entity_id):
+	"""
+	Drops a cached state, e.g. after a directive changed the device (for a virtual group, its members).
+	PT-BR: Descarta um estado do cache, ex: depois que uma diretiva alterou o dispositivo (num grupo virtual, os membros).
+	"""
+	for target in VIRTUAL_GROUPS[entity_id]["entities"] if entity_id in VIRTUAL_GROUPS else [entity_id]:
+		_state_cache.pop(target, None)
+
+def get_cached_entity_state(entity_id):
+	"""
+	Returns (state, age in seconds) when a fresh entry exists, otherwise (None, None).
+	PT-BR: Retorna (estado, idade em segundos) quando existe uma entrada válida, senão (None, None).
+	"""
+	if (entry := _state_cache.get(entity_id)) and (age := time.monotonic() - entry[0]) < STATE_CACHE_TTL:
+		state_cache_stats["hits"] += 1
+		return entry[1], age
+	state_cache_stats["misses"] += 1
+	return None, None
+
+# ===============================================================================
+# 🧩 VIRTUAL GROUP ENDPOINTS
+# ===============================================================================
+def _load_virtual_groups(raw):
+	"""
+	Parses VIRTUAL_GROUPS, e.g. {"light.spots": {"name": "Spots", "entities": ["light.spot_1", "light.spot_2"]}}
+	(a plain list of entities is also accepted). Groups with members outside the group's domain are ignored.
+	PT-BR: Interpreta VIRTUAL_GROUPS, ex: {"light.spots": {"name": "Spots", "entities": ["light.spot_1", "light.spot_2"]}}
+	(uma lista simples de entidades também é aceita). Grupos com membros de outro domínio são ignorados.
+	"""
+	try:
+		config = json.loads(raw) if raw else {}
+	except json.JSONDecodeError:
+		logger.error("VIRTUAL_GROUPS is not valid JSON, ignoring it.")
+		return {}
+	groups = {}
+	for group_id, group in config.items():
+		group = {"entities": group} if isinstance(group, list) else group
+		domain, members = group_id.split('.')[0], list(group.get("entities", []))
+		if not members or any(member.split('.')[0] != domain for member in members):
+			logger.error(f"Ignoring virtual group {group_id}: it needs member entities of the '{domain}' domain.")
+			continue
+		groups[group_id] = {"name": group.get("name", group_id), "entities": members}
+	return groups
+
+# PT-BR: Grupos virtuais: endpoint da Alexa -> membros no HA, e o índice inverso membro -> grupos.
+VIRTUAL_GROUPS = _load_virtual_groups(os.environ.get('VIRTUAL_GROUPS'))
+VIRTUAL_GROUP_MEMBERS = {member: [group_id for group_id, group in VIRTUAL_GROUPS.items() if member in group["entities"]] for group in VIRTUAL_GROUPS.values() for member in group["entities"]}
+
+def endpoint_targets(endpoint_id):
+	"""
+	Returns the HA entity_id targeted by a directive, or the member list of a virtual group.
+	PT-BR: Retorna o entity_id do HA alvo de uma diretiva, ou a lista de membros de um grupo virtual.
+	"""
+	return VIRTUAL_GROUPS[endpoint_id]["entities"] if endpoint_id in VIRTUAL_GROUPS else endpoint_id
+
+def build_group_discovery_endpoint(group_id, member_states):
+	"""
+	Builds the discovery endpoint of a virtual group with the capabilities every known member supports.
+	PT-BR: Monta o endpoint de descoberta de um grupo virtual com as capacidades que todos os membros conhecidos suportam.
+	"""
+	domain = group_id.split('.')[0]
+	members = [member_states[member].get('attributes', {}) for member in VIRTUAL_GROUPS[group_id]["entities"] if member in member_states]
+	if not members or domain not in CAPABILITY_TEMPLATES: return None
+	display_categories, templates = CAPABILITY_TEMPLATES[domain]
+	alexa_capabilities = [BASE_ALEXA_CAPABILITY]
+	alexa_capabilities.extend(alexa_cap for ha_check, alexa_cap in templates if not ha_check or all(ha_check(attributes) for attributes in members))
+	if len(alexa_capabilities) <= 1: return None
+	return {"endpointId": group_id, "manufacturerName": "Home Assistant", "friendlyName": VIRTUAL_GROUPS[group_id]["name"], "description": f"{domain} group via HA", "displayCategories": display_categories, "capabilities": alexa_capabilities}
+
+def build_discovery_endpoints(states):
+	"""
+	Builds the discovery endpoints for an iterable of HA states, plus the virtual groups whose members are among them.
+	PT-BR: Monta os endpoints da descoberta para um iterável de estados do HA, mais os grupos virtuais cujos membros estão entre eles.
+	"""
+	endpoints, member_states = [], {}
+	for state in states:
+		if state.get('entity_id') in VIRTUAL_GROUP_MEMBERS: member_states[state['entity_id']] = state
+		if endpoint := build_discovery_endpoint(state): endpoints.append(endpoint)
+	endpoints.extend(endpoint for group_id in VIRTUAL_GROUPS if (endpoint := build_group_discovery_endpoint(group_id, member_states)))
+	return endpoints
+
+# PT-BR: Estados de uma persiana ainda em movimento.
+MOVING_STATES = ('opening', 'closing')
+
+def aggregate_group_state(group_id, member_states):
+	"""
+	Combines member states into one HA-shaped state: on when any member is on (opening/closing while a
+	cover member moves), brightness and cover position averaged, color and color temperature taken
+	from the first lit member.
+	PT-BR: Combina os estados dos membros num único estado no formato do HA: ligado se algum membro
+	está ligado (opening/closing enquanto uma persiana se move), brilho e posição da persiana pela
+	média, cor e temperatura do primeiro membro aceso.
+	"""
+	if not (members := [member_states[member] for member in VIRTUAL_GROUPS[group_id]["entities"] if member in member_states]): return None
+	lit = [member.get('attributes', {}) for member in members if member.get('state') == 'on']
+	attributes = {"friendly_name": VIRTUAL_GROUPS[group_id]["name"]}
+	if brightness := [member['brightness'] for member in lit if member.get('brightness') is not None]:
+		attributes['brightness'] = round(sum(brightness) / len(brightness))
+	for key in ('hs_color', 'color_temp_kelvin'):
+		if (value := next((member[key] for member in lit if member.get(key) is not None), None)) is not None: attributes[key] = value
+	if positions := [position for member in members if (position := member.get('attributes', {}).get('current_position')) is not None]:
+		attributes['current_position'] = round(sum(positions) / len(positions))
+	# PT-BR: Uma persiana ainda em movimento marca o grupo como em movimento, para a confirmação do DeferredResponse esperar.
+	state = next((member['state'] for member in members if member.get('state') in MOVING_STATES), "on" if lit else "off")
+	return {"entity_id": group_id, "state": state, "attributes": attributes}
+
+def get_group_states(group_ids):
+	"""
+	Returns {group_id: aggregated state}, using cached member states and reading every missing member
+	of every group in one batched HA request.
+	PT-BR: Retorna {group_id: estado agregado}, usando os estados dos membros em cache e lendo todos os
+	membros que faltam, de todos os grupos, numa única requisição ao HA.
+	"""
+	members = {member for group_id in group_ids for member in VIRTUAL_GROUPS[group_id]["entities"]}
+	member_states = {member: state for member in members if (state := get_cached_entity_state(member)[0]) is not None}
+	if missing := members - member_states.keys():
+		for entity_id, state in fetch_entity_states(sorted(missing)).items():
+			cache_entity_state(state)
+			member_states[entity_id] = state
+	return {group_id: state for group_id in group_ids if (state := aggregate_group_state(group_id, member_states))}
+
+# ===============================================================================
+# 🗂️ DISCOVERY INDEX (incremental AddOrUpdateReport / DeleteReport)
+# ===============================================================================
+# PT-BR: entity_id -> (impressão digital, endpoint) da última leitura completa, e o instante dessa leitura.
+_discovery_index = {}
+_discovery_index_at = None
+_discovery_index_lock = threading.Lock()
+DISCOVERY_INDEX_KEY = 'discovery#index'
+# PT-BR: Limite de endpoints por AddOrUpdateReport/DeleteReport.
+DISCOVERY_REPORT_MAX_ENDPOINTS = 300
+
+def _endpoint_fingerprint(endpoint):
+	# PT-BR: Só compara versões do mesmo endpoint, então um CRC32 curto basta e mantém pequeno o item no DynamoDB.
+	return f"{zlib.crc32(json.dumps(endpoint, sort_keys=True).encode()):08x}"
+
+def fetch_discovery_endpoints():
+	"""
+	Builds the discovery endpoints from a template query in which HA returns only candidate entities as
+	NDJSON, parsed line by line so time and memory follow the number of exposed devices instead of the
+	total entity count. Falls back to the full /api/states dump when the template API fails.
+	PT-BR: Monta os endpoints da descoberta a partir de um template em que o HA devolve só as entidades
+	candidatas em NDJSON, lidas linha a linha para que tempo e memória acompanhem o número de
+	dispositivos expostos e não o total de entidades. Volta ao /api/states completo se o template falhar.
+	"""
+	try:
+		# PT-BR: Membros de grupos virtuais também são pedidos, mesmo sem a tag, para montar os endpoints dos grupos.
+		return build_discovery_endpoints(stream_template_states(sorted(CAPABILITY_TEMPLATES), HA_DISCOVERY_TAG, VIRTUAL_GROUP_MEMBERS))
+	except Exception:
+		logger.exception("Template discovery failed, falling back to /api/states")
+	if (states := _call_ha_api("states")) is None: raise ConnectionError("Failed to fetch states from Home Assistant")
+	return build_discovery_endpoints(states)
+
+def refresh_discovery_index(states=None):
+	"""
+	Rebuilds the discovery index from the given states, or from HA when none are given, and returns the endpoints.
+	PT-BR: Reconstrói o índice de descoberta a partir dos estados informados, ou do HA quando nenhum é informado, e retorna os endpoints.
+	"""
+	global _discovery_index_at
+	endpoints = fetch_discovery_endpoints() if states is None else build_discovery_endpoints(states)
+	index = {endpoint['endpointId']: (_endpoint_fingerprint(endpoint), endpoint) for endpoint in endpoints}
+	with _discovery_index_lock:
+		_discovery_index.clear()
+		_discovery_index.update(index)
+		_discovery_index_at = time.monotonic()
+	return [endpoint for _, endpoint in index.values()]
+
+def cached_discovery_endpoints():
+	"""
+	Returns the indexed endpoints while the index is fresh (DISCOVERY_INDEX_TTL), otherwise None.
+	PT-BR: Retorna os endpoints do índice enquanto ele é recente (DISCOVERY_INDEX_TTL), senão None.
+	"""
+	with _discovery_index_lock:
+		if DISCOVERY_INDEX_TTL and _discovery_index_at is not None and time.monotonic() - _discovery_index_at < DISCOVERY_INDEX_TTL:
+			return [endpoint for _, endpoint in _discovery_index.values()]
+	return None
+
+def update_discovery_index(states, removed_entity_ids=()):
+	"""
+	Applies complete state objects (e.g. from the bridge) and removed entities to the index and returns
+	the entity_ids whose endpoint appeared, changed or disappeared.
+	PT-BR: Aplica estados completos (ex: do bridge) e entidades removidas ao índice e retorna os
+	entity_ids cujo endpoint surgiu, mudou ou sumiu.
+	"""
+	changed = set()
+	with _discovery_index_lock:
+		for state in states:
+			# PT-BR: Entidades indisponíveis perdem atributos de capacidade; não são tratadas como mudança de descoberta.
+			if state.get('state') == 'unavailable': continue
+			entity_id = state.get('entity_id')
+			if endpoint := build_discovery_endpoint(state):
+				fingerprint = _endpoint_fingerprint(endpoint)
+				if (entry := _discovery_index.get(entity_id)) is None or entry[0] != fingerprint:
+					_discovery_index[entity_id] = (fingerprint, endpoint)
+					changed.add(entity_id)
+			elif _discovery_index.pop(entity_id, None) is not None:
+				changed.add(entity_id)
+		for entity_id in removed_entity_ids:
+			if _discovery_index.pop(entity_id, None) is not None: changed.add(entity_id)
+	return changed
+
+def build_discovery_report(name, token, endpoints):
+	"""
+	Builds an Alexa.Discovery AddOrUpdateReport or DeleteReport event.
+	PT-BR: Monta um evento Alexa.Discovery AddOrUpdateReport ou DeleteReport.
+	"""
+	return {"event": {"header": {"namespace": "Alexa.Discovery", "name": name, "payloadVersion": "3", "messageId": str(uuid.uuid4())}, "payload": {"endpoints": endpoints, "scope": {"type": "BearerToken", "token": token}}}}
+
+def publish_discovery_changes(entity_ids=None):
+	"""
+	Compares the index with the fingerprints last published to Alexa (stored in the tokens table, shared
+	by every container) and sends only the differences as AddOrUpdateReport/DeleteReport to each user
+	of the affected entities. Limited to entity_ids when given. The baseline only moves forward when
+	every report was accepted, so failed deltas are sent again on the next call.
+	PT-BR: Compara o índice com as impressões digitais publicadas por último (guardadas na tabela de
+	tokens, compartilhadas por todos os containers) e envia só as diferenças como
+	AddOrUpdateReport/DeleteReport para cada usuário das entidades afetadas. Limitado a entity_ids
+	quando informado. A referência só avança quando todos os reports foram aceitos, então deltas que
+	falharam são reenviados na próxima chamada.
+	"""
+	with _discovery_index_lock: index = dict(_discovery_index)
+	item = get_token_store().get(DISCOVERY_INDEX_KEY, consistent=True)
+	published = dict((item or {}).get('fingerprints', {}))
+	candidates = published.keys() | index.keys() if entity_ids is None else set(entity_ids)
+	upserts = sorted(entity_id for entity_id in candidates if entity_id in index and published.get(entity_id) != index[entity_id][0])
+	deletes = sorted(entity_id for entity_id in candidates if entity_id not in index and entity_id in published)
+	summary = {"added_or_updated": len(upserts), "deleted": len(deletes)}
+	if item is not None and not upserts and not deletes: return summary
+
+	# PT-BR: Sem referência ainda (primeira execução), os usuários já têm a descoberta completa; só grava a referência.
+	if item is not None:
+		routes = get_entity_users(upserts + deletes)
+		tokens = get_user_access_tokens({user_id for users in routes.values() for user_id in users})
+		reports = []
+		for user_id, token in sorted(tokens.items()):
+			for name, endpoints in (("AddOrUpdateReport", [index[entity_id][1] for entity_id in upserts if user_id in routes[entity_id]]), ("DeleteReport", [{"endpointId": entity_id} for entity_id in deletes if user_id in routes[entity_id]])):
+				for start in range(0, len(endpoints), DISCOVERY_REPORT_MAX_ENDPOINTS):
+					reports.append((user_id, name, token, build_discovery_report(name, token, endpoints[start:start + DISCOVERY_REPORT_MAX_ENDPOINTS])))
+		if not all(result["success"] for result in send_change_reports(reports)):
+			logger.error(f"Discovery changes not fully delivered, they will be sent again: {summary}.")
+			return {**summary, "delivered": False}
+
+	for entity_id in upserts: published[entity_id] = index[entity_id][0]
+	for entity_id in deletes: published.pop(entity_id, None)
+	get_token_store().put({'user_id': DISCOVERY_INDEX_KEY, 'fingerprints': published, 'updated_at': int(time.time())})
+	logger.info(f"Discovery changes published: {summary}.")
+	return {**summary, "delivered": True}
+
 # ===============================================================================
 # ALEXA DIRECTIVE HANDLERS (Alexa -> Home Assistant)
 # ===============================================================================
@@ -155,6 +1300,7 @@ def handle_accept_grant(event):
 	Handles the AcceptGrant directive for account linking.
 	PT-BR: Lida com a diretiva AcceptGrant para vincular a conta do usuário.
 	"""
+	global _default_user_id
 	try:
 		payload = event.get('directive', {}).get('payload', {})
 		code = payload.get('grant', {}).get('code')
@@ -163,7 +1309,10 @@ def handle_accept_grant(event):
 			return create_error_response(event, "INVALID_AUTHORIZATION_CREDENTIAL", "Missing grant code or grantee token.")
 		if not (user_tokens := exchange_code_for_tokens(code)):
 			return create_error_response(event, "INVALID_AUTHORIZATION_CREDENTIAL", "Failed to exchange code for tokens")
-		tokens_table.put_item(Item={'user_id': user_id, 'created_at': int(time.time()), 'updated_at': int(time.time()), **user_tokens})
+		get_token_store().put({'user_id': user_id, 'created_at': int(time.time()), 'updated_at': int(time.time()), **user_tokens})
+		_token_cache[user_id] = {'user_id': user_id, **user_tokens}
+		link_user_entities(user_id)
+		if not ALEXA_USER_ID: _default_user_id = user_id # PT-BR: A vinculação mais recente passa a ser a padrão.
 		return {"event": {"header": {"namespace": "Alexa.Authorization", "name": "AcceptGrant.Response", "payloadVersion": "3", "messageId": "accept-grant-response"}, "payload": {}}}
 	except Exception:
 		logger.exception("Exception in handle_accept_grant")
@@ -174,14 +1323,14 @@ def handle_discovery(event):
 	Handles the Discover directive to find devices in Home Assistant.
 	PT-BR: Lida com a diretiva Discover para encontrar dispositivos no Home Assistant.
 	"""
-	endpoints = []
 	try:
-		ha_states = _call_ha_api("states")
-		if ha_states is None: raise ConnectionError("Failed to fetch states from Home Assistant")
-		for state in ha_states:
-			if (endpoint := build_discovery_endpoint(state)):
-				endpoints.append(endpoint)
-		logger.info(f"Discovery found {len(endpoints)} devices.")
+		if (endpoints := cached_discovery_endpoints()) is None:
+			# PT-BR: Quem pediu o Discover recebe tudo; as diferenças para os demais usuários são publicadas pelo
+			# evento agendado, pelo modo servidor ou pelo bridge, fora do prazo da diretiva.
+			endpoints = refresh_discovery_index()
+			logger.info(f"Discovery found {len(endpoints)} devices.")
+		else:
+			logger.info(f"Discovery answered {len(endpoints)} devices from the index.")
 		return {"event": {"header": {"namespace": "Alexa.Discovery", "name": "Discover.Response", "payloadVersion": "3", "messageId": "discovery-response"}, "payload": {"endpoints": endpoints}}}
 	except Exception:
 		logger.exception("Exception in handle_discovery")
@@ -196,10 +1345,22 @@ def handle_report_state(event):
 	entity_id = endpoint.get('endpointId')
 	if not entity_id: return create_error_response(event, "INVALID_VALUE", "Missing endpointId.")
 	try:
-		ha_state = _call_ha_api(f"states/{entity_id}")
-		if ha_state is None: raise ConnectionError(f"Could not retrieve state for {entity_id}")
+		# PT-BR: Um grupo virtual é agregado a partir dos membros (cache ou uma leitura em lote do HA).
+		if entity_id in VIRTUAL_GROUPS:
+			ha_state, age = get_group_states([entity_id]).get(entity_id), None
+			if ha_state is None: raise ConnectionError(f"Could not retrieve member states for {entity_id}")
+		else:
+			ha_state, age = get_cached_entity_state(entity_id)
+			if ha_state is None:
+				ha_state = _call_ha_api(f"states/{entity_id}")
+				if ha_state is None: raise ConnectionError(f"Could not retrieve state for {entity_id}")
+				cache_entity_state(ha_state)
 		
 		properties = build_alexa_properties(ha_state)
+		if age is not None:
+			# PT-BR: A incerteza reflete a idade do estado em cache.
+			for prop in properties: prop["uncertaintyInMilliseconds"] = max(prop["uncertaintyInMilliseconds"], int(age * 1000))
+		logger.info(f"ReportState for {entity_id} served from {'cache' if age is not None else 'Home Assistant'}, state_cache={state_cache_stats}.")
 		header = event.get('directive', {}).get('header', {})
 		return {
 			"event": {"header": {"namespace": "Alexa", "name": "StateReport", "payloadVersion": "3", "messageId": header.get('messageId', 'msg') + "-R", "correlationToken": header.get('correlationToken')}, "endpoint": endpoint, "payload": {}},
@@ -221,7 +1382,7 @@ def handle_power_control(event):
 	command = "turn_on" if event['directive']['header']['name'] == 'TurnOn' else "turn_off"
 	domain = entity_id.split('.')[0]
 	
-	if _call_ha_api(f"services/{domain}/{command}", method='POST', json_payload={'entity_id': entity_id}) is not None:
+	if _call_ha_api(f"services/{domain}/{command}", method='POST', json_payload={'entity_id': endpoint_targets(entity_id)}) is not None:
 		return build_control_response(event, "powerState", "ON" if command == "turn_on" else "OFF")
 	return create_error_response(event, "DEPENDENT_SERVICE_UNAVAILABLE", "Failed to send command to Home Assistant")
 
@@ -243,7 +1404,7 @@ def handle_brightness_control(event):
 	elif event['directive']['header']['name'] == 'AdjustBrightness':
 		ha_payload['brightness_step_pct'] = payload.get('brightnessDelta')
 	
-	if _call_ha_api("services/light/turn_on", method='POST', json_payload={'entity_id': entity_id, **ha_payload}) is not None:
+	if _call_ha_api("services/light/turn_on", method='POST', json_payload={'entity_id': endpoint_targets(entity_id), **ha_payload}) is not None:
 		return build_control_response(event, "brightness", alexa_brightness)
 	return create_error_response(event, "DEPENDENT_SERVICE_UNAVAILABLE", "Failed to set brightness")
 
@@ -258,7 +1419,7 @@ def handle_color_control(event):
 	if not entity_id or not color: return create_error_response(event, "INVALID_VALUE", "Missing endpointId or color payload.")
 	
 	ha_payload = {'hs_color': [color.get('hue', 0.0), color.get('saturation', 0.0) * 100.0], 'brightness_pct': int(color.get('brightness', 0.0) * 100.0)}
-	if _call_ha_api("services/light/turn_on", method='POST', json_payload={'entity_id': entity_id, **ha_payload}) is not None:
+	if _call_ha_api("services/light/turn_on", method='POST', json_payload={'entity_id': endpoint_targets(entity_id), **ha_payload}) is not None:
 		return build_control_response(event, "color", color)
 	return create_error_response(event, "DEPENDENT_SERVICE_UNAVAILABLE", "Failed to set color")
 
@@ -272,7 +1433,7 @@ def handle_color_temperature_control(event):
 	kelvin = event.get('directive', {}).get('payload', {}).get('colorTemperatureInKelvin')
 	if not entity_id or not kelvin: return create_error_response(event, "INVALID_VALUE", "Missing endpointId or kelvin value.")
 
-	if _call_ha_api("services/light/turn_on", method='POST', json_payload={'entity_id': entity_id, 'kelvin': kelvin}) is not None:
+	if _call_ha_api("services/light/turn_on", method='POST', json_payload={'entity_id': endpoint_targets(entity_id), 'kelvin': kelvin}) is not None:
 		return build_control_response(event, "colorTemperatureInKelvin", kelvin)
 	return create_error_response(event, "DEPENDENT_SERVICE_UNAVAILABLE", "Failed to set color temperature")
 
@@ -286,7 +1447,7 @@ def handle_range_control(event):
 	range_value = event.get('directive', {}).get('payload', {}).get('rangeValue')
 	if not entity_id or range_value is None: return create_error_response(event, "INVALID_VALUE", "Missing endpointId or range value.")
 	
-	if _call_ha_api("services/cover/set_cover_position", method='POST', json_payload={'entity_id': entity_id, 'position': range_value}) is not None:
+	if _call_ha_api("services/cover/set_cover_position", method='POST', json_payload={'entity_id': endpoint_targets(entity_id), 'position': range_value}) is not None:
 		return build_control_response(event, "rangeValue", range_value, instance="Cover.Position")
 	return create_error_response(event, "DEPENDENT_SERVICE_UNAVAILABLE", "Failed to set range")
 
@@ -301,7 +1462,7 @@ def handle_mode_control(event):
 	if not entity_id or not mode: return create_error_response(event, "INVALID_VALUE", "Missing endpointId or mode value.")
 	
 	action = "open_cover" if mode == "Cover.Open" else "close_cover" if mode == "Cover.Closed" else None
-	if action and _call_ha_api(f"services/cover/{action}", method='POST', json_payload={'entity_id': entity_id}) is not None:
+	if action and _call_ha_api(f"services/cover/{action}", method='POST', json_payload={'entity_id': endpoint_targets(entity_id)}) is not None:
 		return build_control_response(event, "mode", mode, instance="Cover.State")
 	return create_error_response(event, "DEPENDENT_SERVICE_UNAVAILABLE", "Failed to set mode")
 
@@ -314,14 +1475,371 @@ def handle_script_activate(event):
 	entity_id = endpoint.get('endpointId')
 	if not entity_id: return create_error_response(event, "INVALID_VALUE", "Missing endpointId.")
 	
-	if _call_ha_api("services/script/turn_on", method='POST', json_payload={'entity_id': entity_id}) is not None:
+	if _call_ha_api("services/script/turn_on", method='POST', json_payload={'entity_id': endpoint_targets(entity_id)}) is not None:
 		return build_control_response(event)
 	return create_error_response(event, "DEPENDENT_SERVICE_UNAVAILABLE", "Failed to activate script")
 
 
+# ===============================================================================
+# CHANGE REPORT DEDUPLICATION AND COALESCING
+# ===============================================================================
+# PT-BR: Últimas propriedades enviadas por (user_id, endpoint), rajadas pendentes e contadores do container.
+_last_sent_reports = {}
+_pending_change_reports = {}
+_change_report_lock = threading.Lock()
+_change_report_timer = None
+change_report_stats = {"received": 0, "deduplicated": 0, "coalesced": 0, "sent": 0, "failed": 0}
+
+def _properties_fingerprint(properties):
+	"""
+	Builds a comparable fingerprint of Alexa properties, ignoring sample time and uncertainty.
+	PT-BR: Gera uma impressão digital comparável das propriedades, ignorando horário e incerteza da amostra.
+	"""
+	return json.dumps([{k: v for k, v in prop.items() if k not in ('timeOfSample', 'uncertaintyInMilliseconds')} for prop in properties], sort_keys=True)
+
+def plan_change_reports(latest_properties):
+	"""
+	Decides which (user_id, entity_id) reports must be sent now. Unchanged properties are suppressed
+	and changes arriving inside the coalescing window are parked so that only the latest one is sent.
+	PT-BR: Decide quais reports (user_id, entity_id) devem ser enviados agora. Propriedades iguais são
+	descartadas e mudanças dentro da janela de agrupamento ficam pendentes para que só a mais recente seja enviada.
+	"""
+	# PT-BR: Na Lambda a janela só atrasaria (e cobraria) o envio, sem nada a agrupar; vale só a deduplicação.
+	due, now, window = [], time.monotonic(), 0.0 if RUNNING_ON_LAMBDA else CHANGE_REPORT_COALESCE_MS / 1000.0
+	with _change_report_lock:
+		for report_key, properties in latest_properties.items():
+			change_report_stats["received"] += 1
+			fingerprint = _properties_fingerprint(properties)
+			last_fingerprint, last_sent_at = _last_sent_reports.get(report_key, (None, 0.0))
+			if fingerprint == last_fingerprint:
+				change_report_stats["deduplicated"] += 1
+				_pending_change_reports.pop(report_key, None)
+				continue
+			if window and now - last_sent_at < window:
+				if report_key in _pending_change_reports: change_report_stats["coalesced"] += 1
+				_pending_change_reports[report_key] = (properties, last_sent_at + window)
+				continue
+			# PT-BR: Reserva o envio já aqui para que webhooks concorrentes respeitem a mesma janela.
+			_last_sent_reports[report_key] = (fingerprint, now)
+			due.append((report_key, properties))
+		if _pending_change_reports: _arm_change_report_timer()
+	return due
+
+def deliver_planned_change_reports(tokens, due):
+	"""
+	Sends the planned ChangeReports and records the outcome. Failed endpoints are forgotten so the
+	same value is not suppressed as a duplicate on the next webhook.
+	PT-BR: Envia os ChangeReports planejados e registra o resultado. Endpoints que falharam são
+	esquecidos para que o mesmo valor não seja descartado como duplicado no próximo webhook.
+	"""
+	reports = [(user_id, entity_id, tokens[user_id], build_change_report_payload(tokens[user_id], entity_id, properties)) for (user_id, entity_id), properties in due]
+	results = send_change_reports(reports)
+	with _change_report_lock:
+		for result in results:
+			change_report_stats["sent" if result["success"] else "failed"] += 1
+			if not result["success"]: _last_sent_reports.pop((result["user_id"], result["entity_id"]), None)
+	spool_failed_change_reports(reports, results)
+	return results
+
+def _arm_change_report_timer():
+	"""
+	Schedules a flush of pending reports for the earliest window end. Must be called with the lock held.
+	PT-BR: Agenda o envio dos reports pendentes para o fim da janela mais próxima. Deve ser chamada com o lock.
+	"""
+	global _change_report_timer
+	if _change_report_timer and _change_report_timer.is_alive(): return
+	delay = max(0.0, min(due_at for _, due_at in _pending_change_reports.values()) - time.monotonic())
+	_change_report_timer = threading.Timer(delay, flush_pending_change_reports)
+	_change_report_timer.daemon = True
+	_change_report_timer.start()
+
+def flush_pending_change_reports():
+	"""
+	Sends the latest pending value of every endpoint whose coalescing window has elapsed.
+	PT-BR: Envia o valor pendente mais recente de cada endpoint cuja janela de agrupamento terminou.
+	"""
+	global _change_report_timer
+	now = time.monotonic()
+	with _change_report_lock:
+		_change_report_timer = None
+		due = [(report_key, properties) for report_key, (properties, due_at) in _pending_change_reports.items() if due_at <= now]
+		for report_key, properties in due:
+			del _pending_change_reports[report_key]
+			_last_sent_reports[report_key] = (_properties_fingerprint(properties), now)
+		if _pending_change_reports: _arm_change_report_timer()
+	if not due: return []
+	tokens = get_user_access_tokens({user_id for (user_id, _), _ in due})
+	if missing := [report_key for report_key, _ in due if report_key[0] not in tokens]:
+		logger.error(f"User access token is not available for {len(missing)} pending ChangeReports.")
+		with _change_report_lock:
+			for report_key in missing: _last_sent_reports.pop(report_key, None)
+	return deliver_planned_change_reports(tokens, [(report_key, properties) for report_key, properties in due if report_key[0] in tokens])
+
+# ===============================================================================
+# 🔁 DURABLE RETRY QUEUE (failed Alexa Gateway deliveries)
+# ===============================================================================
+class SQLiteRetryQueue:
+	"""
+	Retry spool in a local SQLite file (WAL mode) with one row per (user_id, endpoint_id): a newer
+	report for the same endpoint replaces the payload of the one still waiting, keeping its backoff.
+	PT-BR: Fila de reenvio num arquivo SQLite local (modo WAL) com uma linha por (user_id, endpoint_id):
+	um report mais novo do mesmo endpoint substitui o payload do que ainda espera, mantendo o backoff.
+	"""
+	def __init__(self, path):
+		self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+		self._conn.execute('PRAGMA journal_mode=WAL')
+		self._conn.execute('PRAGMA synchronous=NORMAL')
+		self._conn.execute('CREATE TABLE IF NOT EXISTS change_report_retries (user_id TEXT NOT NULL, endpoint_id TEXT NOT NULL, payload TEXT NOT NULL, attempts INTEGER NOT NULL, next_attempt_at REAL NOT NULL, enqueued_at REAL NOT NULL, version INTEGER NOT NULL, PRIMARY KEY (user_id, endpoint_id))')
+		self._conn.execute('CREATE INDEX IF NOT EXISTS change_report_retries_due ON change_report_retries (next_attempt_at)')
+		self._lock = threading.Lock()
+		# PT-BR: Chaves com linha na fila; evita um DELETE a cada ChangeReport entregue quando nada foi gravado.
+		self._spooled = set(self._conn.execute('SELECT user_id, endpoint_id FROM change_report_retries').fetchall())
+
+	def enqueue(self, user_id, endpoint_id, payload, next_attempt_at):
+		with self._lock:
+			self._conn.execute('INSERT INTO change_report_retries VALUES (?, ?, ?, 0, ?, ?, 1) ON CONFLICT (user_id, endpoint_id) DO UPDATE SET payload = excluded.payload, next_attempt_at = MAX(next_attempt_at, excluded.next_attempt_at), version = version + 1',
+				(user_id, endpoint_id, json.dumps(payload), next_attempt_at, time.time()))
+			self._spooled.add((user_id, endpoint_id))
+
+	def discard(self, user_id, endpoint_id):
+		with self._lock:
+			if (user_id, endpoint_id) not in self._spooled: return
+			self._conn.execute('DELETE FROM change_report_retries WHERE user_id = ? AND endpoint_id = ?', (user_id, endpoint_id))
+			self._spooled.discard((user_id, endpoint_id))
+
+	def due(self, now, limit):
+		with self._lock:
+			rows = self._conn.execute('SELECT user_id, endpoint_id, payload, attempts, enqueued_at, version FROM change_report_retries WHERE next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?', (now, limit)).fetchall()
+		return [{"user_id": user_id, "endpoint_id": endpoint_id, "payload": json.loads(payload), "attempts": attempts, "enqueued_at": enqueued_at, "version": version} for user_id, endpoint_id, payload, attempts, enqueued_at, version in rows]
+
+	def remove(self, entry):
+		# PT-BR: Só remove a versão enviada; um report mais novo que chegou nesse meio tempo continua na fila.
+		with self._lock:
+			if self._conn.execute('DELETE FROM change_report_retries WHERE user_id = ? AND endpoint_id = ? AND version = ?', (entry["user_id"], entry["endpoint_id"], entry["version"])).rowcount:
+				self._spooled.discard((entry["user_id"], entry["endpoint_id"]))
+
+	def reschedule(self, entry, attempts, next_attempt_at):
+		with self._lock:
+			self._conn.execute('UPDATE change_report_retries SET attempts = ?, next_attempt_at = ? WHERE user_id = ? AND endpoint_id = ? AND version = ?', (attempts, next_attempt_at, entry["user_id"], entry["endpoint_id"], entry["version"]))
+
+	def stats(self):
+		with self._lock:
+			depth, oldest = self._conn.execute('SELECT COUNT(*), MIN(enqueued_at) FROM change_report_retries').fetchone()
+		return {"depth": depth, "oldest_age_s": round(time.time() - oldest, 1) if oldest else 0.0}
+
+class SQSRetryQueue:
+	"""
+	Retry spool on an Amazon SQS queue, with backoff through DelaySeconds (max 15 min). Replacement
+	is best effort: within a received batch only the newest message per endpoint is sent, and
+	messages older than a delivery already made by this container are dropped.
+	PT-BR: Fila de reenvio no Amazon SQS, com backoff via DelaySeconds (máx. 15 min). A substituição é
+	aproximada: num lote recebido só a mensagem mais nova de cada endpoint é enviada, e mensagens
+	mais antigas que uma entrega já feita por este container são descartadas.
+	"""
+	def __init__(self, queue_url):
+		self.queue_url = queue_url
+		self._delivered_at = {}
+
+	def _send(self, entry, next_attempt_at):
+		get_aws_client('sqs').send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(entry), DelaySeconds=int(min(900, max(0, next_attempt_at - time.time()))))
+
+	def enqueue(self, user_id, endpoint_id, payload, next_attempt_at):
+		self._send({"user_id": user_id, "endpoint_id": endpoint_id, "payload": payload, "attempts": 0, "enqueued_at": time.time()}, next_attempt_at)
+
+	def discard(self, user_id, endpoint_id):
+		self._delivered_at[(user_id, endpoint_id)] = time.time()
+
+	def due(self, now, limit):
+		newest = {}
+		for message in get_aws_client('sqs').receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=max(1, min(10, limit)), WaitTimeSeconds=0, VisibilityTimeout=60).get('Messages', []):
+			entry = {**json.loads(message['Body']), "receipt_handle": message['ReceiptHandle']}
+			key = (entry["user_id"], entry["endpoint_id"])
+			if entry["enqueued_at"] <= self._delivered_at.get(key, 0) or (key in newest and newest[key]["enqueued_at"] >= entry["enqueued_at"]):
+				self.remove(entry)
+				continue
+			if key in newest: self.remove(newest[key])
+			newest[key] = entry
+		return list(newest.values())
+
+	def remove(self, entry):
+		get_aws_client('sqs').delete_message(QueueUrl=self.queue_url, ReceiptHandle=entry["receipt_handle"])
+
+	def reschedule(self, entry, attempts, next_attempt_at):
+		self._send({**{k: v for k, v in entry.items() if k != "receipt_handle"}, "attempts": attempts}, next_attempt_at)
+		self.remove(entry)
+
+	def stats(self):
+		attributes = get_aws_client('sqs').get_queue_attributes(QueueUrl=self.queue_url, AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesDelayed', 'ApproximateNumberOfMessagesNotVisible'])['Attributes']
+		# PT-BR: A idade da mensagem mais antiga já é publicada pelo próprio SQS (ApproximateAgeOfOldestMessage).
+		return {"depth": sum(int(value) for value in attributes.values()), "oldest_age_s": None}
+
+_retry_queue = None
+_retry_queue_lock = threading.Lock()
+# PT-BR: Indica que este container gravou reports na fila e ainda não a viu vazia; só então o webhook a drena.
+_retry_queue_pending = False
+
+def get_retry_queue():
+	"""
+	Returns the retry spool selected by RETRY_QUEUE_BACKEND, or None when it is disabled or unavailable.
+	PT-BR: Retorna a fila de reenvio selecionada por RETRY_QUEUE_BACKEND, ou None quando desativada ou indisponível.
+	"""
+	global _retry_queue, RETRY_QUEUE_BACKEND
+	with _retry_queue_lock:
+		if _retry_queue is None and RETRY_QUEUE_BACKEND != 'none':
+			try:
+				_retry_queue = SQSRetryQueue(RETRY_QUEUE_URL) if RETRY_QUEUE_BACKEND == 'sqs' else SQLiteRetryQueue(RETRY_QUEUE_PATH)
+			except Exception:
+				logger.exception("Retry queue unavailable, failed ChangeReports will not be retried")
+				RETRY_QUEUE_BACKEND = 'none'
+		return _retry_queue
+
+def retry_delay(attempts, retry_after=None):
+	"""
+	Exponential backoff with full jitter, never shorter than the gateway's Retry-After.
+	PT-BR: Backoff exponencial com jitter completo, nunca menor que o Retry-After do gateway.
+	"""
+	return max(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempts)), retry_after or 0)
+
+def spool_failed_change_reports(reports, results):
+	"""
+	Writes retryable failures to the retry queue and clears queued entries superseded by a successful delivery.
+	PT-BR: Grava as falhas temporárias na fila de reenvio e limpa entradas superadas por uma entrega bem-sucedida.
+	"""
+	global _retry_queue_pending
+	if not (queue := get_retry_queue()): return
+	for (user_id, entity_id, _, payload), result in zip(reports, results):
+		try:
+			if result["success"]:
+				queue.discard(user_id, entity_id)
+			elif result["retryable"]:
+				# PT-BR: O token não é gravado; um token válido é colocado no momento do reenvio.
+				spooled = json.loads(json.dumps(payload))
+				spooled["event"]["endpoint"]["scope"]["token"] = None
+				queue.enqueue(user_id, entity_id, spooled, time.time() + retry_delay(0, result.get("retry_after")))
+				_retry_queue_pending = True
+		except Exception:
+			logger.exception(f"Failed to spool ChangeReport for {entity_id}")
+
+def drain_retry_queue(limit=25):
+	"""
+	Retries due ChangeReports from the spool with fresh tokens, rescheduling retryable failures with
+	backoff and dropping reports after RETRY_MAX_ATTEMPTS. Returns the queue depth and age.
+	PT-BR: Reenvia os ChangeReports vencidos da fila com tokens válidos, reagendando falhas temporárias
+	com backoff e descartando reports após RETRY_MAX_ATTEMPTS. Retorna profundidade e idade da fila.
+	"""
+	global _retry_queue_pending
+	if not (queue := get_retry_queue()): return None
+	try:
+		if entries := queue.due(time.time(), limit):
+			tokens = get_user_access_tokens({entry["user_id"] for entry in entries})
+			reports = []
+			for entry in entries:
+				if (token := tokens.get(entry["user_id"])) is None:
+					# PT-BR: Sem token (ex: usuário desvinculou a skill) também conta tentativa, para o report não ficar na fila para sempre.
+					if (attempts := entry["attempts"] + 1) < RETRY_MAX_ATTEMPTS:
+						queue.reschedule(entry, attempts, time.time() + retry_delay(attempts))
+					else:
+						logger.error(f"Dropping ChangeReport for {entry['endpoint_id']} after {attempts} attempts (no user token).")
+						queue.remove(entry)
+					continue
+				entry["payload"]["event"]["endpoint"]["scope"]["token"] = token
+				reports.append((entry, token))
+			results = send_change_reports([(entry["user_id"], entry["endpoint_id"], token, entry["payload"]) for entry, token in reports])
+			for (entry, _), result in zip(reports, results):
+				attempts = entry["attempts"] + 1
+				if result["success"]:
+					queue.remove(entry)
+				elif result["retryable"] and attempts < RETRY_MAX_ATTEMPTS:
+					queue.reschedule(entry, attempts, time.time() + retry_delay(attempts, result.get("retry_after")))
+				else:
+					logger.error(f"Dropping ChangeReport for {entry['endpoint_id']} after {attempts} attempts (status {result['status']}).")
+					queue.remove(entry)
+			logger.info(f"Retry queue drained: {sum(1 for result in results if result['success'])}/{len(entries)} delivered.")
+		stats = queue.stats()
+		_retry_queue_pending = stats["depth"] > 0
+		record_metric("RetryQueueDepth", stats["depth"])
+		if stats["oldest_age_s"] is not None: record_metric("RetryQueueOldestAge", stats["oldest_age_s"], "Seconds")
+		return stats
+	except Exception:
+		logger.exception("Exception draining the retry queue")
+		return None
+
 # ===============================================================================
 # WEBHOOK HANDLER (Home Assistant -> Alexa)
 # ===============================================================================
+def push_state_changes(states, complete=True):
+	"""
+	Sends ChangeReports for a batch of HA state objects to every user that sees each entity.
+	Shared by the webhook (partial states, complete=False, unless the automation marks the payload
+	complete) and the WebSocket bridge. Returns None when no user token is available.
+	PT-BR: Envia ChangeReports de um lote de estados do HA para todos os usuários que enxergam cada entidade.
+	Usado pelo webhook (estados parciais, complete=False, a menos que a automação marque o payload como
+	completo) e pelo bridge WebSocket. Retorna None quando nenhum token de usuário está disponível.
+	"""
+	# PT-BR: Envia rajadas de invocações anteriores cuja janela já terminou (ex: container estava congelado).
+	flush_pending_change_reports()
+	# PT-BR: Se o mesmo endpoint aparece várias vezes no lote, vale o último estado.
+	latest_properties, seen = {}, set()
+	for entity in states:
+		seen.add(entity.get('entity_id'))
+		cache_entity_state(entity, complete)
+		if properties := build_alexa_properties(entity):
+			if latest_properties.pop(entity.get('entity_id'), None) is not None:
+				with _change_report_lock: change_report_stats["coalesced"] += 1
+			latest_properties[entity.get('entity_id')] = properties
+	# PT-BR: Grupos virtuais com algum membro no lote são reavaliados a partir de todos os seus membros.
+	if groups := {group_id for entity_id in seen for group_id in VIRTUAL_GROUP_MEMBERS.get(entity_id, ())}:
+		for group_id, state in get_group_states(sorted(groups)).items():
+			if properties := build_alexa_properties(state): latest_properties[group_id] = properties
+	# PT-BR: Nada a reportar (ex: script, cover sem posição): não há por que buscar rotas nem tokens.
+	if not latest_properties: return []
+
+	# PT-BR: Cada entidade vai para todos os usuários que a enxergam; sem índice, vale o usuário padrão (instalações antigas).
+	routes = get_entity_users(list(latest_properties))
+	if not any(routes.values()) and (default_user_id := _resolve_default_user_id()):
+		routes = {entity_id: {default_user_id} for entity_id in latest_properties}
+	if not (tokens := get_user_access_tokens({user_id for users in routes.values() for user_id in users})):
+		logger.error("User access token is not available for ChangeReport.")
+		return None
+
+	user_properties = {(user_id, entity_id): properties for entity_id, properties in latest_properties.items() for user_id in sorted(routes[entity_id]) if user_id in tokens}
+	return deliver_planned_change_reports(tokens, plan_change_reports(user_properties))
+
+def decode_webhook_body(headers, body, is_base64=False):
+	"""
+	Decodes a webhook body into {"entities": [...]}. Accepts gzip (Content-Encoding or magic bytes), the legacy
+	{"entities": [...]} object, the compact columnar batch {"v": 2, "cols": [...], "rows": [[...]]} and NDJSON
+	(one entity per line). Raises ValueError for malformed or oversized bodies.
+	PT-BR: Decodifica o corpo do webhook em {"entities": [...]}. Aceita gzip (Content-Encoding ou bytes mágicos), o
+	formato antigo {"entities": [...]}, o lote colunar compacto {"v": 2, "cols": [...], "rows": [[...]]} e NDJSON
+	(uma entidade por linha). Lança ValueError para corpos inválidos ou grandes demais.
+	"""
+	data = base64.b64decode(body or '') if is_base64 else (body or '{}').encode('utf-8')
+	if headers.get('content-encoding', '').lower() == 'gzip' or data[:2] == b'\x1f\x8b':
+		# PT-BR: Descompacta com limite de tamanho; o corpo ainda não passou pela verificação de segurança.
+		decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+		try:
+			data = decompressor.decompress(data, WEBHOOK_MAX_BODY_BYTES)
+		except zlib.error as e:
+			raise ValueError(f"invalid gzip body: {e}")
+		if decompressor.unconsumed_tail: raise ValueError("decompressed body exceeds WEBHOOK_MAX_BODY_BYTES")
+	text = data.decode('utf-8')
+	if 'ndjson' in headers.get('content-type', ''):
+		body_dict = {"entities": [json.loads(line) for line in text.splitlines() if line.strip()]}
+	elif not isinstance(body_dict := json.loads(text), dict):
+		raise ValueError("webhook body must be a JSON object")
+	elif 'rows' in body_dict:
+		# PT-BR: Formato colunar: os nomes dos campos vêm uma única vez em 'cols'; nulos são descartados.
+		columns, rows = body_dict.get('cols'), body_dict['rows']
+		if not isinstance(columns, list) or not all(isinstance(column, str) for column in columns): raise ValueError("'cols' must be a list of field names")
+		if not isinstance(rows, list) or not all(isinstance(row, list) and len(row) == len(columns) for row in rows):
+			raise ValueError("'rows' must be a list of rows with one value per column")
+		body_dict = {**body_dict, "entities": [{column: value for column, value in zip(columns, row) if value is not None} for row in rows]}
+	# PT-BR: Valida aqui para que um corpo malformado vire 400, e não um erro no meio do processamento.
+	if not isinstance(entities := body_dict.get('entities') or [], list) or not all(isinstance(entity, dict) for entity in entities):
+		raise ValueError("'entities' must be a list of JSON objects")
+	return body_dict
+
 def handle_change_report(headers, body_dict, source_ip):
 	"""
 	Processes webhooks from Home Assistant to send proactive ChangeReports to Alexa.
@@ -335,23 +1853,53 @@ def handle_change_report(headers, body_dict, source_ip):
 			logger.info("Webhook received with empty entities list.")
 			return {"statusCode": 200, "body": json.dumps({"message": "Empty entities list"})}
 		
-		if not (user_access_token := get_user_access_token()):
-			logger.error("User access token is not available for ChangeReport.")
+		# PT-BR: As automações atuais mandam todos os atributos usados pela Lambda e marcam "complete"; as antigas, não.
+		if (results := push_state_changes(map(normalize_webhook_entity, entities), complete=body_dict.get('complete') is True)) is None:
 			return {"statusCode": 503, "body": json.dumps({"error": "User access token unavailable."})}
-
-		successful_sends = 0
-		for entity in entities:
-			if properties := build_alexa_properties(entity):
-				report = build_change_report_payload(user_access_token, entity.get('entity_id'), properties)
-				if send_to_alexa_gateway(user_access_token, report):
-					successful_sends += 1
-		
-		logger.info(f"ChangeReport processed: {successful_sends}/{len(entities)} successful sends.")
-		return {"statusCode": 200, "body": json.dumps({"successful_sends": successful_sends, "total_entities": len(entities)})}
+		# PT-BR: Com SQS, drenar a cada webhook custaria duas chamadas a mais; o evento agendado e o bridge drenam o resto.
+		retry_queue_stats = drain_retry_queue() if _retry_queue_pending else None
+		successful_sends = sum(1 for result in results if result['success'])
+		logger.info(f"ChangeReport processed: {successful_sends}/{len(entities)} successful sends, stats={change_report_stats}.")
+		# PT-BR: O user_id é o token de vinculação do usuário e não deve sair na resposta.
+		results = [{key: value for key, value in result.items() if key != 'user_id'} for result in results]
+		return {"statusCode": 200, "body": json.dumps({"successful_sends": successful_sends, "total_entities": len(entities), "results": results, "stats": change_report_stats, "state_cache": state_cache_stats, "retry_queue": retry_queue_stats, "ha_circuit": ha_circuit.snapshot()})}
 	except Exception:
 		logger.exception("FATAL ERROR in handle_change_report")
 		return {"statusCode": 500, "body": json.dumps({"error": "Internal server error."})}
 
+def sync_discovery_changes():
+	"""
+	Re-reads the discovery endpoints from HA unless the index is still fresh, and publishes what changed
+	since the last baseline to the routed users. Returns the publish summary, or None when it failed.
+	PT-BR: Relê os endpoints da descoberta do HA, a menos que o índice ainda esteja recente, e publica o
+	que mudou desde a última referência para os usuários roteados. Retorna o resumo, ou None se falhou.
+	"""
+	try:
+		# PT-BR: Num container frio o índice está vazio; publicar sem reler apagaria todos os dispositivos.
+		if cached_discovery_endpoints() is None: refresh_discovery_index()
+		return publish_discovery_changes()
+	except Exception:
+		logger.exception("Exception publishing discovery changes")
+		return None
+
+def handle_scheduled_event(event):
+	"""
+	Handles the EventBridge timer: refreshes tokens ahead of expiry, so no request waits on Login with
+	Amazon, drains the retry queue and publishes discovery changes to the linked users.
+	PT-BR: Trata o agendamento do EventBridge: renova os tokens antes de expirarem, para que nenhuma
+	requisição espere o Login with Amazon, drena a fila de reenvio e publica as mudanças da descoberta
+	para os usuários vinculados.
+	"""
+	try:
+		token_stats = refresh_expiring_tokens()
+		retry_queue_stats = drain_retry_queue()
+		discovery_stats = sync_discovery_changes()
+		logger.info(f"Scheduled maintenance done: tokens={token_stats}, retry_queue={retry_queue_stats}, discovery={discovery_stats}.")
+		return {"statusCode": 200, "body": json.dumps({"tokens": token_stats, "retry_queue": retry_queue_stats, "discovery": discovery_stats})}
+	except Exception:
+		logger.exception("FATAL ERROR in handle_scheduled_event")
+		return {"statusCode": 500, "body": json.dumps({"error": "Internal server error."})}
+
 # ===============================================================================
 # HELPER AND LOGIC FUNCTIONS
 # ===============================================================================
@@ -380,6 +1928,24 @@ DEVICE_CAPABILITIES = {
 	}
 }
 
+def _build_capability_templates():
+	"""
+	Precomputes, per domain, the Alexa capability objects and their optional HA checks, once at import.
+	PT-BR: Pré-calcula, por domínio, os objetos de capacidade da Alexa e suas checagens opcionais no HA, uma vez na importação.
+	"""
+	templates = {}
+	for domain, domain_map in DEVICE_CAPABILITIES.items():
+		capabilities = []
+		for cap_data in domain_map.get("capabilities", {}).values():
+			alexa_cap = {"type": "AlexaInterface", "version": "3", **cap_data}
+			capabilities.append((alexa_cap.pop("ha_check", None), alexa_cap))
+		templates[domain] = (domain_map["display_categories"], capabilities)
+	return templates
+
+# PT-BR: Os objetos de capacidade são compartilhados entre endpoints e devem ser tratados como somente leitura.
+CAPABILITY_TEMPLATES = _build_capability_templates()
+BASE_ALEXA_CAPABILITY = {"type": "AlexaInterface", "interface": "Alexa", "version": "3"}
+
 def build_discovery_endpoint(state):
 	"""
 	Builds an Alexa discovery endpoint using the centralized capability map.
@@ -393,22 +1959,15 @@ def build_discovery_endpoint(state):
 	if not entity_id: return None
 	
 	domain = entity_id.split('.')[0]
-	if domain not in DEVICE_CAPABILITIES: return None
-
-	domain_map = DEVICE_CAPABILITIES[domain]
-	alexa_capabilities = [{"type": "AlexaInterface", "interface": "Alexa", "version": "3"}]
+	if domain not in CAPABILITY_TEMPLATES: return None
 
-	for cap_key, cap_data in domain_map.get("capabilities", {}).items():
-		if "ha_check" in cap_data and not cap_data["ha_check"](attributes):
-			continue
-		
-		alexa_cap = {"type": "AlexaInterface", "version": "3", **cap_data}
-		alexa_cap.pop("ha_check", None)
-		alexa_capabilities.append(alexa_cap)
+	display_categories, templates = CAPABILITY_TEMPLATES[domain]
+	alexa_capabilities = [BASE_ALEXA_CAPABILITY]
+	alexa_capabilities.extend(alexa_cap for ha_check, alexa_cap in templates if not ha_check or ha_check(attributes))
 
 	if len(alexa_capabilities) <= 1: return None
 
-	return {"endpointId": entity_id, "manufacturerName": "Home Assistant", "friendlyName": attributes.get('friendly_name', entity_id), "description": f"{domain} via HA", "displayCategories": domain_map["display_categories"], "capabilities": alexa_capabilities}
+	return {"endpointId": entity_id, "manufacturerName": "Home Assistant", "friendlyName": attributes.get('friendly_name', entity_id), "description": f"{domain} via HA", "displayCategories": display_categories, "capabilities": alexa_capabilities}
 
 def build_control_response(event, prop_name=None, prop_value=None, instance=None):
 	"""
@@ -463,23 +2022,55 @@ def build_change_report_payload(token, entity_id, properties):
 	Builds the full ChangeReport payload.
 	PT-BR: Monta o payload completo do ChangeReport.
 	"""
-	return {"event": {"header": {"namespace": "Alexa", "name": "ChangeReport", "payloadVersion": "3", "messageId": f"cr-{int(time.time()*1000)}"},
+	return {"event": {"header": {"namespace": "Alexa", "name": "ChangeReport", "payloadVersion": "3", "messageId": f"cr-{uuid.uuid4()}"},
 			"endpoint": {"scope": {"type": "BearerToken", "token": token}, "endpointId": entity_id},
 			"payload": {"change": {"cause": {"type": "PHYSICAL_INTERACTION"}, "properties": properties}}}}
 
-def send_to_alexa_gateway(token, payload):
+def deliver_to_alexa_gateway(token, payload):
 	"""
-	Sends a payload to the Alexa Event Gateway.
-	PT-BR: Envia dados para o Alexa Event Gateway.
+	Sends a payload to the Alexa Event Gateway over a pooled keep-alive connection and
+	returns a result dict with the HTTP status, success flag and latency.
+	PT-BR: Envia dados para o Alexa Event Gateway por uma conexão keep-alive do pool e
+	retorna um dict com o status HTTP, o sucesso e a latência.
 	"""
+	start = time.perf_counter()
+	result = {"success": False, "status": None}
 	try:
 		data = json.dumps(payload).encode('utf-8')
-		req = urllib.request.Request("https://api.amazonalexa.com/v3/events", data=data, method='POST', headers={'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'})
-		with urllib.request.urlopen(req, timeout=8) as response:
-			return response.status == 202
+		with timed_stage("AlexaGateway", Event=payload["event"]["header"]["name"]) as timer:
+			status, response_headers, body = get_connection_pool(ALEXA_GATEWAY_URL).request('POST', f"{urllib.parse.urlsplit(ALEXA_GATEWAY_URL).path.rstrip('/')}/v3/events", body=data, headers={'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}, timeout=8)
+			if status != 202: timer.set_outcome(f"http_{status}")
+		result.update(success=status == 202, status=status)
+		if status != 202:
+			logger.error(f"Alexa Gateway returned status {status}: {body[:200]}")
+			if (retry_after := response_headers.get('retry-after', '')).isdigit(): result["retry_after"] = int(retry_after)
 	except Exception:
 		logger.exception("Exception sending to Alexa Gateway")
-		return False
+	# PT-BR: Timeouts/erros de conexão (sem status), 429 e 5xx são temporários e podem ser reenviados.
+	result["retryable"] = not result["success"] and (result["status"] is None or result["status"] == 429 or result["status"] >= 500)
+	result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+	return result
+
+def send_to_alexa_gateway(token, payload):
+	"""
+	Sends a payload to the Alexa Event Gateway.
+	PT-BR: Envia dados para o Alexa Event Gateway.
+	"""
+	return deliver_to_alexa_gateway(token, payload)["success"]
+
+def send_change_reports(reports):
+	"""
+	Delivers a batch of (user_id, entity_id, token, payload) ChangeReports in parallel over the
+	bounded gateway worker pool and returns one result per report, in the original order.
+	PT-BR: Envia um lote de ChangeReports (user_id, entity_id, token, payload) em paralelo pelo pool
+	limitado de workers e retorna um resultado por report, na ordem original.
+	"""
+	if len(reports) <= 1:
+		return [{"user_id": user_id, "entity_id": entity_id, **deliver_to_alexa_gateway(token, payload)} for user_id, entity_id, token, payload in reports]
+	executor = _get_gateway_executor()
+	# PT-BR: Cada envio roda numa cópia do contexto atual para que as métricas cheguem ao coletor da requisição.
+	futures = [(user_id, entity_id, executor.submit(contextvars.copy_context().run, deliver_to_alexa_gateway, token, payload)) for user_id, entity_id, token, payload in reports]
+	return [{"user_id": user_id, "entity_id": entity_id, **future.result()} for user_id, entity_id, future in futures]
 
 def create_error_response(event, error_type, message):
 	"""
@@ -491,53 +2082,593 @@ def create_error_response(event, error_type, message):
 	return {"event": {"header": {"namespace": "Alexa", "name": "ErrorResponse", "payloadVersion": "3", "messageId": f"{header.get('messageId', 'err')}-R", "correlationToken": header.get('correlationToken')},
 			"endpoint": event.get('directive', {}).get('endpoint'), "payload": {"type": error_type, "message": message}}}
 
+# ===============================================================================
+# ⏳ DEFERRED RESPONSES (slow Home Assistant service calls)
+# ===============================================================================
+# PT-BR: Namespaces que não são diretivas de controle (ReportState, descoberta e vinculação).
+NON_CONTROL_NAMESPACES = ("Alexa", "Alexa.Discovery", "Alexa.Authorization")
+
+def should_defer_directive(event):
+	"""
+	Tells whether a control directive must be answered with a DeferredResponse (DEFERRED_RESPONSE_DOMAINS).
+	PT-BR: Indica se uma diretiva de controle deve ser respondida com DeferredResponse (DEFERRED_RESPONSE_DOMAINS).
+	"""
+	directive = event.get('directive', {})
+	if not DEFERRED_RESPONSE_DOMAINS or directive.get('header', {}).get('namespace') in NON_CONTROL_NAMESPACES: return False
+	entity_id = directive.get('endpoint', {}).get('endpointId') or ''
+	return '*' in DEFERRED_RESPONSE_DOMAINS or entity_id.split('.')[0] in DEFERRED_RESPONSE_DOMAINS
+
+def resolve_directive_user(directive):
+	"""
+	Returns the user_id of a directive: its scope token, when that token is a user_id stored by AcceptGrant.
+	PT-BR: Retorna o user_id de uma diretiva: o token do escopo, quando ele é um user_id gravado pelo AcceptGrant.
+	"""
+	if not (user_id := directive.get('endpoint', {}).get('scope', {}).get('token')): return None
+	if user_id in _token_cache or ((item := get_token_store().get(user_id)) and 'refresh_token' in item): return user_id
+	return None
+
+def defer_directive(event, context):
+	"""
+	Starts the directive asynchronously and returns the DeferredResponse, or None when it could not be
+	started (the caller then handles it synchronously). The final Response goes to the user the directive
+	belongs to, so a directive whose user cannot be resolved is not deferred. On Lambda the function
+	invokes itself with InvocationType 'Event'; self-hosted, the work runs on a background thread.
+	PT-BR: Inicia a diretiva de forma assíncrona e retorna o DeferredResponse, ou None quando não foi
+	possível iniciar (quem chamou então a trata de forma síncrona). O Response final vai para o usuário
+	dono da diretiva, então uma diretiva cujo usuário não é identificado não é adiada. Na Lambda a função
+	invoca a si mesma com InvocationType 'Event'; fora dela, o trabalho roda numa thread em segundo plano.
+	"""
+	try:
+		if not (user_id := resolve_directive_user(event['directive'])):
+			logger.warning(f"Directive scope token is not a linked user, answering {event['directive'].get('endpoint', {}).get('endpointId')} synchronously.")
+			return None
+		deferred = {"deferredDirective": event['directive'], "userId": user_id}
+		if function_arn := getattr(context, 'invoked_function_arn', None):
+			with timed_stage("Lambda", Operation="InvokeAsync"):
+				get_aws_client('lambda').invoke(FunctionName=function_arn, InvocationType='Event', Payload=json.dumps(deferred).encode('utf-8'))
+		else:
+			# PT-BR: A thread não herda o contexto da requisição, então não escreve no coletor de métricas já enviado.
+			threading.Thread(target=complete_deferred_directive, args=(deferred,), daemon=True).start()
+	except Exception:
+		logger.exception("Failed to start deferred directive, answering synchronously")
+		return None
+	header = event['directive'].get('header', {})
+	return {"event": {"header": {"namespace": "Alexa", "name": "DeferredResponse", "payloadVersion": "3", "messageId": f"{header.get('messageId', 'msg')}-D", "correlationToken": header.get('correlationToken')}, "payload": {"estimatedDeferralInSeconds": DEFERRED_RESPONSE_SECONDS}}}
+
+# PT-BR: Intervalo (s) entre leituras enquanto a persiana de uma diretiva adiada ainda se move.
+DEFERRED_STATE_POLL_INTERVAL = 1
+
+def _property_key(prop):
+	return prop.get('namespace'), prop.get('instance'), prop.get('name')
+
+def read_settled_state(entity_id, deadline):
+	"""
+	Reads an entity (or virtual group) from HA, polling while a cover is still opening or closing until
+	it stops or the deadline (time.monotonic()) passes, and returns the last state read.
+	PT-BR: Lê uma entidade (ou grupo virtual) do HA, repetindo a leitura enquanto uma persiana ainda
+	abre ou fecha, até parar ou o prazo (time.monotonic()) passar, e retorna o último estado lido.
+	"""
+	while True:
+		if entity_id in VIRTUAL_GROUPS: state = get_group_states([entity_id]).get(entity_id)
+		else: state = _call_ha_api(f"states/{entity_id}")
+		if not state or state.get('state') not in MOVING_STATES or time.monotonic() + DEFERRED_STATE_POLL_INTERVAL >= deadline: break
+		invalidate_entity_state(entity_id)
+		time.sleep(DEFERRED_STATE_POLL_INTERVAL)
+	if state and entity_id not in VIRTUAL_GROUPS and state.get('state') not in MOVING_STATES: cache_entity_state(state)
+	return state
+
+def complete_deferred_directive(event):
+	"""
+	Runs a deferred directive: calls its handler, confirms the resulting state with a fresh read from HA
+	and delivers the final Response or ErrorResponse to the Alexa Event Gateway with the original
+	correlation token.
+	PT-BR: Executa uma diretiva adiada: chama o handler, confirma o estado resultante com uma nova leitura
+	do HA e entrega o Response ou ErrorResponse final ao Alexa Event Gateway com o correlation token original.
+	"""
+	directive = event['deferredDirective']
+	header, endpoint = directive.get('header', {}), directive.get('endpoint', {})
+	# PT-BR: Sem o usuário da diretiva não há para quem entregar o Response; nunca cai no usuário padrão.
+	if not (user_id := event.get('userId') or resolve_directive_user(directive)):
+		logger.error(f"Deferred directive for {endpoint.get('endpointId')} has no linked user, dropping it.")
+		return {"success": False, "status": None}
+	handler = HANDLER_MAP.get(header.get('namespace'))
+	if isinstance(handler, dict): handler = handler.get(header.get('name'))
+	response = handler({"directive": directive}) if handler else create_error_response({"directive": directive}, "INVALID_DIRECTIVE", "Unsupported deferred directive.")
+	entity_id = endpoint.get('endpointId')
+	invalidate_entity_state(entity_id)
+
+	if response['event']['header']['name'] != 'ErrorResponse':
+		state = read_settled_state(entity_id, time.monotonic() + DEFERRED_RESPONSE_SECONDS)
+		# PT-BR: A propriedade da própria diretiva (o valor pedido) prevalece; a leitura nova completa as demais.
+		own = {_property_key(prop): prop for prop in response.get('context', {}).get('properties', [])}
+		if state and (properties := [prop for prop in build_alexa_properties(state) if _property_key(prop) not in own] + list(own.values())):
+			response["context"] = {"properties": properties}
+
+	if not (token := get_user_access_token(user_id)):
+		logger.error(f"No user token to deliver the deferred response for {endpoint.get('endpointId')}.")
+		return {"success": False, "status": None}
+	response['event']['header']['messageId'] = str(uuid.uuid4())
+	response['event']['endpoint'] = {**endpoint, "scope": {"type": "BearerToken", "token": token}}
+	result = deliver_to_alexa_gateway(token, response)
+	logger.info(f"Deferred {header.get('namespace')}.{header.get('name')} for {endpoint.get('endpointId')} delivered: {result}.")
+	return result
+
 # ===============================================================================
 # MAIN LAMBDA HANDLER AND ROUTER
 # ===============================================================================
+# PT-BR: Tabela de despacho montada uma única vez na importação, e não a cada invocação.
+HANDLER_MAP = {
+	"Alexa.Authorization": handle_accept_grant,
+	"Alexa.Discovery": handle_discovery,
+	"Alexa": {"ReportState": handle_report_state},
+	"Alexa.PowerController": handle_power_control,
+	"Alexa.BrightnessController": handle_brightness_control,
+	"Alexa.ColorController": handle_color_control,
+	"Alexa.ColorTemperatureController": handle_color_temperature_control,
+	"Alexa.RangeController": handle_range_control,
+	"Alexa.ModeController": handle_mode_control,
+	"Alexa.SceneController": handle_script_activate
+}
+
+def is_scheduled_event(event):
+	"""
+	Recognizes an EventBridge (CloudWatch Events) scheduled rule invocation.
+	PT-BR: Reconhece uma invocação de regra agendada do EventBridge (CloudWatch Events).
+	"""
+	return event.get('source') == 'aws.events' or event.get('detail-type') == 'Scheduled Event'
+
 def lambda_handler(event, context):
 	"""
 	Main entry point that routes requests from Alexa and Home Assistant webhooks.
 	PT-BR: Ponto de entrada principal que roteia requisições da Alexa e de webhooks do HA.
 	"""
 	logger.info("Lambda invoked.")
+	if not METRICS_ENABLED:
+		return route_event(event, context)
+
+	header = (event.get('directive') or event.get('deferredDirective') or {}).get('header', {})
+	if header: dimensions = {"Namespace": header.get('namespace'), "Name": header.get('name')}
+	elif is_scheduled_event(event): dimensions = {"Namespace": "Scheduled", "Name": "TokenRefresh"}
+	else: dimensions = {"Namespace": "Webhook", "Name": "ChangeReport"}
+	collector = MetricsCollector(dimensions, traced=random.random() < TRACE_SAMPLE_RATE)
+	token = _metrics_collector.set(collector)
+	try:
+		with timed_stage("Request") as timer:
+			response = route_event(event, context)
+			if response.get('statusCode', 200) >= 400 or response.get('event', {}).get('header', {}).get('name') == 'ErrorResponse':
+				timer.set_outcome("error")
+		record_metric("HomeAssistantCircuitOpen", int(ha_circuit.state != CircuitBreaker.CLOSED))
+		return response
+	finally:
+		_metrics_collector.reset(token)
+		collector.flush()
 
+def route_event(event, context):
+	"""
+	Routes an Alexa directive or an HA webhook to its handler.
+	PT-BR: Encaminha uma diretiva da Alexa ou um webhook do HA para o seu handler.
+	"""
 	if 'directive' in event:
 		header = event.get('directive', {}).get('header', {})
 		namespace = header.get('namespace')
 		name = header.get('name')
 		
-		handler_map = {
-			"Alexa.Authorization": handle_accept_grant,
-			"Alexa.Discovery": handle_discovery,
-			"Alexa": {"ReportState": handle_report_state},
-			"Alexa.PowerController": handle_power_control,
-			"Alexa.BrightnessController": handle_brightness_control,
-			"Alexa.ColorController": handle_color_control,
-			"Alexa.ColorTemperatureController": handle_color_temperature_control,
-			"Alexa.RangeController": handle_range_control,
-			"Alexa.ModeController": handle_mode_control,
-			"Alexa.SceneController": handle_script_activate
-		}
-
-		handler = handler_map.get(namespace)
+		handler = HANDLER_MAP.get(namespace)
 		if isinstance(handler, dict): handler = handler.get(name)
 
+		# PT-BR: Diretivas de controle mudam o dispositivo; o estado em cache deixa de ser confiável.
+		if namespace not in NON_CONTROL_NAMESPACES:
+			invalidate_entity_state(event.get('directive', {}).get('endpoint', {}).get('endpointId'))
+
+		# PT-BR: Com o HA inacessível, diretivas de controle falham na hora em vez de esperar o timeout.
+		if handler and namespace not in NON_CONTROL_NAMESPACES and ha_circuit.rejecting():
+			return create_error_response(event, "BRIDGE_UNREACHABLE", "Home Assistant is unreachable.")
+
 		if handler:
+			if should_defer_directive(event) and (deferred := defer_directive(event, context)): return deferred
 			return handler(event)
 		
 		return create_error_response(event, "INVALID_DIRECTIVE", f"The directive {namespace}.{name} is not supported.")
 
+	if 'deferredDirective' in event:
+		return complete_deferred_directive(event)
+
+	if is_scheduled_event(event):
+		return handle_scheduled_event(event)
+
 	if event.get('requestContext', {}).get('http', {}).get('method') == 'POST':
 		source_ip = event.get('requestContext', {}).get('http', {}).get('sourceIp', 'unknown_ip')
 		headers = event.get('headers', {})
-		body_str = base64.b64decode(event['body']).decode('utf-8') if event.get('isBase64Encoded') else event.get('body', '{}')
 		try:
-			body_dict = json.loads(body_str)
-		except json.JSONDecodeError:
-			logger.error(f"Invalid JSON received in webhook body: {body_str[:200]}")
+			body_dict = decode_webhook_body(headers, event.get('body'), event.get('isBase64Encoded', False))
+		except ValueError as e:
+			# PT-BR: json.JSONDecodeError e UnicodeDecodeError também são ValueError.
+			logger.error(f"Invalid webhook body received: {e}")
 			return {"statusCode": 400, "body": json.dumps({"error": "Invalid JSON format."})}
 			
 		return handle_change_report(headers=headers, body_dict=body_dict, source_ip=source_ip)
 
 	logger.warning(f"Unrecognized event received: {json.dumps(event, default=str)[:300]}")
 	return {"statusCode": 400, "body": json.dumps({"error": "Unrecognized request format."})}
+
+# ===============================================================================
+# 🌉 WEBSOCKET BRIDGE (python lambda.py bridge)
+# ===============================================================================
+# PT-BR: asyncio e hashlib só são importados no modo bridge, para não pesar no cold start da Lambda.
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+def _websocket_mask(data, mask):
+	if not data: return b''
+	repeated = (mask * (len(data) // 4 + 1))[:len(data)]
+	return (int.from_bytes(data, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(len(data), 'big')
+
+class HAWebSocket:
+	"""
+	Minimal RFC 6455 client on asyncio streams, enough for the HA WebSocket API (JSON text frames, ping/pong, close).
+	PT-BR: Cliente RFC 6455 mínimo sobre streams do asyncio, suficiente para a API WebSocket do HA (JSON, ping/pong, close).
+	"""
+	def __init__(self, reader, writer):
+		self._reader, self._writer = reader, writer
+
+	@classmethod
+	async def connect(cls, url):
+		import asyncio, hashlib, ssl
+		parsed = urllib.parse.urlsplit(url)
+		secure = parsed.scheme in ('https', 'wss')
+		reader, writer = await asyncio.open_connection(parsed.hostname, parsed.port or (443 if secure else 80), ssl=ssl.create_default_context() if secure else None)
+		key = base64.b64encode(os.urandom(16)).decode()
+		writer.write((f"GET {parsed.path.rstrip('/')}/api/websocket HTTP/1.1\r\nHost: {parsed.netloc}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+			f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+		await writer.drain()
+		status, headers = await reader.readline(), {}
+		while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+			name, _, value = line.decode('latin-1').partition(':')
+			headers[name.strip().lower()] = value.strip()
+		expected = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+		if status.split(b' ')[1:2] != [b'101'] or headers.get('sec-websocket-accept') != expected:
+			writer.close()
+			raise ConnectionError(f"WebSocket handshake failed: {status.decode('latin-1').strip()}")
+		return cls(reader, writer)
+
+	async def _send_frame(self, opcode, data):
+		length = len(data)
+		if length < 126: header = bytes([0x80 | opcode, 0x80 | length])
+		elif length < 65536: header = bytes([0x80 | opcode, 0x80 | 126]) + length.to_bytes(2, 'big')
+		else: header = bytes([0x80 | opcode, 0x80 | 127]) + length.to_bytes(8, 'big')
+		# PT-BR: Frames do cliente são sempre mascarados (RFC 6455 5.3).
+		mask = os.urandom(4)
+		self._writer.write(header + mask + _websocket_mask(data, mask))
+		await self._writer.drain()
+
+	async def send_json(self, message):
+		await self._send_frame(0x1, json.dumps(message).encode())
+
+	async def receive_json(self, timeout=None):
+		"""
+		Reads the next JSON message. The timeout only covers the wait for a message to start: once a frame
+		header arrives the rest is read without it, so a timeout never leaves a frame half consumed.
+		PT-BR: Lê a próxima mensagem JSON. O timeout só vale para a espera do início da mensagem: depois que
+		o cabeçalho de um frame chega, o resto é lido sem ele, então um timeout nunca deixa um frame pela metade.
+		"""
+		import asyncio
+		message = bytearray()
+		while True:
+			header = self._reader.readexactly(2)
+			# PT-BR: readexactly só consome o buffer quando os 2 bytes chegam, então cancelar aqui não perde dados.
+			first, second = await (asyncio.wait_for(header, timeout) if timeout and not message else header)
+			opcode, length = first & 0x0F, second & 0x7F
+			if length == 126: length = int.from_bytes(await self._reader.readexactly(2), 'big')
+			elif length == 127: length = int.from_bytes(await self._reader.readexactly(8), 'big')
+			mask = await self._reader.readexactly(4) if second & 0x80 else None
+			data = await self._reader.readexactly(length)
+			if mask: data = _websocket_mask(data, mask)
+			if opcode == 0x8: raise ConnectionError("WebSocket closed by Home Assistant")
+			if opcode == 0x9: await self._send_frame(0xA, data)
+			if opcode in (0x9, 0xA): continue
+			message += data
+			if first & 0x80: return json.loads(message)
+
+	def close(self):
+		self._writer.close()
+
+def discovered_entity_ids():
+	"""
+	Refreshes the discovery index, publishes its changes to Alexa and returns the HA entity_ids to
+	watch (virtual groups are replaced by their members).
+	PT-BR: Atualiza o índice de descoberta, publica as mudanças para a Alexa e retorna os entity_ids do
+	HA a observar (grupos virtuais são trocados pelos seus membros).
+	"""
+	endpoints = refresh_discovery_index()
+	try:
+		publish_discovery_changes()
+	except Exception:
+		logger.exception("Exception publishing discovery changes")
+	entity_ids = {endpoint['endpointId'] for endpoint in endpoints}
+	for group_id in entity_ids & VIRTUAL_GROUPS.keys():
+		entity_ids.discard(group_id)
+		entity_ids.update(VIRTUAL_GROUPS[group_id]["entities"])
+	return entity_ids
+
+class HomeAssistantBridge:
+	"""
+	Long-running process that subscribes to state changes of the discovered entities over the HA
+	WebSocket API and pushes ChangeReports continuously, replacing the webhook automation.
+	PT-BR: Processo contínuo que assina as mudanças de estado das entidades descobertas pela API
+	WebSocket do HA e envia ChangeReports continuamente, substituindo a automação do webhook.
+	"""
+	def __init__(self):
+		self._pending = {}
+		self._message_id = 0
+		self.stats = {"events": 0, "pushes": 0, "reconnects": 0}
+
+	def _next_id(self):
+		self._message_id += 1
+		return self._message_id
+
+	async def run(self):
+		import asyncio
+		self._wakeup = asyncio.Event()
+		pusher = asyncio.create_task(self._pusher())
+		backoff = 1
+		try:
+			while True:
+				try:
+					await self._session()
+				except (OSError, EOFError, ValueError, asyncio.TimeoutError) as e:
+					logger.warning(f"Bridge disconnected ({e!r}), reconnecting in {backoff}s.")
+				# PT-BR: O backoff volta a 1s quando a sessão autenticou (ver _session).
+				await asyncio.sleep(backoff)
+				backoff = 1 if self._authenticated else min(backoff * 2, 60)
+				self.stats["reconnects"] += 1
+		finally:
+			pusher.cancel()
+
+	async def _session(self):
+		import asyncio
+		loop = asyncio.get_running_loop()
+		self._authenticated = False
+		websocket = await HAWebSocket.connect(HA_URL)
+		try:
+			if (message := await websocket.receive_json()).get('type') == 'auth_required':
+				await websocket.send_json({"type": "auth", "access_token": HA_TOKEN})
+				message = await websocket.receive_json()
+			if message.get('type') != 'auth_ok': raise PermissionError(f"Home Assistant rejected the token: {message.get('message')}")
+			self._authenticated = True
+
+			subscription, entity_ids, refreshed_at = None, set(), 0.0
+			while True:
+				if time.monotonic() - refreshed_at >= BRIDGE_DISCOVERY_INTERVAL:
+					refreshed_at = time.monotonic()
+					if (latest := await loop.run_in_executor(None, discovered_entity_ids)) != entity_ids:
+						# PT-BR: Assina a nova lista antes de cancelar a anterior; eventos duplicados são descartados pela deduplicação.
+						previous, subscription, entity_ids = subscription, self._next_id(), latest
+						await websocket.send_json({"id": subscription, "type": "subscribe_trigger", "trigger": {"platform": "state", "entity_id": sorted(entity_ids)}})
+						if previous: await websocket.send_json({"id": self._next_id(), "type": "unsubscribe_events", "subscription": previous})
+						logger.info(f"Bridge subscribed to {len(entity_ids)} entities.")
+				try:
+					message = await websocket.receive_json(timeout=30)
+				except asyncio.TimeoutError:
+					# PT-BR: Sem eventos por 30s: um ping do HA confirma que a conexão continua viva; sem resposta, reconecta.
+					await websocket.send_json({"id": self._next_id(), "type": "ping"})
+					message = await websocket.receive_json(timeout=30)
+				if message.get('type') == 'result' and not message.get('success'):
+					raise ValueError(f"Home Assistant error: {message.get('error')}")
+				if message.get('type') == 'event' and message.get('id') == subscription:
+					trigger = message['event'].get('variables', {}).get('trigger', {})
+					if (entity_id := trigger.get('entity_id')) in entity_ids:
+						# PT-BR: to_state None indica que a entidade foi removida do HA.
+						self.stats["events"] += 1
+						self._pending[entity_id] = trigger.get('to_state')
+						self._wakeup.set()
+		finally:
+			websocket.close()
+
+	async def _pusher(self):
+		"""
+		Sends pending states in batches, one batch at a time so reports for an entity stay in order.
+		PT-BR: Envia os estados pendentes em lotes, um lote por vez para manter a ordem dos reports de cada entidade.
+		"""
+		import asyncio
+		loop = asyncio.get_running_loop()
+		while True:
+			await self._wakeup.wait()
+			await asyncio.sleep(BRIDGE_BATCH_MS / 1000.0)
+			self._wakeup.clear()
+			states, self._pending = list(self._pending.items()), {}
+			try:
+				await loop.run_in_executor(None, self._push, states)
+			except Exception:
+				logger.exception("Exception pushing bridge ChangeReports")
+
+	def _push(self, states):
+		removed = [entity_id for entity_id, state in states if state is None]
+		states = [state for _, state in states if state is not None]
+		if changed := update_discovery_index(states, removed):
+			try:
+				publish_discovery_changes(changed)
+			except Exception:
+				logger.exception("Exception publishing discovery changes")
+		results = push_state_changes(states) or []
+		drain_retry_queue()
+		self.stats["pushes"] += 1
+		logger.info(f"Bridge pushed {sum(1 for result in results if result['success'])}/{len(states)} ChangeReports, stats={self.stats}.")
+
+def run_bridge():
+	"""
+	Entry point of the bridge mode: runs until interrupted.
+	PT-BR: Ponto de entrada do modo bridge: roda até ser interrompido.
+	"""
+	import asyncio
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+	try:
+		asyncio.run(HomeAssistantBridge().run())
+	except KeyboardInterrupt:
+		logger.info("Bridge stopped.")
+
+# ===============================================================================
+# 🖥️ SELF-HOSTED HTTP SERVER (python lambda.py serve)
+# ===============================================================================
+class AlexaHTTPServer:
+	"""
+	Minimal HTTP/1.1 server on asyncio streams that feeds Alexa directives (POST /alexa) and HA
+	webhooks (POST /webhook) to lambda_handler on a thread pool. Every request shares the module
+	caches (tokens, states, discovery index, connection pools) of this single process.
+	PT-BR: Servidor HTTP/1.1 mínimo sobre streams do asyncio que entrega diretivas da Alexa (POST /alexa)
+	e webhooks do HA (POST /webhook) ao lambda_handler num pool de threads. Todas as requisições
+	compartilham os caches do módulo (tokens, estados, índice de descoberta, pools de conexão) deste processo.
+	"""
+	def __init__(self, host=None, port=None):
+		self.host, self.port = host or SERVER_HOST, SERVER_PORT if port is None else port
+		self._connections = set()
+		self._inflight = 0
+		self.stats = {"requests": 0, "errors": 0}
+
+	async def run(self):
+		import asyncio, signal
+		loop = asyncio.get_running_loop()
+		self._stopping = asyncio.Event()
+		self._executor = ThreadPoolExecutor(max_workers=SERVER_MAX_WORKERS, thread_name_prefix='http-server')
+		for sig in (signal.SIGINT, signal.SIGTERM):
+			# PT-BR: Sem suporte a sinais no loop (ex: Windows), o Ctrl+C encerra pelo KeyboardInterrupt em run_server.
+			with contextlib.suppress(NotImplementedError, RuntimeError): loop.add_signal_handler(sig, self._stopping.set)
+		server = await asyncio.start_server(self._serve_connection, self.host, self.port)
+		self.port = server.sockets[0].getsockname()[1]
+		maintenance = asyncio.create_task(self._maintenance()) if SERVER_MAINTENANCE_INTERVAL > 0 else None
+		logger.info(f"HTTP server listening on {self.host}:{self.port}.")
+		try:
+			await self._stopping.wait()
+		finally:
+			await self._shutdown(server, maintenance)
+
+	def stop(self):
+		self._stopping.set()
+
+	async def _shutdown(self, server, maintenance):
+		"""
+		Stops accepting connections, lets in-flight requests finish (up to SERVER_SHUTDOWN_TIMEOUT),
+		closes idle keep-alive connections and flushes coalesced ChangeReports still waiting for their window.
+		PT-BR: Para de aceitar conexões, deixa as requisições em andamento terminarem (até SERVER_SHUTDOWN_TIMEOUT),
+		fecha conexões keep-alive ociosas e envia os ChangeReports agrupados que ainda aguardam a janela.
+		"""
+		import asyncio
+		loop = asyncio.get_running_loop()
+		logger.info(f"HTTP server stopping, waiting for {self._inflight} in-flight requests.")
+		server.close()
+		if maintenance: maintenance.cancel()
+		deadline = loop.time() + SERVER_SHUTDOWN_TIMEOUT
+		while self._inflight and loop.time() < deadline: await asyncio.sleep(0.05)
+		for writer in list(self._connections): writer.close()
+		with contextlib.suppress(asyncio.TimeoutError): await asyncio.wait_for(server.wait_closed(), timeout=1)
+		await asyncio.sleep(CHANGE_REPORT_COALESCE_MS / 1000.0)
+		try:
+			await loop.run_in_executor(self._executor, flush_pending_change_reports)
+		except Exception:
+			logger.exception("Exception flushing pending ChangeReports on shutdown")
+		self._executor.shutdown(wait=True)
+		logger.info(f"HTTP server stopped, stats={self.stats}.")
+
+	async def _maintenance(self):
+		"""
+		Runs the scheduled maintenance (token refresh ahead of expiry, retry queue) in-process, in place of the EventBridge rule.
+		PT-BR: Roda a manutenção agendada (renovação antecipada de tokens, fila de reenvio) no próprio processo, no lugar da regra do EventBridge.
+		"""
+		import asyncio
+		loop = asyncio.get_running_loop()
+		while True:
+			await loop.run_in_executor(self._executor, handle_scheduled_event, {})
+			await asyncio.sleep(SERVER_MAINTENANCE_INTERVAL)
+
+	async def _serve_connection(self, reader, writer):
+		import asyncio
+		self._connections.add(writer)
+		source_ip = (writer.get_extra_info('peername') or ('unknown_ip',))[0]
+		try:
+			while not self._stopping.is_set():
+				try:
+					request_line = await asyncio.wait_for(reader.readline(), timeout=SERVER_KEEPALIVE_TIMEOUT)
+				except asyncio.TimeoutError:
+					break
+				if not request_line.strip(): break
+				method, target, version = request_line.decode('latin-1').split()
+				headers = {}
+				while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+					name, _, value = line.decode('latin-1').partition(':')
+					headers[name.strip().lower()] = value.strip()
+				keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+				if 'transfer-encoding' in headers:
+					status, body, keep_alive = 411, {"error": "Content-Length is required."}, False
+				elif (length := int(headers.get('content-length') or 0)) > WEBHOOK_MAX_BODY_BYTES:
+					status, body, keep_alive = 413, {"error": "Request body too large."}, False
+				else:
+					data = await reader.readexactly(length)
+					self._inflight += 1
+					try:
+						status, body = await asyncio.get_running_loop().run_in_executor(self._executor, self._handle, method, urllib.parse.urlsplit(target).path, headers, data, source_ip)
+					finally:
+						self._inflight -= 1
+				keep_alive = keep_alive and not self._stopping.is_set()
+				payload = (body if isinstance(body, str) else json.dumps(body)).encode('utf-8')
+				writer.write((f"HTTP/1.1 {status} {http.client.responses.get(status, '')}\r\nContent-Type: application/json\r\n"
+					f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode() + payload)
+				await writer.drain()
+				if not keep_alive: break
+		except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+			# PT-BR: Requisição malformada ou cliente que desconectou no meio: só fecha a conexão.
+			logger.debug(f"Closing HTTP connection from {source_ip}: {e!r}")
+		finally:
+			self._connections.discard(writer)
+			writer.close()
+
+	def _handle(self, method, path, headers, data, source_ip):
+		"""
+		Turns one HTTP request into a Lambda event and returns (status, body) from lambda_handler.
+		PT-BR: Converte uma requisição HTTP num evento da Lambda e retorna (status, corpo) do lambda_handler.
+		"""
+		self.stats["requests"] += 1
+		try:
+			if method == 'GET' and path == '/health':
+				return 200, {"status": "ok", "server": self.stats, "ha_circuit": ha_circuit.snapshot(), "state_cache": state_cache_stats}
+			if method != 'POST' or path not in ('/alexa', '/webhook'):
+				return 404, {"error": "Not found."}
+			if path == '/webhook':
+				event = {"requestContext": {"http": {"method": "POST", "sourceIp": source_ip}}, "headers": headers, "body": base64.b64encode(data).decode(), "isBase64Encoded": True}
+			else:
+				# PT-BR: Fora da Lambda nada garante que a diretiva veio da Alexa; o proxy que a encaminha envia o segredo do webhook.
+				if not security_check(headers, source_ip):
+					return 403, {"error": "Security validation failed"}
+				try:
+					event = json.loads(data or b'{}')
+				except ValueError:
+					return 400, {"error": "Invalid JSON format."}
+				if not isinstance(event, dict) or 'directive' not in event:
+					return 400, {"error": "Expected an Alexa directive."}
+			response = lambda_handler(event, None)
+			if 'statusCode' in response:
+				return response['statusCode'], response.get('body') or '{}'
+			return 200, response
+		except Exception:
+			self.stats["errors"] += 1
+			logger.exception(f"Exception handling {method} {path}")
+			return 500, {"error": "Internal server error."}
+
+def run_server():
+	"""
+	Entry point of the self-hosted server mode: runs until SIGINT/SIGTERM, then shuts down gracefully.
+	PT-BR: Ponto de entrada do modo servidor: roda até SIGINT/SIGTERM e então encerra de forma ordenada.
+	"""
+	import asyncio
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+	try:
+		asyncio.run(AlexaHTTPServer().run())
+	except KeyboardInterrupt:
+		logger.info("HTTP server stopped.")
+
+if __name__ == '__main__':
+	import sys
+	if (command := sys.argv[1:2]) == ['bridge']:
+		run_bridge()
+	elif command == ['serve']:
+		run_server()
+	else:
+		print(f"Usage: {sys.argv[0]} bridge|serve")
+		sys.exit(2)
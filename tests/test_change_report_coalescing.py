@@ -0,0 +1,94 @@
+"""
+Tests for ChangeReport deduplication and window coalescing (plan_change_reports and the flush timer).
+PT-BR: Testes da deduplicação e do agrupamento por janela dos ChangeReports (plan_change_reports e o timer de envio).
+"""
+import importlib.util
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_lambda_module():
+	spec = importlib.util.spec_from_file_location('lambda_function', os.path.join(REPO_ROOT, 'lambda.py'))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+lambda_function = load_lambda_module()
+KEY = ('user', 'light.a')
+
+def brightness(value):
+	return [{"namespace": "Alexa.BrightnessController", "name": "brightness", "value": value, "timeOfSample": time.time(), "uncertaintyInMilliseconds": 500}]
+
+class ChangeReportCoalescingTest(unittest.TestCase):
+	def setUp(self):
+		lambda_function._last_sent_reports.clear()
+		lambda_function._pending_change_reports.clear()
+		lambda_function.change_report_stats.update({key: 0 for key in lambda_function.change_report_stats})
+		# PT-BR: O timer envia pelo deliver_planned_change_reports; aqui ele só registra o que seria enviado.
+		self.flushed, self.flush_done = [], threading.Event()
+		def deliver(tokens, due):
+			self.flushed.extend(due)
+			self.flush_done.set()
+			return []
+		for patcher in (
+			mock.patch.object(lambda_function, 'CHANGE_REPORT_COALESCE_MS', 100),
+			mock.patch.object(lambda_function, 'RUNNING_ON_LAMBDA', False),
+			mock.patch.object(lambda_function, 'get_user_access_tokens', return_value={'user': 'token'}),
+			mock.patch.object(lambda_function, 'deliver_planned_change_reports', side_effect=deliver),
+		):
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def _plan(self, value):
+		return [(key, properties[0]["value"]) for key, properties in lambda_function.plan_change_reports({KEY: brightness(value)})]
+
+	def test_unchanged_properties_are_suppressed(self):
+		with mock.patch.object(lambda_function, 'CHANGE_REPORT_COALESCE_MS', 0):
+			self.assertEqual(self._plan(10), [(KEY, 10)])
+			self.assertEqual(self._plan(10), [])
+		self.assertEqual(lambda_function.change_report_stats["deduplicated"], 1)
+
+	def test_burst_inside_the_window_sends_only_the_latest_value(self):
+		self.assertEqual(self._plan(10), [(KEY, 10)])
+		self.assertEqual(self._plan(20), [])
+		self.assertEqual(self._plan(30), [])
+		self.assertEqual(lambda_function.change_report_stats["coalesced"], 1)
+		self.assertTrue(self.flush_done.wait(2))
+		self.assertEqual([(key, properties[0]["value"]) for key, properties in self.flushed], [(KEY, 30)])
+		self.assertEqual(lambda_function._pending_change_reports, {})
+
+	def test_returning_to_the_sent_value_cancels_the_pending_report(self):
+		self.assertEqual(self._plan(10), [(KEY, 10)])
+		self.assertEqual(self._plan(20), [])
+		self.assertEqual(self._plan(10), [])
+		self.assertEqual(lambda_function._pending_change_reports, {})
+		self.assertFalse(self.flush_done.wait(0.3))
+
+	def test_change_after_the_window_is_sent_at_once(self):
+		self.assertEqual(self._plan(10), [(KEY, 10)])
+		time.sleep(0.12)
+		self.assertEqual(self._plan(20), [(KEY, 20)])
+
+	def test_window_is_ignored_on_lambda(self):
+		with mock.patch.object(lambda_function, 'RUNNING_ON_LAMBDA', True):
+			self.assertEqual([self._plan(value) for value in (10, 20, 20)], [[(KEY, 10)], [(KEY, 20)], []])
+		self.assertEqual(lambda_function._pending_change_reports, {})
+
+class FailedChangeReportTest(unittest.TestCase):
+	def setUp(self):
+		lambda_function._last_sent_reports.clear()
+
+	def test_failed_delivery_is_not_suppressed_as_duplicate(self):
+		with mock.patch.object(lambda_function, 'CHANGE_REPORT_COALESCE_MS', 0):
+			due = lambda_function.plan_change_reports({KEY: brightness(10)})
+			failure = {"user_id": KEY[0], "entity_id": KEY[1], "success": False, "status": 500, "retryable": False}
+			with mock.patch.object(lambda_function, 'send_change_reports', return_value=[failure]), mock.patch.object(lambda_function, 'get_retry_queue', return_value=None):
+				lambda_function.deliver_planned_change_reports({'user': 'token'}, due)
+			self.assertEqual(len(lambda_function.plan_change_reports({KEY: brightness(10)})), 1)
+
+if __name__ == '__main__':
+	unittest.main()
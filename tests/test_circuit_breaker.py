@@ -0,0 +1,105 @@
+"""
+Tests for the Home Assistant circuit breaker: state transitions and which errors count as failures.
+PT-BR: Testes do circuit breaker do Home Assistant: transições de estado e quais erros contam como falha.
+"""
+import importlib.util
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_lambda_module():
+	spec = importlib.util.spec_from_file_location('lambda_function', os.path.join(REPO_ROOT, 'lambda.py'))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+lambda_function = load_lambda_module()
+CircuitBreaker = lambda_function.CircuitBreaker
+
+class CircuitBreakerTransitionTest(unittest.TestCase):
+	def test_opens_after_consecutive_failures(self):
+		breaker = CircuitBreaker("Test", failure_threshold=3, cooldown=60)
+		for _ in range(2): breaker.record_failure()
+		self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+		breaker.record_failure()
+		self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+		self.assertFalse(breaker.allow())
+		self.assertEqual(breaker.snapshot()["rejected"], 1)
+
+	def test_success_resets_the_failure_count(self):
+		breaker = CircuitBreaker("Test", failure_threshold=2, cooldown=60)
+		breaker.record_failure()
+		breaker.record_success()
+		breaker.record_failure()
+		self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+	def test_half_open_trial_closes_or_reopens(self):
+		for succeeded, expected in ((True, CircuitBreaker.CLOSED), (False, CircuitBreaker.OPEN)):
+			with self.subTest(succeeded=succeeded):
+				breaker = CircuitBreaker("Test", failure_threshold=1, cooldown=0.05)
+				breaker.record_failure()
+				self.assertFalse(breaker.allow())
+				time.sleep(0.06)
+				self.assertTrue(breaker.allow())
+				self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+				breaker.record_success() if succeeded else breaker.record_failure()
+				self.assertEqual(breaker.state, expected)
+
+	def test_only_one_trial_passes_after_the_cooldown(self):
+		breaker = CircuitBreaker("Test", failure_threshold=1, cooldown=0.05)
+		breaker.record_failure()
+		time.sleep(0.06)
+		allowed, barrier = [], threading.Barrier(16)
+		def call():
+			barrier.wait()
+			allowed.append(breaker.allow())
+		threads = [threading.Thread(target=call) for _ in range(16)]
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+		self.assertEqual(allowed.count(True), 1)
+
+	def test_unreachable_statuses_count_as_failures(self):
+		breaker = CircuitBreaker("Test", failure_threshold=2, cooldown=60)
+		breaker.record_status(502)
+		breaker.record_status(404)
+		breaker.record_status(530)
+		self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+		breaker.record_status(504)
+		self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+class HomeAssistantCircuitTest(unittest.TestCase):
+	def setUp(self):
+		lambda_function.ha_circuit = CircuitBreaker("HomeAssistant", failure_threshold=1, cooldown=60)
+		self.pool = mock.Mock()
+		for patcher in (mock.patch.object(lambda_function, 'HA_URL', 'http://ha.test'), mock.patch.object(lambda_function, 'get_connection_pool', return_value=self.pool)):
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def _call_with(self, error):
+		self.pool.request.side_effect = error
+		result = lambda_function._call_ha_api("states")
+		self.pool.request.assert_called_once()
+		return result
+
+	def test_connection_errors_trip_the_breaker(self):
+		self.assertIsNone(self._call_with(ConnectionRefusedError()))
+		self.assertEqual(lambda_function.ha_circuit.state, CircuitBreaker.OPEN)
+
+	def test_pool_exhaustion_does_not_trip_the_breaker(self):
+		self.assertIsNone(self._call_with(lambda_function.ConnectionPoolExhausted("Connection limit reached")))
+		self.assertEqual(lambda_function.ha_circuit.snapshot()["consecutive_failures"], 0)
+		self.assertEqual(lambda_function.ha_circuit.state, CircuitBreaker.CLOSED)
+
+	def test_saturated_pool_raises_pool_exhaustion(self):
+		pool = lambda_function.ConnectionPool('http', '127.0.0.1', 9, max_connections=1, idle_timeout=60)
+		pool._slots.acquire()
+		with self.assertRaises(lambda_function.ConnectionPoolExhausted) as raised:
+			pool.request('GET', '/', timeout=0.01)
+		self.assertNotIsInstance(raised.exception, OSError)
+
+if __name__ == '__main__':
+	unittest.main()
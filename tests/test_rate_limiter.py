@@ -0,0 +1,72 @@
+"""
+Tests for LocalRateLimiter, the in-memory token bucket used by the webhook security check.
+PT-BR: Testes do LocalRateLimiter, o token bucket em memória usado na checagem de segurança do webhook.
+"""
+import importlib.util
+import os
+import threading
+import types
+import unittest
+from unittest import mock
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_lambda_module():
+	spec = importlib.util.spec_from_file_location('lambda_function', os.path.join(REPO_ROOT, 'lambda.py'))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+lambda_function = load_lambda_module()
+
+class LocalRateLimiterTest(unittest.TestCase):
+	def setUp(self):
+		# PT-BR: Relógio controlado pelo teste no lugar do time.monotonic do módulo.
+		self.now = 1000.0
+		patcher = mock.patch.object(lambda_function, 'time', types.SimpleNamespace(monotonic=lambda: self.now))
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_burst_up_to_capacity_then_rejects(self):
+		limiter = lambda_function.LocalRateLimiter(max_requests=3, window=60, max_keys=100)
+		self.assertEqual([limiter.allow("ip") for _ in range(4)], [True, True, True, False])
+
+	def test_refills_at_the_window_rate_without_exceeding_capacity(self):
+		limiter = lambda_function.LocalRateLimiter(max_requests=3, window=60, max_keys=100)
+		for _ in range(3): limiter.allow("ip")
+		self.now += 19
+		self.assertFalse(limiter.allow("ip"))
+		self.now += 1
+		self.assertTrue(limiter.allow("ip"))
+		self.assertFalse(limiter.allow("ip"))
+		self.now += 3600
+		self.assertEqual([limiter.allow("ip") for _ in range(4)], [True, True, True, False])
+
+	def test_keys_have_separate_buckets(self):
+		limiter = lambda_function.LocalRateLimiter(max_requests=1, window=60, max_keys=100)
+		self.assertTrue(limiter.allow("a"))
+		self.assertFalse(limiter.allow("a"))
+		self.assertTrue(limiter.allow("b"))
+
+	def test_key_table_is_bounded(self):
+		limiter = lambda_function.LocalRateLimiter(max_requests=1, window=60, max_keys=2)
+		for key in ("a", "b", "c"): limiter.allow(key)
+		self.assertEqual(list(limiter._buckets), ["b", "c"])
+		# PT-BR: Buckets ociosos por uma janela inteira já estão cheios e saem da tabela.
+		self.now += 60
+		limiter.allow("d")
+		self.assertEqual(list(limiter._buckets), ["d"])
+
+	def test_concurrent_requests_never_exceed_capacity(self):
+		limiter = lambda_function.LocalRateLimiter(max_requests=10, window=60, max_keys=100)
+		allowed, barrier = [], threading.Barrier(32)
+		def call():
+			barrier.wait()
+			allowed.append(limiter.allow("ip"))
+		threads = [threading.Thread(target=call) for _ in range(32)]
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+		self.assertEqual(allowed.count(True), 10)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,84 @@
+"""
+Tests for the per-user single-flight token refresh, with the SQLite token store and a stubbed
+Login with Amazon endpoint.
+PT-BR: Testes do refresh único por usuário, com o armazenamento de tokens em SQLite e o endpoint
+do Login with Amazon substituído.
+"""
+import importlib.util
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_lambda_module():
+	# PT-BR: As variáveis de ambiente só valem durante a importação, para não vazar para os outros módulos de teste.
+	with mock.patch.dict(os.environ, {'TOKEN_STORE_BACKEND': 'sqlite', 'TOKEN_STORE_PATH': os.path.join(tempfile.mkdtemp(), 'tokens.db')}):
+		spec = importlib.util.spec_from_file_location('lambda_function', os.path.join(REPO_ROOT, 'lambda.py'))
+		module = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(module)
+	return module
+
+lambda_function = load_lambda_module()
+
+class SingleFlightRefreshTest(unittest.TestCase):
+	def setUp(self):
+		lambda_function._token_cache.clear()
+		self.calls, self.calls_lock, self.in_flight, self.max_in_flight = [], threading.Lock(), 0, 0
+		patcher = mock.patch.object(lambda_function, '_request_lwa_token', side_effect=self._slow_lwa)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def _slow_lwa(self, payload):
+		with self.calls_lock:
+			self.calls.append(payload["refresh_token"])
+			self.in_flight += 1
+			self.max_in_flight = max(self.max_in_flight, self.in_flight)
+		time.sleep(0.1)
+		with self.calls_lock: self.in_flight -= 1
+		return {"access_token": f"Atza|{payload['refresh_token']}|{len(self.calls)}", "refresh_token": payload["refresh_token"]}
+
+	def _link(self, user_id, expires_at):
+		lambda_function.get_token_store().put({'user_id': user_id, 'access_token': f'Atza|{user_id}|old', 'refresh_token': f'Atzr|{user_id}', 'expires_at': expires_at})
+
+	def _concurrently(self, target, count):
+		results, barrier = [None] * count, threading.Barrier(count)
+		def call(i):
+			barrier.wait()
+			results[i] = target(i)
+		threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+		return results
+
+	def test_concurrent_callers_share_one_refresh(self):
+		self._link('user-a', int(time.time()) - 10)
+		tokens = self._concurrently(lambda i: lambda_function.get_user_access_token('user-a'), 16)
+		self.assertEqual(self.calls, ['Atzr|user-a'])
+		self.assertEqual(set(tokens), {'Atza|Atzr|user-a|1'})
+		self.assertEqual(lambda_function.get_token_store().get('user-a', consistent=True)['access_token'], 'Atza|Atzr|user-a|1')
+
+	def test_different_users_refresh_in_parallel(self):
+		for user_id in ('user-b', 'user-c'): self._link(user_id, int(time.time()) - 10)
+		self._concurrently(lambda i: lambda_function.get_user_access_token(('user-b', 'user-c')[i % 2]), 8)
+		self.assertEqual(sorted(self.calls), ['Atzr|user-b', 'Atzr|user-c'])
+		# PT-BR: Com um lock global os dois refreshes seriam feitos em sequência.
+		self.assertEqual(self.max_in_flight, 2)
+
+	def test_valid_token_is_served_without_refresh(self):
+		self._link('user-d', int(time.time()) + 3600)
+		self.assertEqual(lambda_function.get_user_access_token('user-d'), 'Atza|user-d|old')
+		self.assertEqual(lambda_function.get_user_access_tokens(['user-d']), {'user-d': 'Atza|user-d|old'})
+		self.assertEqual(self.calls, [])
+
+	def test_batch_lookup_refreshes_each_expired_user_once(self):
+		for user_id in ('user-e', 'user-f'): self._link(user_id, int(time.time()) - 10)
+		results = self._concurrently(lambda i: lambda_function.get_user_access_tokens(['user-e', 'user-f']), 6)
+		self.assertEqual(sorted(self.calls), ['Atzr|user-e', 'Atzr|user-f'])
+		self.assertTrue(all(result.keys() == {'user-e', 'user-f'} for result in results))
+
+if __name__ == '__main__':
+	unittest.main()
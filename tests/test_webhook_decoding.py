@@ -0,0 +1,91 @@
+"""
+Tests for decode_webhook_body and the webhook route's handling of malformed bodies.
+PT-BR: Testes do decode_webhook_body e do tratamento de corpos malformados na rota do webhook.
+"""
+import base64
+import gzip
+import importlib.util
+import json
+import os
+import unittest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_lambda_module():
+	# PT-BR: 'lambda' é palavra reservada, então o arquivo é carregado pelo caminho.
+	spec = importlib.util.spec_from_file_location('lambda_function', os.path.join(REPO_ROOT, 'lambda.py'))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+lambda_function = load_lambda_module()
+decode = lambda_function.decode_webhook_body
+
+def _gzip_b64(text):
+	return base64.b64encode(gzip.compress(text.encode('utf-8'))).decode()
+
+class DecodeWebhookBodyTest(unittest.TestCase):
+	def test_legacy_entities(self):
+		body = json.dumps({"entities": [{"entity_id": "light.a", "state": "on", "brightness": 128}]})
+		self.assertEqual(decode({}, body)["entities"], [{"entity_id": "light.a", "state": "on", "brightness": 128}])
+
+	def test_missing_body_is_empty(self):
+		self.assertEqual(decode({}, None).get("entities", []), [])
+
+	def test_columnar_rows_drop_nulls(self):
+		body = json.dumps({"v": 2, "cols": ["entity_id", "state", "brightness", "current_position"], "rows": [["light.a", "on", 5, None], ["cover.b", "open", None, 100]]})
+		self.assertEqual(decode({}, body)["entities"], [{"entity_id": "light.a", "state": "on", "brightness": 5}, {"entity_id": "cover.b", "state": "open", "current_position": 100}])
+
+	def test_ndjson_skips_blank_lines(self):
+		body = '{"entity_id": "light.a", "state": "on"}\n\n{"entity_id": "light.b", "state": "off"}\n'
+		self.assertEqual([entity["entity_id"] for entity in decode({"content-type": "application/x-ndjson"}, body)["entities"]], ["light.a", "light.b"])
+
+	def test_gzip_from_header_and_magic_bytes(self):
+		body = _gzip_b64(json.dumps({"v": 2, "cols": ["entity_id", "state"], "rows": [["light.a", "on"]]}))
+		expected = [{"entity_id": "light.a", "state": "on"}]
+		self.assertEqual(decode({"content-encoding": "gzip"}, body, True)["entities"], expected)
+		self.assertEqual(decode({}, body, True)["entities"], expected)
+
+	def test_gzip_ndjson(self):
+		body = _gzip_b64('{"entity_id": "light.a", "state": "on"}\n')
+		self.assertEqual(decode({"content-encoding": "gzip", "content-type": "application/x-ndjson"}, body, True)["entities"], [{"entity_id": "light.a", "state": "on"}])
+
+	def test_gzip_over_limit_is_rejected(self):
+		body = _gzip_b64(' ' * (lambda_function.WEBHOOK_MAX_BODY_BYTES + 1))
+		with self.assertRaisesRegex(ValueError, "WEBHOOK_MAX_BODY_BYTES"):
+			decode({"content-encoding": "gzip"}, body, True)
+
+	def test_malformed_bodies_raise_value_error(self):
+		cases = [
+			({"content-encoding": "gzip"}, "not gzip", False),
+			({}, "not json", False),
+			({}, "[1, 2]", False),
+			({}, json.dumps({"v": 2, "cols": ["a"], "rows": 5}), False),
+			({}, json.dumps({"v": 2, "cols": "a", "rows": [["x"]]}), False),
+			({}, json.dumps({"v": 2, "cols": [["a"]], "rows": [["x"]]}), False),
+			({}, json.dumps({"v": 2, "cols": ["a"], "rows": [["x", "y"]]}), False),
+			({}, json.dumps({"entities": {"entity_id": "light.a"}}), False),
+			({}, json.dumps({"entities": [5]}), False),
+			({"content-type": "application/x-ndjson"}, '5\n{"entity_id": "light.a"}', False),
+			({}, "%%%", True),
+			({}, base64.b64encode(b'\xff\xfe').decode(), True),
+		]
+		for headers, body, is_base64 in cases:
+			with self.subTest(body=body), self.assertRaises(ValueError):
+				decode(headers, body, is_base64)
+
+class WebhookRouteTest(unittest.TestCase):
+	def _post(self, body, headers=None):
+		event = {"requestContext": {"http": {"method": "POST", "sourceIp": "127.0.0.1"}}, "headers": headers or {}, "body": body, "isBase64Encoded": False}
+		return lambda_function.lambda_handler(event, None)
+
+	def test_malformed_bodies_get_400(self):
+		for body in (json.dumps({"v": 2, "cols": ["a"], "rows": 5}), json.dumps({"entities": [5]}), "not json"):
+			with self.subTest(body=body):
+				self.assertEqual(self._post(body)["statusCode"], 400)
+
+	def test_ndjson_non_object_line_gets_400(self):
+		self.assertEqual(self._post("5\n", {"content-type": "application/x-ndjson"})["statusCode"], 400)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,95 @@
+"""
+Tests for how webhook entities become HA states: attribute normalization and the end-to-end
+ChangeReport, run against the local stand-ins from benchmarks/fakes.py.
+PT-BR: Testes de como as entidades do webhook viram estados do HA: normalização dos atributos e o
+ChangeReport de ponta a ponta, contra os simuladores locais de benchmarks/fakes.py.
+"""
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'benchmarks'))
+
+from fakes import FakeAmazon, FakeHomeAssistant, InMemoryDynamoDB, InMemoryTokensTable
+
+WEBHOOK_SECRET = 'test-secret'
+USER_ID = 'test-user'
+
+def load_lambda_module(ha, amazon, table):
+	# PT-BR: As variáveis de ambiente só valem durante a importação, para não vazar para os outros módulos de teste.
+	with mock.patch.dict(os.environ, {
+		'HA_URL': ha.url, 'HA_TOKEN': 'test', 'WEBHOOK_SECRET': WEBHOOK_SECRET,
+		'ALEXA_GATEWAY_URL': amazon.url, 'LWA_TOKEN_URL': f'{amazon.url}/auth/o2/token',
+		'ALEXA_CLIENT_ID': 'test', 'ALEXA_CLIENT_SECRET': 'test', 'ALEXA_USER_ID': USER_ID,
+		'RETRY_QUEUE_PATH': os.path.join(tempfile.mkdtemp(), 'retry-queue.db'),
+	}):
+		spec = importlib.util.spec_from_file_location('lambda_function', os.path.join(REPO_ROOT, 'lambda.py'))
+		module = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(module)
+	table.items[USER_ID] = {'user_id': USER_ID, 'access_token': 'Atza|test', 'refresh_token': 'Atzr|test', 'expires_at': 2 ** 31}
+	table.items['route#*'] = {'user_id': 'route#*', 'users': {USER_ID}, 'seeded_at': 1}
+	module._aws_clients['dynamodb'] = InMemoryDynamoDB(module.DYNAMODB_TABLE_NAME, table)
+	return module
+
+def setUpModule():
+	global ha, amazon, lambda_function
+	ha, amazon = FakeHomeAssistant().start(), FakeAmazon().start()
+	lambda_function = load_lambda_module(ha, amazon, InMemoryTokensTable())
+
+def tearDownModule():
+	ha.stop()
+	amazon.stop()
+
+class NormalizeWebhookEntityTest(unittest.TestCase):
+	def test_empty_and_malformed_attributes_are_skipped(self):
+		state = lambda_function.normalize_webhook_entity({"entity_id": "light.sonoff", "state": "on", "brightness": "", "current_position": "", "hs_color": "", "color_temp_kelvin": "warm", "friendly_name": ""})
+		self.assertEqual(state, {"entity_id": "light.sonoff", "state": "on", "attributes": {}})
+
+	def test_numeric_strings_become_numbers(self):
+		state = lambda_function.normalize_webhook_entity({"entity_id": "cover.a", "state": "open", "current_position": "40", "brightness": "127.5"})
+		self.assertEqual(state["attributes"], {"current_position": 40, "brightness": 127.5})
+
+class WebhookChangeReportTest(unittest.TestCase):
+	def setUp(self):
+		lambda_function._state_cache.clear()
+
+	def _post(self, entities, **body):
+		event = {"requestContext": {"http": {"method": "POST", "sourceIp": "127.0.0.1"}}, "headers": {"x-webhook-secret": WEBHOOK_SECRET}, "body": json.dumps({"entities": entities, **body}), "isBase64Encoded": False}
+		return lambda_function.lambda_handler(event, None)
+
+	def _report_state(self, entity_id):
+		requests = ha.requests
+		directive = {"header": {"namespace": "Alexa", "name": "ReportState", "payloadVersion": "3", "messageId": "test", "correlationToken": "test"}, "endpoint": {"scope": {"type": "BearerToken", "token": USER_ID}, "endpointId": entity_id}, "payload": {}}
+		response = lambda_function.lambda_handler({"directive": directive}, None)
+		return {prop["name"]: prop["value"] for prop in response["context"]["properties"]}, ha.requests - requests
+
+	def test_complete_webhook_state_answers_report_state(self):
+		entity = {"entity_id": "light.bench_3", "state": "on", "brightness": 51, "current_position": None, "hs_color": [120.0, 40.0], "color_temp_kelvin": None, "friendly_name": "Light 3"}
+		self.assertEqual(self._post([entity], complete=True)["statusCode"], 200)
+		properties, ha_requests = self._report_state("light.bench_3")
+		self.assertEqual(ha_requests, 0)
+		self.assertEqual(properties["brightness"], 20)
+		self.assertEqual(properties["color"]["hue"], 120.0)
+
+	def test_partial_webhook_state_does_not_answer_report_state(self):
+		self.assertEqual(self._post([{"entity_id": "light.bench_4", "state": "on", "brightness": 51}])["statusCode"], 200)
+		properties, ha_requests = self._report_state("light.bench_4")
+		self.assertEqual(ha_requests, 1)
+		self.assertIn("color", properties)
+
+	def test_on_off_light_with_empty_attributes_reports_power_state(self):
+		# PT-BR: Payload que a automação gera para uma luz só liga/desliga (brilho e posição vazios).
+		sent = []
+		with mock.patch.object(lambda_function, 'deliver_to_alexa_gateway', side_effect=lambda token, payload: sent.append(payload) or {"success": True, "status": 202, "retryable": False}):
+			response = self._post([{"entity_id": "light.sonoff", "state": "on", "brightness": "", "current_position": ""}])
+		self.assertEqual(response["statusCode"], 200)
+		self.assertEqual(json.loads(response["body"])["successful_sends"], 1)
+		self.assertEqual([(p["name"], p["value"]) for p in sent[0]["event"]["payload"]["change"]["properties"]], [("powerState", "ON")])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,58 @@
+"""
+Tests for HAWebSocket.receive_json timeouts against a loopback server that writes raw frames.
+PT-BR: Testes dos timeouts do HAWebSocket.receive_json contra um servidor local que escreve frames crus.
+"""
+import asyncio
+import importlib.util
+import json
+import os
+import unittest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_lambda_module():
+	spec = importlib.util.spec_from_file_location('lambda_function', os.path.join(REPO_ROOT, 'lambda.py'))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+lambda_function = load_lambda_module()
+
+def _text_frame(message):
+	data = json.dumps(message).encode()
+	return bytes([0x81, len(data)]) + data
+
+class ReceiveJsonTimeoutTest(unittest.IsolatedAsyncioTestCase):
+	async def _connect(self, serve):
+		server = await asyncio.start_server(serve, '127.0.0.1', 0)
+		self.addAsyncCleanup(server.wait_closed)
+		self.addCleanup(server.close)
+		reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+		self.addCleanup(writer.close)
+		return lambda_function.HAWebSocket(reader, writer)
+
+	async def test_timeout_while_idle_keeps_the_stream_in_sync(self):
+		async def serve(reader, writer):
+			await asyncio.sleep(0.2)
+			writer.write(_text_frame({"type": "pong"}))
+			await writer.drain()
+		websocket = await self._connect(serve)
+		with self.assertRaises(asyncio.TimeoutError):
+			await websocket.receive_json(timeout=0.05)
+		self.assertEqual(await websocket.receive_json(timeout=1), {"type": "pong"})
+
+	async def test_slow_frame_body_is_not_cut_by_the_timeout(self):
+		frame = _text_frame({"type": "event", "id": 1})
+		async def serve(reader, writer):
+			# PT-BR: O cabeçalho chega antes do timeout e o corpo só depois dele.
+			writer.write(frame[:2])
+			await writer.drain()
+			await asyncio.sleep(0.2)
+			writer.write(frame[2:] + _text_frame({"type": "pong"}))
+			await writer.drain()
+		websocket = await self._connect(serve)
+		self.assertEqual(await websocket.receive_json(timeout=0.05), {"type": "event", "id": 1})
+		self.assertEqual(await websocket.receive_json(timeout=1), {"type": "pong"})
+
+if __name__ == '__main__':
+	unittest.main()